@@ -11,7 +11,6 @@ from pmb.helpers.exceptions import BuildFailedError, NonBugError
 
 from . import config
 from . import parse
-from .config import init as config_init
 from .helpers import frontend
 from .helpers import logging as pmb_logging
 from .helpers import mount
@@ -57,7 +56,7 @@ def main():
 
         # Initialize or require config
         if args.action == "init":
-            return config_init.frontend(args)
+            return frontend.run(args)
         elif not os.path.exists(args.config):
             raise RuntimeError("Please specify a config file, or run"
                                " 'pmbootstrap init' to generate one.")
@@ -73,7 +72,7 @@ def main():
 
         # Run the function with the action's name (in pmb/helpers/frontend.py)
         if args.action:
-            getattr(frontend, args.action)(args)
+            frontend.run(args)
         else:
             logging.info("Run pmbootstrap -h for usage information.")
 
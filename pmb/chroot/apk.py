@@ -4,9 +4,11 @@ import os
 import logging
 import shlex
 
+import pmb.build
 import pmb.chroot
 import pmb.config
 import pmb.helpers.apk
+import pmb.helpers.package
 import pmb.helpers.pmaports
 import pmb.parse.apkindex
 import pmb.parse.arch
@@ -150,13 +152,19 @@ def packages_get_locally_built_apks(args, packages, arch):
     channel = pmb.config.pmaports.read_config(args)["channel"]
     ret = []
 
+    # List the local packages once, instead of checking each path separately
+    local_dir = f"{args.work}/packages/{channel}/{arch}"
+    if not os.path.exists(local_dir):
+        return ret
+    local_apks = set(os.listdir(local_dir))
+
     for package in packages:
         data_repo = pmb.parse.apkindex.package(args, package, arch, False)
         if not data_repo:
             continue
 
         apk_file = f"{package}-{data_repo['version']}.apk"
-        if not os.path.exists(f"{args.work}/packages/{channel}/{arch}/{apk_file}"):
+        if apk_file not in local_apks:
             continue
 
         ret.append(f"/mnt/pmbootstrap/packages/{arch}/{apk_file}")
@@ -164,11 +172,104 @@ def packages_get_locally_built_apks(args, packages, arch):
     return ret
 
 
+def world(args, suffix="native"):
+    """
+    Read the world file of a chroot (the explicitly installed packages).
+
+    :returns: list of world entries as written by apk, e.g.
+              ["alpine-base", "postmarketos-base>=3", ...]
+    """
+    path = f"{args.work}/chroot_{suffix}/etc/apk/world"
+    if not os.path.exists(path):
+        return []
+    with open(path) as handle:
+        return handle.read().split()
+
+
+def world_write(args, world, suffix="native"):
+    """
+    Replace the world file of a chroot. This does not install or remove any
+    packages, the next apk invocation applies the changes.
+
+    :param world: list of world entries, e.g. ["alpine-base", ...]
+    """
+    path = f"{args.work}/chroot_{suffix}/etc/apk/world"
+    content = "".join(f"{entry}\n" for entry in world)
+    pmb.helpers.run.root(args, ["sh", "-c", f"printf %s {shlex.quote(content)}"
+                                f" > {shlex.quote(path)}"])
+
+
+def world_get_final(world_old, to_add, to_del):
+    """
+    Calculate the world file contents after adding and deleting packages.
+
+    :param world_old: return value of world()
+    :param to_add: list of pkgnames to be explicitly installed
+    :param to_del: list of pkgnames to be removed from the world
+    :returns: list of world entries
+    """
+    ret = []
+    for entry in world_old:
+        if pmb.helpers.package.remove_operators(entry) not in to_del:
+            ret.append(entry)
+
+    names = [pmb.helpers.package.remove_operators(entry) for entry in ret]
+    for package in to_add:
+        if package not in names:
+            ret.append(package)
+            names.append(package)
+    return ret
+
+
+def install_is_satisfied(args, to_add, to_add_no_deps, to_del, arch,
+                         suffix="native"):
+    """
+    Check if a chroot already has exactly the requested packages installed, so
+    running apk can be skipped entirely.
+
+    :param to_add: list of pkgnames to install, with all their dependencies
+    :param to_add_no_deps: list of pkgnames that must be in the world file
+    :param to_del: list of pkgnames that must not be installed
+    :param arch: architecture of the chroot
+    :returns: True if apk would not change anything, False otherwise
+    """
+    world_names = [pmb.helpers.package.remove_operators(entry)
+                   for entry in world(args, suffix)]
+    for package in to_add_no_deps:
+        if package not in world_names:
+            return False
+
+    installed_pkgs = installed(args, suffix)
+    for package in to_del:
+        if package in installed_pkgs:
+            return False
+
+    for package in to_add:
+        data_installed = installed_pkgs.get(package)
+        if not data_installed:
+            return False
+
+        # Compare the timestamp too, so locally rebuilt packages with the same
+        # pkgver and pkgrel get installed
+        data_repo = pmb.parse.apkindex.package(args, package, arch, False)
+        if not data_repo:
+            continue
+        for key in ["version", "timestamp"]:
+            if data_installed.get(key) != data_repo.get(key):
+                return False
+
+    return True
+
+
 def install_run_apk(args, to_add, to_add_local, to_del, suffix):
     """
     Run apk to add packages, and ensure only the desired packages get
     explicitly marked as installed.
 
+    The final world (explicitly installed packages) gets calculated and
+    written first, so adding and deleting packages happens in one apk
+    transaction. Without locally built packages, apk only runs once.
+
     :param to_add: list of pkgnames to install, without their dependencies
     :param to_add_local: return of packages_get_locally_built_apks()
     :param to_del: list of pkgnames to be deleted, this should be set to
@@ -182,17 +283,23 @@ def install_run_apk(args, to_add, to_add_local, to_del, suffix):
         if package.startswith("-"):
             raise ValueError(f"Invalid package name: {package}")
 
-    commands = [["add"] + to_add]
+    # Write the world file if packages need to be removed from it, or if the
+    # explicitly requested packages are not installed by "apk add" below
+    world_old = world(args, suffix)
+    world_new = world_get_final(world_old, to_add, to_del)
+    if world_new != world_old and (to_del or to_add_local):
+        world_write(args, world_new, suffix)
 
-    # Use a virtual package to mark only the explicitly requested packages as
-    # explicitly installed, not the ones in to_add_local
+    # Use a virtual package to upgrade to the locally built packages, without
+    # marking them as explicitly installed. The packages in to_add are already
+    # in the world file, so they get installed in the same transaction.
     if to_add_local:
-        commands += [["add", "-u", "--virtual", ".pmbootstrap"] + to_add_local,
-                     ["del", ".pmbootstrap"]]
-
-    if to_del:
-        commands += [["del"] + to_del]
+        commands = [["add", "-u", "--virtual", ".pmbootstrap"] + to_add_local,
+                    ["del", ".pmbootstrap"]]
+    else:
+        commands = [["add"] + to_add]
 
+    installed_clear_cache(args, suffix)
     for (i, command) in enumerate(commands):
         # --no-interactive is a parameter to `add`, so it must be appended or apk
         # gets confused
@@ -204,11 +311,78 @@ def install_run_apk(args, to_add, to_add_local, to_del, suffix):
             pmb.helpers.apk.apk_with_progress(args, ["apk"] + command,
                                               chroot=True, suffix=suffix)
         else:
-            # Virtual package related commands don't actually install or remove
-            # packages, but only mark the right ones as explicitly installed.
-            # They finish up almost instantly, so don't display a progress bar.
+            # Removing the virtual package doesn't install or remove
+            # packages, but only marks the right ones as explicitly installed.
+            # It finishes up almost instantly, so don't display a progress bar.
             pmb.chroot.root(args, ["apk", "--no-progress"] + command,
                             suffix=suffix)
+    installed_clear_cache(args, suffix)
+
+
+def install_is_satisfied_installed(args, packages, arch, suffix="native",
+                                   build=True):
+    """
+    Check if the requested packages and their dependencies are installed at
+    the wanted versions, by only looking at the installed packages of the
+    chroot. This is much faster than resolving the dependencies with
+    pmb.parse.depends.recurse() and is used to return early in install().
+
+    :param packages: list of pkgnames as passed to install()
+    :param arch: architecture of the chroot
+    :param build: also check if the binary repository has the versions of
+                  the packages in pmaports, otherwise they would need to be
+                  built
+    :returns: True if nothing needs to be installed, False if unsure
+    """
+    snapshot = installed_snapshot(args, suffix)
+    installed_pkgs = snapshot["packages"]
+    world_names = [pmb.helpers.package.remove_operators(entry)
+                   for entry in world(args, suffix)]
+
+    todo = list(packages)
+    done = set()
+    while todo:
+        package = todo.pop()
+        if package in done:
+            continue
+        done.add(package)
+
+        # Conflicting packages must not be installed
+        if package.startswith("!"):
+            if package[1:] in installed_pkgs:
+                return False
+            continue
+
+        # File dependencies (e.g. "/bin/sh") are not in the installed db, apk
+        # takes care of them
+        if package.startswith("/"):
+            continue
+
+        data_installed = installed_pkgs.get(package)
+        if not data_installed:
+            return False
+        if package in packages and package not in world_names:
+            return False
+
+        # Compare with the binary package repository
+        pkgname = data_installed["pkgname"]
+        data_repo = pmb.parse.apkindex.package(args, pkgname, arch, False)
+        if data_repo:
+            for key in ["version", "timestamp"]:
+                if data_installed.get(key) != data_repo.get(key):
+                    return False
+
+        # Compare with pmaports: install_build() builds the package if the
+        # binary repository doesn't have the version from pmaports
+        if build:
+            data_aport = pmb.parse.depends.package_from_aports(args, pkgname)
+            if data_aport and (not data_repo or pmb.parse.version.compare(
+                    data_aport["version"], data_repo["version"]) == 1):
+                return False
+
+        todo += data_installed["depends"]
+
+    return True
 
 
 def install(args, packages, suffix="native", build=True):
@@ -235,6 +409,18 @@ def install(args, packages, suffix="native", build=True):
     check_min_version(args, suffix)
     pmb.chroot.init(args, suffix)
 
+    # Skip when the same packages were installed already in this session, or
+    # when they are installed with all their dependencies at wanted versions
+    satisfied = installed_snapshot(args, suffix)["satisfied"]
+    keys = {(suffix, arch, package) for package in packages}
+    if keys <= satisfied:
+        return
+    if install_is_satisfied_installed(args, packages, arch, suffix, build):
+        logging.debug(f"({suffix}) already installed: {' '.join(packages)}")
+        if build:
+            satisfied.update(keys)
+        return
+
     packages_with_depends = pmb.parse.depends.recurse(args, packages, suffix)
     to_add, to_del = packages_split_to_add_del(packages_with_depends)
 
@@ -242,11 +428,57 @@ def install(args, packages, suffix="native", build=True):
         for package in to_add:
             install_build(args, package, arch)
 
-    to_add_local = packages_get_locally_built_apks(args, to_add, arch)
     to_add_no_deps, _ = packages_split_to_add_del(packages)
+    if install_is_satisfied(args, to_add, to_add_no_deps, to_del, arch,
+                            suffix):
+        logging.debug(f"({suffix}) already installed:"
+                      f" {' '.join(to_add_no_deps)}")
+        if build:
+            installed_snapshot(args, suffix)["satisfied"].update(keys)
+        return
+
+    to_add_local = packages_get_locally_built_apks(args, to_add, arch)
 
     logging.info(f"({suffix}) install {' '.join(to_add_no_deps)}")
     install_run_apk(args, to_add_no_deps, to_add_local, to_del, suffix)
+    if build:
+        installed_snapshot(args, suffix)["satisfied"].update(keys)
+
+
+def installed_snapshot(args, suffix="native"):
+    """
+    Get the cached snapshot of the installed packages in a chroot. It gets
+    parsed once and is kept until apk runs through install_run_apk() (see
+    installed_clear_cache()), or the database file gets modified otherwise.
+
+    :returns: dictionary with the following structure:
+              { "lastmod": 1700000000.0,
+              "packages": installed packages (see installed()),
+              "satisfied": set of (suffix, arch, pkgname) of the packages
+              passed to install() with build=True, which were already
+              installed or got installed since the last apk run }
+    """
+    path = f"{args.work}/chroot_{suffix}/lib/apk/db/installed"
+    lastmod = os.path.getmtime(path) if os.path.exists(path) else None
+
+    cache = pmb.helpers.other.cache["pmb.chroot.apk.installed"]
+    snapshot = cache.get(suffix)
+    if snapshot is None or snapshot["lastmod"] != lastmod:
+        snapshot = {"lastmod": lastmod,
+                    "packages": pmb.parse.apkindex.parse(path, False),
+                    "satisfied": set()}
+        cache[suffix] = snapshot
+    return snapshot
+
+
+def installed_clear_cache(args, suffix="native"):
+    """
+    Drop the snapshot of the installed packages of a chroot, so it gets parsed
+    again on next access. Call this after running apk.
+    """
+    path = f"{args.work}/chroot_{suffix}/lib/apk/db/installed"
+    pmb.parse.apkindex.clear_cache(path)
+    pmb.helpers.other.cache["pmb.chroot.apk.installed"].pop(suffix, None)
 
 
 def installed(args, suffix="native"):
@@ -266,5 +498,4 @@ def installed(args, suffix="native"):
               }
 
     """
-    path = f"{args.work}/chroot_{suffix}/lib/apk/db/installed"
-    return pmb.parse.apkindex.parse(path, False)
+    return installed_snapshot(args, suffix)["packages"]
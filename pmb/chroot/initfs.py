@@ -7,6 +7,7 @@ import pmb.chroot.other
 import pmb.chroot.apk
 import pmb.config.pmaports
 import pmb.helpers.cli
+import pmb.parse.cpio
 
 
 def build(args, flavor, suffix):
@@ -29,22 +30,32 @@ def build(args, flavor, suffix):
                             suffix)
 
 
-def extract(args, flavor, suffix, extra=False):
+def get_path(args, flavor, suffix, extra=False):
+    """:returns: path of the initramfs (or initramfs-extra) inside the
+                 chroot"""
+    pmaports_cfg = pmb.config.pmaports.read_config(args)
+    if pmaports_cfg.get("supported_mkinitfs_without_flavors", False):
+        ret = "/boot/initramfs"
+    else:
+        ret = f"/boot/initramfs-{flavor}"
+    if extra:
+        ret += "-extra"
+    return ret
+
+
+def extract(args, flavor, suffix, extra=False, patterns=None):
     """
     Extract the initramfs to /tmp/initfs-extracted or the initramfs-extra to
     /tmp/initfs-extra-extracted and return the outside extraction path.
+
+    :param patterns: only extract the files matching these patterns, see
+                     pmb.parse.cpio.matches()
     """
     # Extraction folder
     inside = "/tmp/initfs-extracted"
-
-    pmaports_cfg = pmb.config.pmaports.read_config(args)
-    if pmaports_cfg.get("supported_mkinitfs_without_flavors", False):
-        initfs_file = "/boot/initramfs"
-    else:
-        initfs_file = f"/boot/initramfs-${flavor}"
     if extra:
         inside = "/tmp/initfs-extra-extracted"
-        initfs_file += "-extra"
+    initfs_file = get_path(args, flavor, suffix, extra)
 
     outside = f"{args.work}/chroot_{suffix}{inside}"
     if os.path.exists(outside):
@@ -54,35 +65,37 @@ def extract(args, flavor, suffix, extra=False):
             raise RuntimeError("Aborted!")
         pmb.chroot.root(args, ["rm", "-r", inside], suffix)
 
-    # Extraction script (because passing a file to stdin is not allowed
-    # in pmbootstrap's chroot/shell functions for security reasons)
-    with open(f"{args.work}/chroot_{suffix}/tmp/_extract.sh", "w") as handle:
-        handle.write(
-            "#!/bin/sh\n"
-            f"cd {inside} && cpio -i < _initfs\n")
-
     # Extract
-    commands = [["mkdir", "-p", inside],
-                ["cp", initfs_file, f"{inside}/_initfs.gz"],
-                ["gzip", "-d", f"{inside}/_initfs.gz"],
-                ["cat", "/tmp/_extract.sh"],  # for the log
-                ["sh", "/tmp/_extract.sh"],
-                ["rm", "/tmp/_extract.sh", f"{inside}/_initfs"]
-                ]
-    for command in commands:
-        pmb.chroot.root(args, command, suffix)
+    count = pmb.parse.cpio.extract(f"{args.work}/chroot_{suffix}"
+                                   f"{initfs_file}", outside, patterns)
+    logging.debug(f"Extracted {count} entries from {initfs_file}")
 
     # Return outside path for logging
     return outside
 
 
 def ls(args, flavor, suffix, extra=False):
-    tmp = "/tmp/initfs-extracted"
-    if extra:
-        tmp = "/tmp/initfs-extra-extracted"
-    extract(args, flavor, suffix, extra)
-    pmb.chroot.root(args, ["ls", "-lahR", "."], suffix, tmp, "stdout")
-    pmb.chroot.root(args, ["rm", "-r", tmp], suffix)
+    """Print the contents of the initramfs, without extracting it."""
+    path = get_path(args, flavor, suffix, extra)
+    path = f"{args.work}/chroot_{suffix}{path}"
+    for line in pmb.parse.cpio.ls(path):
+        print(line)
+
+
+def diff(args, flavor, suffix, path_old, path_new=None):
+    """Print the size changes of all files between two initramfs builds.
+
+    :param path_old: path to the old initramfs
+    :param path_new: path to the new initramfs, default: the initramfs of
+                     the currently installed kernel
+    """
+    if not path_new:
+        path_new = get_path(args, flavor, suffix)
+        path_new = f"{args.work}/chroot_{suffix}{path_new}"
+    changes = pmb.parse.cpio.diff(path_old, path_new)
+    logging.info(f"Changes from {path_old} to {path_new}:")
+    for line in pmb.parse.cpio.format_diff(path_old, path_new, changes):
+        print(line)
 
 
 def frontend(args):
@@ -95,10 +108,12 @@ def frontend(args):
     if action == "build":
         build(args, flavor, suffix)
     elif action == "extract":
-        dir = extract(args, flavor, suffix)
+        dir = extract(args, flavor, suffix, False, args.files)
         logging.info(f"Successfully extracted initramfs to: {dir}")
-        dir_extra = extract(args, flavor, suffix, True)
+        dir_extra = extract(args, flavor, suffix, True, args.files)
         logging.info(f"Successfully extracted initramfs-extra to: {dir_extra}")
+    elif action == "diff":
+        diff(args, flavor, suffix, args.old, args.new)
     elif action == "ls":
         logging.info("*** initramfs ***")
         ls(args, flavor, suffix)
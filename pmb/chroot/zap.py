@@ -1,25 +1,36 @@
 # Copyright 2023 Oliver Smith
 # SPDX-License-Identifier: GPL-3.0-or-later
+import concurrent.futures
 import glob
 import logging
 import math
 import os
+import time
 
+import pmb.build
 import pmb.chroot
 import pmb.config.pmaports
 import pmb.config.workdir
+import pmb.helpers.apk_cache
+import pmb.helpers.du
 import pmb.helpers.pmaports
 import pmb.helpers.run
 import pmb.parse.apkindex
 
+# Amount of folders that get deleted at the same time
+jobs = 4
+
 
 def zap(args, confirm=True, dry=False, pkgs_local=False, http=False,
         pkgs_local_mismatch=False, pkgs_online_mismatch=False, distfiles=False,
-        rust=False, netboot=False):
+        rust=False, netboot=False, background=False, dedup=False):
     """
     Shutdown everything inside the chroots (e.g. adb), umount
     everything and then safely remove folders from the work-directory.
 
+    The folders get moved to $WORK/trash first, which is instant, and get
+    measured and deleted from there in parallel (see empty_trash()).
+
     :param dry: Only show what would be deleted, do not delete for real
     :param pkgs_local: Remove *all* self-compiled packages (!)
     :param http: Clear the http cache (used e.g. for the initial apk download)
@@ -30,24 +41,27 @@ def zap(args, confirm=True, dry=False, pkgs_local=False, http=False,
     :param distfiles: Clear the downloaded files cache
     :param rust: Remove rust related caches
     :param netboot: Remove images for netboot
+    :param background: Don't wait until the moved folders are deleted. Their
+                       size is not measured then.
+    :param dedup: Hardlink identical packages between the apk caches of all
+                  arches (see pmb.helpers.apk_cache.dedup())
 
     NOTE: This function gets called in pmb/config/init.py, with only args.work
     and args.device set!
     """
-    # Get current work folder size
+    # Amount of bytes that got deleted
+    cleared = 0
     if not dry:
         pmb.chroot.shutdown(args)
-        logging.debug("Calculate work folder size")
-        size_old = pmb.helpers.other.folder_size(args, args.work)
 
     # Delete packages with a different version compared to aports,
     # then re-index
     if pkgs_local_mismatch:
-        zap_pkgs_local_mismatch(args, confirm, dry)
+        cleared += zap_pkgs_local_mismatch(args, confirm, dry)
 
     # Delete outdated binary packages
     if pkgs_online_mismatch:
-        zap_pkgs_online_mismatch(args, confirm, dry)
+        cleared += zap_pkgs_online_mismatch(args, confirm, dry)
 
     pmb.chroot.shutdown(args)
 
@@ -69,7 +83,8 @@ def zap(args, confirm=True, dry=False, pkgs_local=False, http=False,
     if netboot:
         patterns += ["images_netboot"]
 
-    # Delete everything matching the patterns
+    # Move everything matching the patterns to the trash folder
+    delete = []
     for pattern in patterns:
         pattern = os.path.realpath(f"{args.work}/{pattern}")
         matches = glob.glob(pattern)
@@ -77,8 +92,25 @@ def zap(args, confirm=True, dry=False, pkgs_local=False, http=False,
             if (not confirm or
                     pmb.helpers.cli.confirm(args, f"Remove {match}?")):
                 logging.info(f"% rm -rf {match}")
-                if not dry:
-                    pmb.helpers.run.root(args, ["rm", "-rf", match])
+                if not dry and not move_to_trash(args, match):
+                    delete.append(match)
+
+    # Folders on other filesystems (symlinked from the work dir) can't be
+    # moved to the trash, delete them in place
+    if delete:
+        cleared += delete_parallel(args, delete)
+    cleared_trash = None
+    if not dry:
+        cleared_trash = empty_trash(args, background)
+        cleared += cleared_trash or 0
+
+    # Hardlink identical packages between the apk caches of all arches
+    question = "Hardlink identical packages between the apk caches?"
+    if dedup and (not confirm or pmb.helpers.cli.confirm(args, question)):
+        saved = pmb.helpers.apk_cache.dedup(args, dry)
+        verb = "Would deduplicate" if dry else "Deduplicated"
+        logging.info(f"{verb} ~{math.ceil(saved / 1024 / 1024)} MB of"
+                     " packages in the apk caches")
 
     # Remove config init dates for deleted chroots
     pmb.config.workdir.clean(args)
@@ -90,22 +122,97 @@ def zap(args, confirm=True, dry=False, pkgs_local=False, http=False,
     if dry:
         logging.info("Dry run: nothing has been deleted")
     else:
-        size_new = pmb.helpers.other.folder_size(args, args.work)
-        mb = (size_old - size_new) / 1024
-        logging.info(f"Cleared up ~{math.ceil(mb)} MB of space")
+        mb = cleared / 1024 / 1024
+        if cleared_trash is None:
+            logging.info(f"Cleared up ~{math.ceil(mb)} MB of space, not"
+                         " counting the folders that get deleted in"
+                         " background")
+        else:
+            logging.info(f"Cleared up ~{math.ceil(mb)} MB of space")
+
+
+def move_to_trash(args, path):
+    """Move a folder to $WORK/trash, so it is gone from its original place
+    right away. This is a rename on the same filesystem, so it doesn't take
+    longer for big folders.
+
+    :param path: folder inside the work dir
+    :returns: new path inside the trash folder, or None if path is on a
+              different filesystem than the work dir (and was not moved)
+    """
+    trash = f"{args.work}/trash"
+    if os.stat(path).st_dev != os.stat(args.work).st_dev:
+        return None
+    os.makedirs(trash, exist_ok=True)
+    ret = f"{trash}/{os.path.basename(path)}.{time.time_ns()}"
+    pmb.helpers.run.root(args, ["mv", path, ret])
+    return ret
+
+
+def delete(args, path):
+    """Measure a folder and delete it with "rm -rf" as root.
+
+    :returns: amount of bytes that got deleted
+    """
+    ret = pmb.helpers.du.size(args, path)
+    pmb.helpers.run.root(args, ["rm", "-rf", path])
+    return ret
+
+
+def delete_parallel(args, paths):
+    """Measure and delete folders, multiple at the same time (see delete()).
+
+    :returns: amount of bytes that got deleted
+    """
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        futures = [executor.submit(delete, args, path) for path in paths]
+        return sum(future.result() for future in futures)
+
+
+def empty_trash(args, background=False):
+    """Delete everything in $WORK/trash. This includes folders of previous zap
+    runs, that were interrupted or deleted in background.
+
+    :param background: start "rm -rf" in background and don't wait until it
+                       is done. The folders don't get measured then.
+    :returns: amount of bytes that got deleted, or None when deleting in
+              background
+    """
+    paths = sorted(glob.glob(f"{args.work}/trash/*"))
+    if not paths:
+        return 0
+    if background:
+        logging.info("Deleting the moved folders in background, their size"
+                     " is not measured")
+        pmb.helpers.run.root(args, ["rm", "-rf"] + paths, output="background")
+        return None
+    return delete_parallel(args, paths)
+
+
+def remove_files(args, paths):
+    """Remove files as root, with as few "rm" calls as possible.
+
+    :returns: amount of bytes that got removed
+    """
+    ret = sum(os.path.getsize(path) for path in paths)
+    chunk = 500
+    for i in range(0, len(paths), chunk):
+        pmb.helpers.run.root(args, ["rm", "--"] + paths[i:i + chunk])
+    return ret
 
 
 def zap_pkgs_local_mismatch(args, confirm=True, dry=False):
+    """:returns: amount of bytes that got removed"""
     channel = pmb.config.pmaports.read_config(args)["channel"]
     if not os.path.exists(f"{args.work}/packages/{channel}"):
-        return
+        return 0
 
     question = "Remove binary packages that are newer than the corresponding" \
                f" pmaports (channel '{channel}')?"
     if confirm and not pmb.helpers.cli.confirm(args, question):
-        return
+        return 0
 
-    reindex = False
+    remove = []
     pattern = f"{args.work}/packages/{channel}/*/APKINDEX.tar.gz"
     for apkindex_path in glob.glob(pattern):
         # Delete packages without same version in aports
@@ -129,9 +236,7 @@ def zap_pkgs_local_mismatch(args, confirm=True, dry=False):
             if not aport_path:
                 logging.info(f"% rm {apk_path_short}"
                              f" ({origin} aport not found)")
-                if not dry:
-                    pmb.helpers.run.root(args, ["rm", apk_path])
-                    reindex = True
+                remove.append(apk_path)
                 continue
 
             # Clear out any binary apks that do not match what is in aports
@@ -140,23 +245,27 @@ def zap_pkgs_local_mismatch(args, confirm=True, dry=False):
             if version != version_aport:
                 logging.info(f"% rm {apk_path_short}"
                              f" ({origin} aport: {version_aport})")
-                if not dry:
-                    pmb.helpers.run.root(args, ["rm", apk_path])
-                    reindex = True
+                remove.append(apk_path)
 
-    if reindex:
-        pmb.build.other.index_repo(args)
+    if dry or not remove:
+        return 0
+    ret = remove_files(args, remove)
+    pmb.build.other.index_repo(args)
+    return ret
 
 
 def zap_pkgs_online_mismatch(args, confirm=True, dry=False):
+    """:returns: amount of bytes that got removed"""
     # Check whether we need to do anything
     paths = glob.glob(f"{args.work}/cache_apk_*")
     if not len(paths):
-        return
+        return 0
     if (confirm and not pmb.helpers.cli.confirm(args,
                                                 "Remove outdated"
                                                 " binary packages?")):
-        return
+        return 0
+
+    ret = 0
 
     # Iterate over existing apk caches
     for path in paths:
@@ -168,4 +277,7 @@ def zap_pkgs_online_mismatch(args, confirm=True, dry=False):
         # Clean the cache with apk
         logging.info(f"({suffix}) apk -v cache clean")
         if not dry:
+            size_old = pmb.helpers.du.size(args, path)
             pmb.chroot.root(args, ["apk", "-v", "cache", "clean"], suffix)
+            ret += size_old - pmb.helpers.du.size(args, path)
+    return ret
@@ -1,10 +1,14 @@
 # Copyright 2023 Oliver Smith
 # SPDX-License-Identifier: GPL-3.0-or-later
 import collections
+import concurrent.futures
 import glob
+import hashlib
+import json
 import logging
 import os
 import shlex
+import time
 import pmb.chroot
 import pmb.helpers.cli
 
@@ -112,31 +116,117 @@ def ask_which_scripts_to_run(scripts_available):
     return ret
 
 
-def copy_git_repo_to_chroot(args, topdir):
-    """ Create a tarball of the git repo (including unstaged changes and new
-        files) and extract it in chroot_native.
-        
-	:param topdir: top directory of the git repository, get it with:
-          pmb.helpers.git.get_topdir() 
+def get_sync_state_path(args, topdir):
+    key = hashlib.sha256(topdir.encode()).hexdigest()[:16]
+    return f"{args.work}/cache_ci/{key}.json"
+
+
+def get_sync_changes(args, topdir, state):
+    """ Find the files that need to be updated in the copy of the git
+        repository in the chroot, since it was synced the last time.
+
+        :param topdir: top directory of the git repository, get it with:
+          pmb.helpers.git.get_topdir()
+        :param state: from the last sync, see copy_git_repo_to_chroot()
+
+        :returns: (copy, delete) lists of files relative to topdir, or None
+          if the commit of the last sync does not exist anymore
+    """
+    changed = pmb.helpers.git.get_changed_files(args, topdir,
+                                                state["commit"])
+    if changed is None:
+        return None
+
+    # Files that had uncommitted changes during the last sync need to be
+    # synced again, even if the changes were reverted since then
+    copy = []
+    delete = []
+    for path in sorted(set(changed) | set(state["dirty"])):
+        path_host = f"{topdir}/{path}"
+        if os.path.isdir(path_host) and not os.path.islink(path_host):
+            continue
+        if os.path.lexists(path_host):
+            copy.append(path)
+        else:
+            delete.append(path)
+    return (copy, delete)
 
-	"""
-    pmb.chroot.init(args)
-    tarball_path = f"{args.work}/chroot_native/tmp/git.tar.gz"
-    files = pmb.helpers.git.get_files(args, topdir)
 
+def copy_files_to_chroot(args, topdir, files, ci_dir):
+    """ Copy files of the git repository with a tarball to ci_dir inside
+        chroot_native.
+
+        :param files: list of files relative to topdir
+    """
+    tarball_path = f"{args.work}/chroot_native/tmp/git.tar.gz"
     with open(f"{tarball_path}.files", "w") as handle:
         for file in files:
             handle.write(file)
-            handle.write("\n")
+            handle.write("\0")
 
-    pmb.helpers.run.user(args, ["tar", "-cf", tarball_path, "-T",
+    pmb.helpers.run.user(args, ["tar", "-cf", tarball_path, "--null", "-T",
                                 f"{tarball_path}.files"], topdir)
+    pmb.chroot.user(args, ["tar", "-xf", "/tmp/git.tar.gz"],
+                    working_dir=ci_dir)
+
+
+def copy_git_repo_to_chroot(args, topdir):
+    """ Copy the git repo (including unstaged changes and new files) to
+        /home/pmos/ci in chroot_native.
+
+        The first time, all files get copied with a tarball to
+        /home/pmos/ci_cache. After that, only the files that changed since
+        the last sync get copied there (according to the diff against the
+        commit of the last sync, and the files that had uncommitted changes
+        back then), and deleted files get removed. The scripts run in a copy
+        of ci_cache, so files that the scripts create or modify are not left
+        behind for the next run.
+
+        :param topdir: top directory of the git repository, get it with:
+          pmb.helpers.git.get_topdir()
+    """
+    pmb.chroot.init(args)
+    ci_cache = "/home/pmos/ci_cache"
+    state_path = get_sync_state_path(args, topdir)
+
+    changes = None
+    if os.path.exists(state_path) and \
+            os.path.exists(f"{args.work}/chroot_native{ci_cache}"):
+        with open(state_path) as handle:
+            changes = get_sync_changes(args, topdir, json.load(handle))
+
+    state = {"commit": pmb.helpers.git.rev_parse(args, topdir)}
+    state["dirty"] = pmb.helpers.git.get_changed_files(args, topdir,
+                                                       state["commit"])
+
+    if changes is None:
+        logging.info("Copying the git repository to the chroot")
+        pmb.chroot.user(args, ["rm", "-rf", ci_cache])
+        pmb.chroot.user(args, ["mkdir", ci_cache])
+        copy_files_to_chroot(args, topdir,
+                             pmb.helpers.git.get_files(args, topdir),
+                             ci_cache)
+    else:
+        copy, delete = changes
+        logging.info(f"Syncing the git repository to the chroot ({len(copy)}"
+                     f" changed, {len(delete)} deleted files)")
+        if copy:
+            copy_files_to_chroot(args, topdir, copy, ci_cache)
+        if delete:
+            delete_path = f"{args.work}/chroot_native/tmp/git_deleted"
+            with open(delete_path, "w") as handle:
+                handle.write("\0".join(delete))
+            pmb.chroot.user(args, ["sh", "-c",
+                                   "xargs -0 rm -f -- < /tmp/git_deleted"],
+                            working_dir=ci_cache)
+
+    os.makedirs(os.path.dirname(state_path), exist_ok=True)
+    with open(state_path, "w") as handle:
+        json.dump(state, handle)
 
     ci_dir = "/home/pmos/ci"
     pmb.chroot.user(args, ["rm", "-rf", ci_dir])
-    pmb.chroot.user(args, ["mkdir", ci_dir])
-    pmb.chroot.user(args, ["tar", "-xf", "/tmp/git.tar.gz"],
-                    working_dir=ci_dir)
+    pmb.chroot.user(args, ["cp", "-a", ci_cache, ci_dir])
 
 
 def run_scripts(args, topdir, scripts):
@@ -182,3 +272,89 @@ def run_scripts(args, topdir, scripts):
         if rc:
             logging.error(f"ERROR: CI script failed: {script_name}")
             exit(1)
+
+
+def run_script_captured(args, topdir, script_name, script, working_dir):
+    """ Run one CI script and capture its output (stdout and stderr), so
+        multiple scripts can run at the same time.
+
+        :param topdir: top directory of the git repository, get it with:
+          pmb.helpers.git.get_topdir()
+        :param script: from get_ci_scripts()
+        :param working_dir: copy of the git repository in chroot_native, for
+          scripts that don't have the "native" option
+
+        :returns: (return code, output, duration in seconds)
+    """
+    begin = time.monotonic()
+    cmd = ["sh", "-c", f"exec .ci/{shlex.quote(script_name)}.sh 2>&1"]
+    if "native" in script["options"]:
+        process = pmb.helpers.run.user(args, cmd, topdir, output="pipe")
+    else:
+        # The chroot was already initialized by copy_git_repo_to_chroot()
+        process = pmb.chroot.root(args, cmd, working_dir=working_dir,
+                                  env={"TESTUSER": "pmos"}, output="pipe",
+                                  auto_init=False)
+    output = process.stdout.read().decode("utf-8", errors="replace")
+    rc = process.wait()
+    return (rc, output, time.monotonic() - begin)
+
+
+def run_scripts_parallel(args, topdir, scripts, jobs):
+    """ Run the given scripts at the same time, with up to jobs scripts
+        running at once. Each script that runs in the chroot gets its own
+        copy of the git repository. The output of each script gets written
+        to the log in a separate section when it is done (and to stdout if it
+        failed), followed by a summary with the duration of each script.
+
+        :param topdir: top directory of the git repository, get it with:
+          pmb.helpers.git.get_topdir()
+        :param scripts: return of get_ci_scripts()
+        :param jobs: maximum amount of scripts running at the same time
+    """
+    working_dirs = {}
+    for script_name, script in scripts.items():
+        if "native" in script["options"]:
+            continue
+        if not working_dirs:
+            copy_git_repo_to_chroot(args, topdir)
+        working_dirs[script_name] = f"/home/pmos/ci_{script_name}"
+        pmb.chroot.user(args, ["rm", "-rf", working_dirs[script_name]])
+        pmb.chroot.user(args, ["cp", "-a", "/home/pmos/ci",
+                               working_dirs[script_name]])
+
+    logging.info(f"*** RUNNING {len(scripts)} CI SCRIPTS ({jobs} at once)"
+                 " ***")
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        futures = {executor.submit(run_script_captured, args, topdir,
+                                   script_name, script,
+                                   working_dirs.get(script_name)):
+                   script_name for script_name, script in scripts.items()}
+        for future in concurrent.futures.as_completed(futures):
+            script_name = futures[future]
+            rc, output, duration = future.result()
+            results[script_name] = (rc, duration)
+            result = "failed" if rc else "passed"
+            logging.info(f"*** CI SCRIPT {result.upper()}:"
+                         f" .ci/{script_name}.sh ({duration:.1f}s) ***")
+            section = (f"--- output of .ci/{script_name}.sh ---\n{output}"
+                       f"--- end of .ci/{script_name}.sh (rc={rc}) ---")
+            if rc:
+                logging.info(section)
+            else:
+                logging.debug(section)
+
+    logging.info("*** CI SUMMARY ***")
+    width = max(len(script_name) for script_name in scripts)
+    for script_name, script in scripts.items():
+        rc, duration = results[script_name]
+        where = "native" if "native" in script["options"] else "chroot"
+        result = "FAILED" if rc else "ok"
+        logging.info(f"{script_name:<{width}}  {where:<6}  {result:<6}"
+                     f"  {duration:7.1f}s")
+
+    failed = [script_name for script_name, (rc, _) in results.items() if rc]
+    if failed:
+        logging.error(f"ERROR: CI scripts failed: {', '.join(failed)}")
+        exit(1)
@@ -1,6 +1,5 @@
 # Copyright 2023 Oliver Smith
 # SPDX-License-Identifier: GPL-3.0-or-later
-import multiprocessing
 import os
 import pmb.parse.arch
 import sys
@@ -118,7 +117,7 @@ defaults = {
     "extra_space": "0",
     "hostname": "",
     "is_default_channel": True,
-    "jobs": str(multiprocessing.cpu_count() + 1),
+    "jobs": str((os.cpu_count() or 1) + 1),
     "kernel": "stable",
     "keymap": "",
     "locale": "en_US.UTF-8",
@@ -1,6 +1,7 @@
 # Copyright 2023 Oliver Smith
 # SPDX-License-Identifier: GPL-3.0-or-later
 import configparser
+import importlib
 import logging
 import os
 import sys
@@ -205,6 +206,7 @@ def switch_to_channel_branch(args, channel_new):
                  f" '{channel_new}'...")
 
     # Make sure we don't have mounts related to the old channel
+    importlib.import_module("pmb.chroot")
     pmb.chroot.shutdown(args)
 
     # Attempt to switch branch (git gives a nice error message, mentioning
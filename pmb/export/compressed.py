@@ -0,0 +1,146 @@
+# Copyright 2023 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+import glob
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+
+import pmb.install.sparse
+
+# Multithreaded compression with the programs from the host system
+compressors = {"zstd": (["zstd", "-T0", "-q", "-c"], "zst"),
+               "xz": (["xz", "-T0", "-c"], "xz")}
+
+bmap_block_size = 4096
+bmap_template = """<?xml version="1.0" ?>
+<!-- Block map of {image_name}, see bmaptool(1) -->
+<bmap version="2.0">
+    <ImageSize> {image_size} </ImageSize>
+    <BlockSize> {block_size} </BlockSize>
+    <BlocksCount> {blocks_count} </BlocksCount>
+    <MappedBlocksCount> {mapped_blocks_count} </MappedBlocksCount>
+    <ChecksumType> sha256 </ChecksumType>
+    <BmapFileChecksum> {bmap_checksum} </BmapFileChecksum>
+    <BlockMap>
+{ranges}
+    </BlockMap>
+</bmap>
+"""
+
+
+def bmap(image_name, image_size, ranges):
+    """Generate a block map in the format of bmaptool, so flashers can skip
+    the blocks of the image that are not used.
+
+    :param image_name: file name of the image, for the comment in the file
+    :param image_size: size of the image in bytes
+    :param ranges: list of (first_block, last_block, sha256) of the mapped
+                   ranges
+    :returns: content of the bmap file
+    """
+    lines = []
+    mapped = 0
+    for first, last, checksum in ranges:
+        blocks = str(first) if first == last else f"{first}-{last}"
+        lines.append(f'        <Range chksum="{checksum}"> {blocks} </Range>')
+        mapped += last - first + 1
+
+    # The checksum of the file gets calculated with zeros in its place
+    values = {"image_name": image_name,
+              "image_size": image_size,
+              "block_size": bmap_block_size,
+              "blocks_count": -(-image_size // bmap_block_size),
+              "mapped_blocks_count": mapped,
+              "bmap_checksum": "0" * 64,
+              "ranges": "\n".join(lines)}
+    ret = bmap_template.format(**values)
+    values["bmap_checksum"] = hashlib.sha256(ret.encode()).hexdigest()
+    return bmap_template.format(**values)
+
+
+def write_zeros(handle, length):
+    zeros = b"\0" * pmb.install.sparse.read_size
+    while length > 0:
+        handle.write(zeros[:length])
+        length -= len(zeros)
+
+
+def compress(path, target, method):
+    """Compress an image and create its block map in the same pass. Holes in
+    the image are not read, zeros get passed to the compressor instead.
+
+    :param path: raw image file
+    :param target: path of the compressed file to create (the block map gets
+                   written to the same path, with .bmap instead of the
+                   compression extension)
+    :param method: key of pmb.export.compressed.compressors
+    """
+    command = compressors[method][0]
+    if not shutil.which(command[0]):
+        raise RuntimeError(f"Compressing with {method} requires the"
+                           f" '{command[0]}' program. Please install it on"
+                           " your host system.")
+
+    ranges = []
+    with open(path, "rb") as handle, open(target, "wb") as handle_target:
+        size = os.fstat(handle.fileno()).st_size
+        logging.debug(f"% {' '.join(command)} < {path} > {target}")
+        process = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                   stdout=handle_target)
+        try:
+            pos = 0
+            for start, end in pmb.install.sparse.data_ranges(handle.fileno(),
+                                                             size):
+                write_zeros(process.stdin, start - pos)
+                handle.seek(start)
+                digest = hashlib.sha256()
+                pos = start
+                while pos < end:
+                    data = handle.read(min(pmb.install.sparse.read_size,
+                                           end - pos))
+                    if not data:
+                        raise RuntimeError(f"Unexpected end of file: {path}")
+                    digest.update(data)
+                    process.stdin.write(data)
+                    pos += len(data)
+                ranges.append((start // bmap_block_size,
+                               (end - 1) // bmap_block_size,
+                               digest.hexdigest()))
+            write_zeros(process.stdin, size - pos)
+        finally:
+            process.stdin.close()
+            ret = process.wait()
+    if ret:
+        raise RuntimeError(f"Failed to compress {path} with {method}")
+
+    path_bmap = os.path.splitext(target)[0] + ".bmap"
+    with open(path_bmap, "w") as handle:
+        handle.write(bmap(os.path.basename(path), size, ranges))
+
+
+def compressed(args, folder):
+    """Export compressed rootfs images with block maps (pmbootstrap export
+    --compress), instead of only symlinking the raw images.
+
+    :param folder: export folder
+    """
+    method = args.compress
+    extension = compressors[method][1]
+    pattern = f"{args.work}/chroot_native/home/pmos/rootfs/{args.device}*.img"
+    for path in sorted(glob.glob(pattern)):
+        with open(path, "rb") as handle:
+            magic = handle.read(4)
+        if magic == pmb.install.sparse.header_magic.to_bytes(4, "little"):
+            logging.info(f"NOTE: {os.path.basename(path)} is an Android"
+                         " sparse image, not compressing it")
+            continue
+
+        name = f"{os.path.basename(path)}.{extension}"
+        logging.info(f" * {name} ({method} compressed, block map:"
+                     f" {os.path.basename(path)}.bmap)")
+        target = f"{folder}/{name}"
+        if os.path.islink(target):
+            os.unlink(target)
+        compress(path, target, method)
@@ -31,3 +31,6 @@ def frontend(args):
     if args.odin_flashable_tar:
         pmb.export.odin(args, flavor, target)
     pmb.export.symlinks(args, flavor, target)
+    if args.compress:
+        logging.info(f"Export {args.compress} compressed images to: {target}")
+        pmb.export.compressed(args, target)
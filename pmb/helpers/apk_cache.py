@@ -0,0 +1,104 @@
+# Copyright 2023 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""Deduplicate packages between the apk caches of all architectures.
+
+Each chroot gets the apk cache of its architecture mounted as /var/cache/apk
+(cache_apk_$ARCH, see pmb.config.chroot_mount_bind). Packages that are not
+architecture specific (firmware, fonts, data...) get downloaded into each of
+these caches. The identical files get replaced with hardlinks to one copy, so
+the per-arch caches stay separate views on a shared set of files.
+"""
+import glob
+import hashlib
+import logging
+import os
+
+import pmb.helpers.run
+
+
+def _files_by_name(args):
+    """Find cached packages with the same file name in multiple apk caches.
+
+    :returns: dict of file name to list of paths, e.g.
+              ``{"linux-firmware-qcom-20231111-r1.d2f3a6b1.apk":
+              ["/home/user/.local/var/pmbootstrap/cache_apk_aarch64/...",
+              "/home/user/.local/var/pmbootstrap/cache_apk_armv7/..."]}``
+    """
+    ret = {}
+    for path in glob.glob(f"{args.work}/cache_apk_*/*.apk"):
+        ret.setdefault(os.path.basename(path), []).append(path)
+    return {name: paths for name, paths in ret.items() if len(paths) > 1}
+
+
+def _checksum(path):
+    """:returns: sha256 hexdigest of the file's content"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as handle:
+        for block in iter(lambda: handle.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def dedup(args, dry=False):
+    """Replace identical packages in the apk caches with hardlinks.
+
+    Only files with the same name are compared, and they get verified by
+    checksum before linking them, since packages of different architectures
+    may have the same file name.
+
+    :param dry: only calculate the space that would be saved
+    :returns: amount of bytes saved by the newly created hardlinks
+    """
+    saved = 0
+    # Folder to list of files to link into it (with the same file name)
+    links = {}
+    for name, paths in sorted(_files_by_name(args).items()):
+        # Group by content, files that are hardlinked already only get hashed
+        # once
+        inodes = {}
+        for path in paths:
+            stat = os.stat(path)
+            inodes.setdefault((stat.st_dev, stat.st_ino), (path, stat.st_size))
+        if len(inodes) < 2:
+            continue
+
+        targets = {}
+        for path, size in inodes.values():
+            key = (size, _checksum(path))
+            if key not in targets:
+                targets[key] = path
+                continue
+
+            logging.verbose(f"apk cache: link {path} -> {targets[key]}")
+            saved += size
+            links.setdefault(os.path.dirname(path), []).append(targets[key])
+
+    # Create the hardlinks with one "ln" call per folder
+    chunk = 500
+    for folder, targets in sorted(links.items()):
+        for i in range(0, len(targets), chunk):
+            if not dry:
+                pmb.helpers.run.root(args, ["ln", "-f"] +
+                                     targets[i:i + chunk] + [folder])
+
+    if saved:
+        logging.debug(f"apk cache: deduplicated {saved} bytes")
+    return saved
+
+
+def saved(args):
+    """Calculate how much space the hardlinks between the apk caches save.
+
+    :returns: amount of bytes that would be used additionally without the
+              hardlinks
+    """
+    ret = 0
+    inodes = set()
+    for path in glob.glob(f"{args.work}/cache_apk_*/*.apk"):
+        stat = os.stat(path)
+        key = (stat.st_dev, stat.st_ino)
+        if key in inodes:
+            ret += stat.st_size
+        else:
+            inodes.add(key)
+    return ret
@@ -1,5 +1,6 @@
 # Copyright 2023 Luca Weiss
 # SPDX-License-Identifier: GPL-3.0-or-later
+import concurrent.futures
 import datetime
 import fnmatch
 import logging
@@ -25,6 +26,13 @@ GITLAB_HOSTS = [
     "https://source.puri.sm",
 ]
 
+# Upstream versions are looked up in parallel with "aportupgrade --all", the
+# requests per host are limited in pmb.helpers.http.retrieve()
+LOOKUP_JOBS = 16
+
+# Seconds for which API responses get cached (in $WORK/cache_http)
+CACHE_TTL = 15 * 60
+
 
 def init_req_headers() -> None:
     global req_headers
@@ -46,7 +54,7 @@ def init_req_headers() -> None:
                      " to increase your rate limit")
 
 
-def get_package_version_info_github(repo_name: str, ref: Optional[str]):
+def get_package_version_info_github(args, repo_name: str, ref: Optional[str]):
     logging.debug("Trying GitHub repository: {}".format(repo_name))
 
     # Get the URL argument to request a special ref, if needed
@@ -55,9 +63,9 @@ def get_package_version_info_github(repo_name: str, ref: Optional[str]):
         ref_arg = f"?sha={ref}"
 
     # Get the commits for the repository
-    commits = pmb.helpers.http.retrieve_json(
-        f"{GITHUB_API_BASE}/repos/{repo_name}/commits{ref_arg}",
-        headers=req_headers_github)
+    commits = pmb.helpers.http.retrieve_json_cached(
+        args, f"{GITHUB_API_BASE}/repos/{repo_name}/commits{ref_arg}",
+        headers=req_headers_github, ttl=CACHE_TTL)
     latest_commit = commits[0]
     commit_date = latest_commit["commit"]["committer"]["date"]
     # Extract the time from the field
@@ -68,7 +76,7 @@ def get_package_version_info_github(repo_name: str, ref: Optional[str]):
     }
 
 
-def get_package_version_info_gitlab(gitlab_host: str, repo_name: str,
+def get_package_version_info_gitlab(args, gitlab_host: str, repo_name: str,
                                     ref: Optional[str]):
     logging.debug("Trying GitLab repository: {}".format(repo_name))
 
@@ -80,10 +88,10 @@ def get_package_version_info_gitlab(gitlab_host: str, repo_name: str,
         ref_arg = f"?ref_name={ref}"
 
     # Get the commits for the repository
-    commits = pmb.helpers.http.retrieve_json(
-        f"{gitlab_host}/api/v4/projects/{repo_name_safe}/repository"
+    commits = pmb.helpers.http.retrieve_json_cached(
+        args, f"{gitlab_host}/api/v4/projects/{repo_name_safe}/repository"
         f"/commits{ref_arg}",
-        headers=req_headers)
+        headers=req_headers, ttl=CACHE_TTL)
     latest_commit = commits[0]
     commit_date = latest_commit["committed_date"]
     # Extract the time from the field
@@ -95,11 +103,13 @@ def get_package_version_info_gitlab(gitlab_host: str, repo_name: str,
     }
 
 
-def upgrade_git_package(args, pkgname: str, package) -> None:
-    """Update _commit/pkgver/pkgrel in a git-APKBUILD (or pretend to do it if args.dry is set).
+def get_git_package_changes(args, pkgname: str, package):
+    """Look up the latest upstream commit of a git-APKBUILD.
 
     :param pkgname: the package name
     :param package: a dict containing package information
+    :returns: dict of the new _commit/pkgver/pkgrel values, or None if the
+              package is up-to-date or can't be upgraded
     """
     # Get the wanted source line
     source = package["source"][0]
@@ -118,25 +128,23 @@ def upgrade_git_package(args, pkgname: str, package) -> None:
         fr"({'|'.join(GITLAB_HOSTS)})/(.+)/-/archive/", source)
     if github_match:
         verinfo = get_package_version_info_github(
-            github_match.group(1), args.ref)
+            args, github_match.group(1), args.ref)
     elif gitlab_match:
         verinfo = get_package_version_info_gitlab(
-            gitlab_match.group(1), gitlab_match.group(2), args.ref)
+            args, gitlab_match.group(1), gitlab_match.group(2), args.ref)
 
     if verinfo is None:
         # ignore for now
         logging.warning("{}: source not handled: {}".format(pkgname, source))
-        return
+        return None
 
     # Get the new commit sha
     sha = package["_commit"]
     sha_new = verinfo["sha"]
 
     # Format the new pkgver, keep the value before _git the same
-    if package["pkgver"] == "9999":
-        pkgver = package["_pkgver"]
-    else:
-        pkgver = package["pkgver"]
+    pkgver_key = "_pkgver" if package["pkgver"] == "9999" else "pkgver"
+    pkgver = package[pkgver_key]
 
     pkgver_match = re.match(r"([\d.]+)_git", pkgver)
     if pkgver_match is None:
@@ -146,66 +154,52 @@ def upgrade_git_package(args, pkgname: str, package) -> None:
     date_pkgver = verinfo["date"].strftime("%Y%m%d")
     pkgver_new = f"{pkgver_match.group(1)}_git{date_pkgver}"
 
-    # pkgrel will be zero
-    pkgrel = int(package["pkgrel"])
-    pkgrel_new = 0
-
     if sha == sha_new:
         logging.info("{}: up-to-date".format(pkgname))
-        return
+        return None
 
-    logging.info("{}: upgrading pmaport".format(pkgname))
-    if args.dry:
-        logging.info(f"  Would change _commit from {sha} to {sha_new}")
-        logging.info(f"  Would change pkgver from {pkgver} to {pkgver_new}")
-        logging.info(f"  Would change pkgrel from {pkgrel} to {pkgrel_new}")
-        return
-
-    if package["pkgver"] == "9999":
-        pmb.helpers.file.replace_apkbuild(args, pkgname, "_pkgver", pkgver_new)
-    else:
-        pmb.helpers.file.replace_apkbuild(args, pkgname, "pkgver", pkgver_new)
-    pmb.helpers.file.replace_apkbuild(args, pkgname, "pkgrel", pkgrel_new)
-    pmb.helpers.file.replace_apkbuild(args, pkgname, "_commit", sha_new, True)
-    return
+    # pkgrel will be zero
+    return {"_commit": sha_new, pkgver_key: pkgver_new, "pkgrel": 0}
 
 
-def upgrade_stable_package(args, pkgname: str, package) -> None:
+def get_stable_package_changes(args, pkgname: str, package):
     """
-    Update _commit/pkgver/pkgrel in an APKBUILD (or pretend to do it if
-    args.dry is set).
+    Look up the latest upstream version of a package in Anitya.
 
     :param pkgname: the package name
     :param package: a dict containing package information
+    :returns: dict of the new pkgver/pkgrel values, or None if the package is
+              up-to-date or can't be upgraded
     """
 
     # Looking up if there's a custom mapping from postmarketOS package name
     # to Anitya project name.
-    mappings = pmb.helpers.http.retrieve_json(
-        f"{ANITYA_API_BASE}/packages/?distribution=postmarketOS"
-        f"&name={pkgname}", headers=req_headers)
+    mappings = pmb.helpers.http.retrieve_json_cached(
+        args, f"{ANITYA_API_BASE}/packages/?distribution=postmarketOS"
+        f"&name={pkgname}", headers=req_headers, ttl=CACHE_TTL)
     if mappings["total_items"] < 1:
-        projects = pmb.helpers.http.retrieve_json(
-            f"{ANITYA_API_BASE}/projects/?name={pkgname}", headers=req_headers)
+        projects = pmb.helpers.http.retrieve_json_cached(
+            args, f"{ANITYA_API_BASE}/projects/?name={pkgname}",
+            headers=req_headers, ttl=CACHE_TTL)
         if projects["total_items"] < 1:
             logging.warning(f"{pkgname}: failed to get Anitya project")
-            return
+            return None
     else:
         project_name = mappings["items"][0]["project"]
         ecosystem = mappings["items"][0]["ecosystem"]
-        projects = pmb.helpers.http.retrieve_json(
-            f"{ANITYA_API_BASE}/projects/?name={project_name}&"
+        projects = pmb.helpers.http.retrieve_json_cached(
+            args, f"{ANITYA_API_BASE}/projects/?name={project_name}&"
             f"ecosystem={ecosystem}",
-            headers=req_headers)
+            headers=req_headers, ttl=CACHE_TTL)
 
     if projects["total_items"] < 1:
         logging.warning(f"{pkgname}: didn't find any projects, can't upgrade!")
-        return
+        return None
     if projects["total_items"] > 1:
         logging.warning(f"{pkgname}: found more than one project, can't "
                         f"upgrade! Please create an explicit mapping of "
                         f"\"project\" to the package name.")
-        return
+        return None
 
     # Get the first, best-matching item
     project = projects["items"][0]
@@ -213,43 +207,94 @@ def upgrade_stable_package(args, pkgname: str, package) -> None:
     # Check that we got a version number
     if len(project["stable_versions"]) < 1:
         logging.warning("{}: got no version number, ignoring".format(pkgname))
-        return
+        return None
 
     version = project["stable_versions"][0]
 
     # Compare the pmaports version with the project version
     if package["pkgver"] == version:
         logging.info("{}: up-to-date".format(pkgname))
-        return
-
-    if package["pkgver"] == "9999":
-        pkgver = package["_pkgver"]
-    else:
-        pkgver = package["pkgver"]
+        return None
 
+    pkgver_key = "_pkgver" if package["pkgver"] == "9999" else "pkgver"
     pkgver_new = version
 
-    pkgrel = package["pkgrel"]
-    pkgrel_new = 0
-
     if not pmb.parse.version.validate(pkgver_new):
         logging.warning(f"{pkgname}: would upgrade to invalid pkgver:"
                         f" {pkgver_new}, ignoring")
+        return None
+
+    return {pkgver_key: pkgver_new, "pkgrel": 0}
+
+
+def get_changes(args, pkgname, git=True, stable=True):
+    """Find the new version of a single package.
+
+    :param pkgname: the name of the package
+    :param git: True if git packages should be upgraded
+    :param stable: True if stable packages should be upgraded
+    :returns: (package, changes) with the package from pmaports and the dict
+              of APKBUILD values to change (or None)
+    """
+    package = pmb.helpers.pmaports.get(args, pkgname)
+    # Run the correct function
+    if "_git" in package["pkgver"]:
+        if git:
+            return (package, get_git_package_changes(args, pkgname, package))
+    else:
+        if stable:
+            return (package, get_stable_package_changes(args, pkgname,
+                                                        package))
+    return (package, None)
+
+
+def apply_changes(args, pkgname, package, changes, batch=None) -> None:
+    """Write the new values to the APKBUILD (or pretend to do it if args.dry
+    is set).
+
+    :param pkgname: the package name
+    :param package: a dict containing package information
+    :param changes: from get_changes()
+    :param batch: optional dict, the changes get added to it instead of
+                  writing them, for pmb.helpers.file.replace_apkbuilds()
+    """
+    if not changes:
         return
 
     logging.info("{}: upgrading pmaport".format(pkgname))
     if args.dry:
-        logging.info(f"  Would change pkgver from {pkgver} to {pkgver_new}")
-        logging.info(f"  Would change pkgrel from {pkgrel} to {pkgrel_new}")
+        for key, value in changes.items():
+            logging.info(f"  Would change {key} from {package[key]} to"
+                         f" {value}")
         return
 
-    if package["pkgver"] == "9999":
-        pmb.helpers.file.replace_apkbuild(args, pkgname, "_pkgver", pkgver_new)
-    else:
-        pmb.helpers.file.replace_apkbuild(args, pkgname, "pkgver", pkgver_new)
+    if batch is not None:
+        batch[pkgname] = changes
+        return
+    pmb.helpers.file.replace_apkbuild_values(args, pkgname, changes,
+                                             ["_commit"])
+
+
+def upgrade_git_package(args, pkgname: str, package) -> None:
+    """Update _commit/pkgver/pkgrel in a git-APKBUILD (or pretend to do it if args.dry is set).
+
+    :param pkgname: the package name
+    :param package: a dict containing package information
+    """
+    changes = get_git_package_changes(args, pkgname, package)
+    apply_changes(args, pkgname, package, changes)
+
+
+def upgrade_stable_package(args, pkgname: str, package) -> None:
+    """
+    Update _commit/pkgver/pkgrel in an APKBUILD (or pretend to do it if
+    args.dry is set).
 
-    pmb.helpers.file.replace_apkbuild(args, pkgname, "pkgrel", pkgrel_new)
-    return
+    :param pkgname: the package name
+    :param package: a dict containing package information
+    """
+    changes = get_stable_package_changes(args, pkgname, package)
+    apply_changes(args, pkgname, package, changes)
 
 
 def upgrade(args, pkgname, git=True, stable=True) -> None:
@@ -262,18 +307,20 @@ def upgrade(args, pkgname, git=True, stable=True) -> None:
     # Initialize request headers
     init_req_headers()
 
-    package = pmb.helpers.pmaports.get(args, pkgname)
-    # Run the correct function
-    if "_git" in package["pkgver"]:
-        if git:
-            upgrade_git_package(args, pkgname, package)
-    else:
-        if stable:
-            upgrade_stable_package(args, pkgname, package)
+    package, changes = get_changes(args, pkgname, git, stable)
+    apply_changes(args, pkgname, package, changes)
 
 
 def upgrade_all(args) -> None:
-    """Upgrade all packages, based on args.all, args.all_git and args.all_stable."""
+    """Upgrade all packages, based on args.all, args.all_git and args.all_stable.
+
+    The upstream versions get looked up in parallel first, then all APKBUILDs
+    get modified as one batch with pmb.helpers.file.replace_apkbuilds().
+    """
+    # Initialize request headers
+    init_req_headers()
+
+    pkgnames = []
     for pkgname in pmb.helpers.pmaports.get_list(args):
         # Always ignore postmarketOS-specific packages that have no upstream
         # source
@@ -283,6 +330,22 @@ def upgrade_all(args) -> None:
                 skip = True
         if skip:
             continue
-
-        upgrade(args, pkgname, args.all or args.all_git,
-                args.all or args.all_stable)
+        pkgnames.append(pkgname)
+
+    # Parse the APKBUILDs before starting the threads, so the APKBUILD cache
+    # doesn't get filled from multiple threads
+    for pkgname in pkgnames:
+        pmb.helpers.pmaports.get(args, pkgname)
+
+    git = args.all or args.all_git
+    stable = args.all or args.all_stable
+    with concurrent.futures.ThreadPoolExecutor(LOOKUP_JOBS) as executor:
+        futures = [executor.submit(get_changes, args, pkgname, git, stable)
+                   for pkgname in pkgnames]
+        results = [future.result() for future in futures]
+
+    batch = {}
+    for pkgname, (package, changes) in zip(pkgnames, results):
+        apply_changes(args, pkgname, package, changes, batch)
+    if batch:
+        pmb.helpers.file.replace_apkbuilds(args, batch, ["_commit"])
@@ -1,9 +1,9 @@
 # Copyright 2023 Oliver Smith
 # SPDX-License-Identifier: GPL-3.0-or-later
+import argparse
 import copy
 import os
 import pmb.config
-import pmb.helpers.git
 
 """This file constructs the args variable, which is passed to almost all
    functions in the pmbootstrap code base. Here's a listing of the kind of
@@ -38,11 +38,29 @@ import pmb.helpers.git
        location, so having a short name for them increases readability of the
        code as well.
 
+       They get parsed on first access (see Args below), so actions that
+       don't need them (e.g. "pmbootstrap log") don't pay for parsing them.
+
        Examples:
        args.deviceinfo (e.g. {"name": "Mydevice", "arch": "armhf", ...})
 """
 
 
+class Args(argparse.Namespace):
+    """Namespace returned by pmb.parse.arguments(), which parses the configs
+    listed above (3.) when they are accessed for the first time."""
+
+    @property
+    def deviceinfo(self):
+        if "deviceinfo" not in self.__dict__:
+            add_deviceinfo(self)
+        return self.__dict__["deviceinfo"]
+
+    @deviceinfo.setter
+    def deviceinfo(self, value):
+        self.__dict__["deviceinfo"] = value
+
+
 def fix_mirrors_postmarketos(args):
     """Fix args.mirrors_postmarketos when it is supposed to be empty or the default value.
 
@@ -97,13 +115,14 @@ def replace_placeholders(args):
 
 def add_deviceinfo(args):
     """Add and verify the deviceinfo (only after initialization)"""
-    setattr(args, "deviceinfo", pmb.parse.deviceinfo(args))
-    arch = args.deviceinfo["arch"]
+    deviceinfo = pmb.parse.deviceinfo(args)
+    arch = deviceinfo["arch"]
     if (arch != pmb.config.arch_native and
             arch not in pmb.config.build_device_architectures):
         raise ValueError("Arch '" + arch + "' is not available in"
                          " postmarketOS. If you would like to add it, see:"
                          " <https://postmarketos.org/newarch>")
+    setattr(args, "deviceinfo", deviceinfo)
 
 
 def init(args):
@@ -116,13 +135,10 @@ def init(args):
     # Initialize logs (we could raise errors below)
     pmb.helpers.logging.init(args)
 
-    # Initialization code which may raise errors
+    # Initialization code which may raise errors. The deviceinfo, pmaports.cfg
+    # and channels.cfg get parsed when they are used (see Args above and
+    # pmb.config.pmaports.read_config(), which also runs the version checks).
     check_pmaports_path(args)
-    if args.action not in ["init", "checksum", "config", "bootimg_analyze", "log",
-                           "pull", "shutdown", "zap"]:
-        pmb.config.pmaports.read_config(args)
-        add_deviceinfo(args)
-        pmb.helpers.git.parse_channels_cfg(args)
 
     return args
 
@@ -141,6 +157,8 @@ def update_work(args, work):
     args_new.work = work
     args_new = pmb.helpers.args.init(args_new)
 
-    # Overwrite old attributes of args with the new attributes
+    # Overwrite old attributes of args with the new attributes, parse the
+    # deviceinfo again if it is used
+    args.__dict__.pop("deviceinfo", None)
     for key in vars(args_new):
         setattr(args, key, getattr(args_new, key))
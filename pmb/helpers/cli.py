@@ -81,8 +81,8 @@ def ask(question="Continue?", choices=["y", "n"], default="n",
         if ret == "":
             ret = str(default)
 
-        pmb.helpers.logging.logfd.write(f"{line}: {ret}\n")
-        pmb.helpers.logging.logfd.flush()
+        pmb.helpers.logging.write(f"{line}: {ret}\n")
+        pmb.helpers.logging.flush()
 
         # Validate with regex
         if not validation_regex:
@@ -0,0 +1,152 @@
+# Copyright 2023 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""Calculate the disk usage of a folder, like "du -ks", without running it.
+
+The folders get scanned in multiple threads (os.scandir and lstat release the
+GIL, so this is mostly useful with a cold cache). Like du, the allocated
+blocks are counted (so sparse files only count with the space they actually
+use) and files with multiple hardlinks are only counted once.
+
+Folders that the current user is not allowed to read (e.g. /root in a chroot)
+are measured with "du -ks" as root instead.
+"""
+import concurrent.futures
+import logging
+import os
+
+import pmb.helpers.run
+
+jobs = 8
+
+
+def scan(path):
+    """Get the disk usage of the entries of one folder (not recursive).
+
+    :param path: folder to scan
+    :returns: (size, inodes, folders) with the size in bytes of all entries
+              that have only one hardlink, a list of (st_dev, st_ino, size)
+              for entries with multiple hardlinks, and a list of the paths of
+              all sub folders. Or None if the folder can't be read.
+    """
+    size = 0
+    inodes = []
+    folders = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    stat = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                blocks = stat.st_blocks * 512
+                if entry.is_dir(follow_symlinks=False):
+                    folders.append(entry.path)
+                    size += blocks
+                elif stat.st_nlink > 1:
+                    inodes.append((stat.st_dev, stat.st_ino, blocks))
+                else:
+                    size += blocks
+    except PermissionError:
+        return None
+    return (size, inodes, folders)
+
+
+def scan_cached(path, cache):
+    """Like scan(), but reuse the result if the folder's mtime didn't change.
+
+    The mtime of a folder changes when entries get added, removed or renamed.
+    Files that get modified in place are not detected, so use this only where
+    an approximate result is good enough.
+
+    :param cache: dict of path to (st_mtime_ns, result of scan())
+    """
+    try:
+        mtime = os.lstat(path).st_mtime_ns
+    except FileNotFoundError:
+        return (0, [], [])
+    cached = cache.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    ret = scan(path)
+    if ret is not None:
+        cache[path] = (mtime, ret)
+    return ret
+
+
+def size_du(args, path):
+    """:returns: size of a folder in bytes, calculated with "du -ks" as root
+    """
+    output = pmb.helpers.run.root(args, ["du", "-ks", path],
+                                  output_return=True)
+
+    # Only look at last line to filter out sudo garbage (#1766)
+    last_line = output.split("\n")[-2]
+    return int(last_line.split("\t")[0]) * 1024
+
+
+def scan_tree(path, cache=None):
+    """Get the disk usage of a folder and all its sub folders.
+
+    :param path: folder to scan
+    :param cache: see size()
+    :returns: (size, inodes, denied) like scan(), and a list of folders that
+              couldn't be read
+    """
+    ret = 0
+    inodes = []
+    denied = []
+    todo = [path]
+    while todo:
+        folder = todo.pop()
+        if cache is None:
+            result = scan(folder)
+        else:
+            result = scan_cached(folder, cache)
+        if result is None:
+            denied.append(folder)
+            continue
+        ret += result[0]
+        inodes += result[1]
+        todo += result[2]
+    return (ret, inodes, denied)
+
+
+def size(args, path, cache=None):
+    """Calculate the disk usage of a folder, including sub folders.
+
+    The sub folders of path (e.g. the chroots and caches in the work dir) get
+    scanned in parallel.
+
+    :param path: folder to measure
+    :param cache: optional dict, that can be passed to the next call to only
+                  scan the folders again that changed (see scan_cached())
+    :returns: size in bytes
+    """
+    ret = os.lstat(path).st_blocks * 512
+    inodes = set()
+    denied = []
+
+    result = scan(path) if cache is None else scan_cached(path, cache)
+    if result is None:
+        results = [(0, [], [path])]
+    else:
+        with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+            futures = [executor.submit(scan_tree, folder, cache)
+                       for folder in result[2]]
+            results = [result[:2] + ([],)]
+            results += [future.result() for future in futures]
+
+    for folder_size, folder_inodes, folder_denied in results:
+        ret += folder_size
+        denied += folder_denied
+        for dev, ino, blocks in folder_inodes:
+            if (dev, ino) not in inodes:
+                inodes.add((dev, ino))
+                ret += blocks
+
+    # The size of the folder entry itself was already counted when scanning
+    # its parent folder
+    for folder in denied:
+        logging.verbose(f"{folder}: permission denied, running du as root")
+        ret += size_du(args, folder) - os.lstat(folder).st_blocks * 512
+    return ret
@@ -2,9 +2,13 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 import os
+import shutil
 import time
 
+import pmb.helpers.other
+import pmb.helpers.pmaports
 import pmb.helpers.run
+import pmb.parse
 
 
 def replace(path, old, new):
@@ -18,6 +22,99 @@ def replace(path, old, new):
         handle.write(text)
 
 
+def write_atomic(path, text):
+    """Write a file by renaming a temporary file over it, so it never gets
+    read half-written. The file permissions are kept."""
+    path_temp = f"{path}.pmb-tmp"
+    with open(path_temp, "w", encoding="utf-8") as handle:
+        handle.write(text)
+    shutil.copymode(path, path_temp)
+    os.replace(path_temp, path)
+
+
+def edit_apkbuild(path, values, in_quotes=()):
+    """Replace multiple key=value lines of an APKBUILD in one pass over the
+    file, and verify all of them with one parse afterwards. When one of the
+    values can't be set, the APKBUILD is left unmodified.
+
+    :param path: full path to the APKBUILD
+    :param values: dict of keys to new values, e.g. {"pkgrel": 1}
+    :param in_quotes: keys whose values are in quotation marks ("")
+    :returns: the original content of the APKBUILD
+    """
+    apkbuild = pmb.parse.apkbuild(path)
+    with open(path, "r", encoding="utf-8") as handle:
+        text_old = handle.read()
+
+    text = text_old
+    lines = {}
+    for key, new in values.items():
+        quote = '"' if key in in_quotes else ""
+        line_old = f"{key}={quote}{apkbuild[key]}{quote}"
+        line_new = f"{key}={quote}{new}{quote}"
+        lines[key] = line_old
+        text = text.replace(f"\n{line_old}\n", f"\n{line_new}\n")
+
+    # Write once, then verify all values with one parse
+    write_atomic(path, text)
+    del pmb.helpers.other.cache["apkbuild"][path]
+    try:
+        apkbuild = pmb.parse.apkbuild(path)
+        failed = [key for key, new in values.items()
+                  if apkbuild[key] != str(new)]
+        if failed:
+            raise RuntimeError("Failed to set {} in: {}. Make sure that"
+                               " there's a line with exactly the string {}"
+                               " and nothing else.".format(
+                                   ", ".join(f"'{key}'" for key in failed),
+                                   path,
+                                   ", ".join(f"'{lines[key]}'"
+                                             for key in failed)))
+    except Exception:
+        write_atomic(path, text_old)
+        pmb.helpers.other.cache["apkbuild"].pop(path, None)
+        raise
+    return text_old
+
+
+def replace_apkbuild_values(args, pkgname, values, in_quotes=()):
+    """Replace multiple key=value lines in an APKBUILD and verify them
+    afterwards (see edit_apkbuild()).
+
+    :param pkgname: package name, e.g. "hello-world"
+    :param values: dict of keys to new values, e.g. {"pkgver": "1.2.3",
+                   "pkgrel": 0}
+    :param in_quotes: keys whose values are in quotation marks ("")
+    """
+    path = pmb.helpers.pmaports.find(args, pkgname) + "/APKBUILD"
+    edit_apkbuild(path, values, in_quotes)
+
+
+def replace_apkbuilds(args, changes, in_quotes=()):
+    """Replace key=value lines in many APKBUILDs. Either all APKBUILDs get
+    changed, or (if setting one value fails) none of them.
+
+    :param changes: dict of package names to the values that should be
+                    replaced, see replace_apkbuild_values()
+    :param in_quotes: keys whose values are in quotation marks ("")
+    """
+    # Find all APKBUILDs first, so nothing gets changed if one is missing
+    paths = {pkgname: pmb.helpers.pmaports.find(args, pkgname) + "/APKBUILD"
+             for pkgname in changes}
+
+    texts_old = {}
+    try:
+        for pkgname, values in changes.items():
+            texts_old[pkgname] = edit_apkbuild(paths[pkgname], values,
+                                               in_quotes)
+    except Exception:
+        # Roll back the APKBUILDs that were changed
+        for pkgname, text_old in texts_old.items():
+            write_atomic(paths[pkgname], text_old)
+            pmb.helpers.other.cache["apkbuild"].pop(paths[pkgname], None)
+        raise
+
+
 def replace_apkbuild(args, pkgname, key, new, in_quotes=False):
     """Replace one key=value line in an APKBUILD and verify it afterwards.
 
@@ -26,30 +123,8 @@ def replace_apkbuild(args, pkgname, key, new, in_quotes=False):
     :param new: new value
     :param in_quotes: expect the value to be in quotation marks ("")
     """
-    # Read old value
-    path = pmb.helpers.pmaports.find(args, pkgname) + "/APKBUILD"
-    apkbuild = pmb.parse.apkbuild(path)
-    old = apkbuild[key]
-
-    # Prepare old/new strings
-    if in_quotes:
-        line_old = '{}="{}"'.format(key, old)
-        line_new = '{}="{}"'.format(key, new)
-    else:
-        line_old = '{}={}'.format(key, old)
-        line_new = '{}={}'.format(key, new)
-
-    # Replace
-    replace(path, "\n" + line_old + "\n", "\n" + line_new + "\n")
-
-    # Verify
-    del (pmb.helpers.other.cache["apkbuild"][path])
-    apkbuild = pmb.parse.apkbuild(path)
-    if apkbuild[key] != str(new):
-        raise RuntimeError("Failed to set '{}' for pmaport '{}'. Make sure"
-                           " that there's a line with exactly the string '{}'"
-                           " and nothing else in: {}".format(key, pkgname,
-                                                             line_old, path))
+    replace_apkbuild_values(args, pkgname, {key: new},
+                            [key] if in_quotes else [])
 
 
 def is_up_to_date(path_sources, path_target=None, lastmod_target=None):
@@ -1,41 +1,69 @@
 # Copyright 2023 Oliver Smith
 # SPDX-License-Identifier: GPL-3.0-or-later
 import glob
+import importlib
 import json
 import logging
+import math
 import os
 import sys
 
-import pmb.aportgen
-import pmb.build
-import pmb.build.autodetect
-import pmb.chroot
-import pmb.chroot.initfs
-import pmb.chroot.other
-import pmb.ci
 import pmb.config
-import pmb.export
-import pmb.flasher
-import pmb.helpers.aportupgrade
-import pmb.helpers.devices
-import pmb.helpers.git
-import pmb.helpers.lint
 import pmb.helpers.logging
-import pmb.helpers.pkgrel_bump
-import pmb.helpers.pmaports
-import pmb.helpers.repo
-import pmb.helpers.repo_bootstrap
-import pmb.helpers.repo_missing
-import pmb.helpers.run
-import pmb.helpers.status
-import pmb.install
-import pmb.install.blockdevice
-import pmb.netboot
 import pmb.parse
-import pmb.qemu
-import pmb.sideload
 from argparse import Namespace
 
+# Subsystems that the actions use. They only get imported when the action
+# runs (see run()), so e.g. "pmbootstrap status" and the shell completion
+# don't load build, install, qemu etc.
+action_modules = {
+    "aportgen": ["pmb.aportgen"],
+    "aportupgrade": ["pmb.helpers.aportupgrade", "pmb.helpers.pmaports"],
+    "apkbuild_parse": ["pmb.helpers.pmaports"],
+    "apkindex_parse": ["pmb.parse.apkindex"],
+    "bootimg_analyze": ["pmb.aportgen.device", "pmb.parse.bootimg"],
+    "build": ["pmb.build", "pmb.build.autodetect", "pmb.build.envkernel",
+              "pmb.chroot", "pmb.helpers.repo_bootstrap"],
+    "build_init": ["pmb.build"],
+    "checksum": ["pmb.build.checksum"],
+    "chroot": ["pmb.chroot", "pmb.chroot.apk", "pmb.chroot.other",
+               "pmb.install.blockdevice"],
+    "ci": ["pmb.ci", "pmb.helpers.git"],
+    "deviceinfo_parse": ["pmb.helpers.devices"],
+    "export": ["pmb.export"],
+    "flasher": ["pmb.flasher"],
+    "index": ["pmb.build"],
+    "init": ["pmb.config.init"],
+    "initfs": ["pmb.chroot.initfs"],
+    "install": ["pmb.helpers.repo_bootstrap", "pmb.install",
+                "pmb.install.image"],
+    "kconfig": ["pmb.build", "pmb.helpers.pmaports", "pmb.parse.kconfig"],
+    "lint": ["pmb.helpers.lint", "pmb.helpers.pmaports"],
+    "log": ["pmb.helpers.run"],
+    "netboot": ["pmb.netboot"],
+    "newapkbuild": ["pmb.build"],
+    "pkgrel_bump": ["pmb.helpers.pkgrel_bump", "pmb.helpers.pmaports"],
+    "pull": ["pmb.helpers.git"],
+    "qemu": ["pmb.qemu"],
+    "rdepends": ["pmb.helpers.rdepends", "pmb.helpers.repo"],
+    "repo_bootstrap": ["pmb.helpers.repo_bootstrap"],
+    "repo_missing": ["pmb.helpers.repo_missing"],
+    "shutdown": ["pmb.chroot"],
+    "sideload": ["pmb.sideload"],
+    "stats": ["pmb.chroot", "pmb.chroot.apk", "pmb.helpers.apk_cache"],
+    "status": ["pmb.helpers.status"],
+    "update": ["pmb.helpers.repo"],
+    "zap": ["pmb.chroot"],
+}
+
+
+def run(args):
+    """Import the subsystems of args.action and run the function with the
+    action's name."""
+    for module in action_modules.get(args.action, []):
+        importlib.import_module(module)
+    return globals()[args.action](args)
+
 
 def _parse_flavor(args, autoinstall=True):
     """Verify the flavor argument if specified, or return a default value.
@@ -230,14 +258,26 @@ def repo_bootstrap(args):
 
 def repo_missing(args):
     missing = pmb.helpers.repo_missing.generate(args, args.arch, args.overview,
-                                                args.package, args.built)
+                                                args.package, args.built,
+                                                args.incremental)
     print(json.dumps(missing, indent=4))
 
 
+def rdepends(args):
+    pmb.helpers.repo.update(args, args.arch)
+    for pkgname in pmb.helpers.rdepends.get(args, args.package, args.arch,
+                                            args.recursive):
+        print(pkgname)
+
+
 def index(args):
     pmb.build.index_repo(args)
 
 
+def init(args):
+    return pmb.config.init.frontend(args)
+
+
 def initfs(args):
     pmb.chroot.initfs.frontend(args)
 
@@ -249,8 +289,9 @@ def install(args):
     if args.rsync and args.full_disk_encryption:
         raise ValueError("Installation using rsync is not compatible with full"
                          " disk encryption.")
-    if args.rsync and not args.disk:
-        raise ValueError("Installation using rsync only works with --disk.")
+    if args.rsync and (args.android_recovery_zip or args.no_image):
+        raise ValueError("Installation using rsync only works with --disk or"
+                         " image files.")
 
     if args.rsync and args.filesystem == "btrfs":
         raise ValueError("Installation using rsync"
@@ -292,6 +333,8 @@ def install(args):
                              " Do you mean --no-image?")
     if args.ondev_no_rootfs:
         _install_ondev_verify_no_rootfs(args)
+    if args.direct_image:
+        pmb.install.image.check_supported(args)
 
     # On-device installer overrides
     if args.on_device_installer:
@@ -394,6 +437,32 @@ def newapkbuild(args):
     pmb.build.newapkbuild(args, args.folder, pass_through, args.force)
 
 
+def kconfig_write_json(args, configs, results, skipped):
+    """ Write the result of "pmbootstrap kconfig check" as JSON, so it can
+        be compared between runs. """
+    summary = {"passed": all(result["passed"] for result in results),
+               "skipped": skipped,
+               "configs": {}}
+    for config, result in zip(configs, results):
+        path = os.path.relpath(config["config_path"], args.aports)
+        summary["configs"][path] = {
+            "arch": config["config_arch"],
+            "pkgver": config["pkgver"],
+            "components": config["components_list"],
+            "enforce_check": config["enforce_check"],
+            "passed": result["passed"],
+            "warnings": result["warnings"],
+        }
+
+    if args.json == "-":
+        print(json.dumps(summary, indent=4, sort_keys=True))
+        return
+    with open(args.json, "w") as handle:
+        json.dump(summary, handle, indent=4, sort_keys=True)
+        handle.write("\n")
+    logging.info(f"kconfig check: summary written to {args.json}")
+
+
 def kconfig(args):
     if args.action_kconfig == "check":
         details = args.kconfig_check_details
@@ -418,29 +487,40 @@ def kconfig(args):
                 if aport.startswith("linux-"):
                     packages.append(aport.split("linux-")[1])
 
-        # Iterate over all kernels
-        error = False
-        skipped = 0
+        # Find the configs of all kernels
+        configs = []
+        skipped = []
         packages.sort()
         for package in packages:
+            pkgname = package if package.startswith("linux-") \
+                else "linux-" + package
             if not args.force:
-                pkgname = package if package.startswith("linux-") \
-                    else "linux-" + package
                 aport = pmb.helpers.pmaports.find(args, pkgname)
                 apkbuild = pmb.parse.apkbuild(f"{aport}/APKBUILD")
                 if "!pmb:kconfigcheck" in apkbuild["options"]:
-                    skipped += 1
+                    skipped += [pkgname]
                     continue
-            if not pmb.parse.kconfig.check(args, package, components_list,
-                                           details=details):
-                error = True
+            configs += pmb.parse.kconfig.get_configs(args, package,
+                                                     components_list)
+
+        # Check them, skip the ones that did not change
+        cache_dir = None if args.no_cache else f"{args.work}/cache_kconfig"
+        results = pmb.parse.kconfig.check_configs(configs, details,
+                                                  cache_dir=cache_dir)
+        error = not all(result["passed"] for result in results)
+        cached = len([result for result in results if result["cached"]])
+        if cached:
+            logging.debug(f"kconfig check: {cached} of {len(results)}"
+                          " config(s) did not change since the last check")
+        if args.json:
+            kconfig_write_json(args, configs, results, skipped)
 
         # At least one failure
         if error:
             raise RuntimeError("kconfig check failed!")
         else:
             if skipped:
-                logging.info("NOTE: " + str(skipped) + " kernel(s) was skipped"
+                logging.info("NOTE: " + str(len(skipped)) + " kernel(s) was skipped"
                              " (consider 'pmbootstrap kconfig check -f')")
             logging.info("kconfig check succeeded!")
     elif args.action_kconfig in ["edit", "migrate"]:
@@ -536,6 +616,11 @@ def stats(args):
     if args.arch != pmb.config.arch_native:
         suffix = "buildroot_" + args.arch
 
+    # Space saved by sharing packages between the apk caches
+    saved_mb = pmb.helpers.apk_cache.saved(args) / 1024 / 1024
+    logging.info(f"apk caches: ~{math.ceil(saved_mb)} MB saved by packages"
+                 " shared between arches")
+
     # Install ccache and display stats
     pmb.chroot.apk.install(args, ["ccache"], suffix)
     logging.info("(" + suffix + ") % ccache -s")
@@ -574,7 +659,8 @@ def zap(args):
                    distfiles=args.distfiles, pkgs_local=args.pkgs_local,
                    pkgs_local_mismatch=args.pkgs_local_mismatch,
                    pkgs_online_mismatch=args.pkgs_online_mismatch,
-                   rust=args.rust, netboot=args.netboot)
+                   rust=args.rust, netboot=args.netboot,
+                   background=args.background, dedup=args.dedup)
 
     # Don't write the "Done" message
     pmb.helpers.logging.disable()
@@ -671,4 +757,8 @@ def ci(args):
     if not scripts_selected:
         scripts_selected = pmb.ci.ask_which_scripts_to_run(scripts_available)
 
-    pmb.ci.run_scripts(args, topdir, scripts_selected)
+    if args.parallel and len(scripts_selected) > 1:
+        pmb.ci.run_scripts_parallel(args, topdir, scripts_selected,
+                                    args.parallel)
+    else:
+        pmb.ci.run_scripts(args, topdir, scripts_selected)
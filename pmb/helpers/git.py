@@ -1,11 +1,10 @@
 # Copyright 2023 Oliver Smith
 # SPDX-License-Identifier: GPL-3.0-or-later
 import configparser
+import json
 import logging
 import os
 
-import pmb.build
-import pmb.chroot.apk
 import pmb.config
 import pmb.helpers.pmaports
 import pmb.helpers.run
@@ -85,6 +84,63 @@ def clean_worktree(args, path):
     return pmb.helpers.run.user(args, command, path, output_return=True) == ""
 
 
+def read_remotes(path):
+    """Read the remotes of a git repository from .git/config, without running
+    git.
+
+    :param path: to the git repository
+    :returns: dict of remote name to list of (push) URLs, e.g.
+              {"origin": ["https://gitlab.com/postmarketOS/pmaports.git"]},
+              or None if .git/config could not be read
+    """
+    cfg = configparser.ConfigParser(strict=False, interpolation=None)
+    try:
+        cfg.read(f"{path}/.git/config")
+    except configparser.Error:
+        return None
+    if not cfg.sections():
+        return None
+
+    ret = {}
+    for section in cfg.sections():
+        if not section.startswith("remote \"") or not section.endswith("\""):
+            continue
+        remote = section[len("remote \""):-1]
+        ret[remote] = [cfg[section][key] for key in ["url", "pushurl"]
+                       if key in cfg[section]]
+    return ret
+
+
+def read_ref(path, ref):
+    """Get the commit of a ref from the loose refs or packed-refs, without
+    running git.
+
+    :param path: to the git repository
+    :param ref: full name of the ref, e.g. "refs/remotes/origin/master"
+    :returns: commit string like "90cd0ad84d390897efdcf881c0315747a4f3a966",
+              or None if the ref was not found
+    """
+    try:
+        with open(f"{path}/.git/{ref}") as handle:
+            commit = handle.read().strip()
+        # Symbolic ref ("ref: refs/...")
+        return None if commit.startswith("ref:") else commit
+    except OSError:
+        pass
+
+    try:
+        with open(f"{path}/.git/packed-refs") as handle:
+            for line in handle:
+                if line.startswith(("#", "^")):
+                    continue
+                commit, name = line.rstrip("\n").split(" ", 1)
+                if name == ref:
+                    return commit
+    except (OSError, ValueError):
+        pass
+    return None
+
+
 def get_upstream_remote(args, name_repo):
     """Find the remote, which matches the git URL from the config.
 
@@ -92,6 +148,12 @@ def get_upstream_remote(args, name_repo):
     """
     url = pmb.config.git_repos[name_repo]
     path = get_path(args, name_repo)
+
+    # Try .git/config first, so we don't need to run git
+    for remote, urls in (read_remotes(path) or {}).items():
+        if any(url in remote_url for remote_url in urls):
+            return remote
+
     command = ["git", "remote", "-v"]
     output = pmb.helpers.run.user(args, command, path, output_return=True)
     for line in output.split("\n"):
@@ -106,6 +168,9 @@ def parse_channels_cfg(args):
 
     Reference: https://postmarketos.org/channels.cfg
 
+    The result gets cached in $WORK/cache_git/channels_cfg.json, so git only
+    runs again after the master branch of the remote changed.
+
     :returns: dict like: {"meta": {"recommended": "edge"},
         "channels": {"edge": {"description": ...,
         "branch_pmaports": ...,
@@ -120,10 +185,23 @@ def parse_channels_cfg(args):
 
     # Read with configparser
     cfg = configparser.ConfigParser()
+    cache_disk = None
     if args.config_channels:
         cfg.read([args.config_channels])
     else:
         remote = get_upstream_remote(args, "pmaports")
+
+        # Cache on disk, until the remote's master branch changes
+        commit = read_ref(args.aports, f"refs/remotes/{remote}/master")
+        if commit:
+            cache_disk = {"aports": args.aports,
+                          "ref": f"{remote}/master",
+                          "commit": commit}
+            ret = parse_channels_cfg_cache_read(args, cache_disk)
+            if ret:
+                pmb.helpers.other.cache[cache_key] = ret
+                return ret
+
         command = ["git", "show", f"{remote}/master:channels.cfg"]
         stdout = pmb.helpers.run.user(args, command, args.aports,
                                       output_return=True, check=False)
@@ -153,10 +231,44 @@ def parse_channels_cfg(args):
             value = cfg.get(channel, key)
             ret["channels"][channel_new][key] = value
 
+    if cache_disk:
+        parse_channels_cfg_cache_write(args, cache_disk, ret)
     pmb.helpers.other.cache[cache_key] = ret
     return ret
 
 
+def parse_channels_cfg_cache_read(args, key):
+    """Get the parsed channels.cfg from $WORK/cache_git/channels_cfg.json.
+
+    :param key: dict with the pmaports path, ref and its commit, which must
+                match the cached values
+    :returns: result of parse_channels_cfg(), or None if not cached
+    """
+    path = f"{args.work}/cache_git/channels_cfg.json"
+    try:
+        with open(path) as handle:
+            cache = json.load(handle)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(cache, dict) or cache.get("key") != key:
+        return None
+    logging.verbose(f"channels.cfg: using cache for {key['ref']}"
+                    f" ({key['commit']})")
+    return cache.get("channels_cfg")
+
+
+def parse_channels_cfg_cache_write(args, key, channels_cfg):
+    """Store the parsed channels.cfg in $WORK/cache_git/channels_cfg.json."""
+    path = f"{args.work}/cache_git/channels_cfg.json"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.new", "w") as handle:
+            json.dump({"key": key, "channels_cfg": channels_cfg}, handle)
+        os.replace(f"{path}.new", path)
+    except OSError as e:
+        logging.verbose(f"channels.cfg: failed to write cache: {e}")
+
+
 def get_branches_official(args, name_repo):
     """Get all branches that point to official release channels.
 
@@ -249,6 +361,30 @@ def get_topdir(args, path):
                                 path, output_return=True, check=False).rstrip()
 
 
+def get_changed_files(args, path, commit):
+    """Get all files that were changed since a specific commit: in the
+    commits since then, in the worktree (not committed yet) and untracked
+    files that are not in gitignore.
+
+    :param path: top dir of the git repository
+    :param commit: the commit to compare with
+    :returns: sorted list of changed (and deleted) files relative to path, or
+              None if the commit does not exist in the repository
+    """
+    if pmb.helpers.run.user(args, ["git", "cat-file", "-e",
+                                   f"{commit}^{{commit}}"], path,
+                            check=False):
+        return None
+
+    ret = pmb.helpers.run.user(args, ["git", "diff", "--name-only", "-z",
+                                      "--no-renames", commit], path,
+                               output_return=True).split("\0")
+    ret += pmb.helpers.run.user(args, ["git", "ls-files", "-z",
+                                       "--exclude-standard", "--other"], path,
+                                output_return=True).split("\0")
+    return sorted(set(filter(None, ret)))
+
+
 def get_files(args, path):
     """Get all files inside a git repository, that are either already in the git tree or are not in gitignore.
 
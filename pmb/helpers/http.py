@@ -5,10 +5,25 @@ import json
 import logging
 import os
 import shutil
+import threading
+import time
+import urllib.parse
 import urllib.request
 
 import pmb.helpers.run
 
+# Requests to the same host that may run at the same time in retrieve()
+host_limit = 4
+host_lock = threading.Lock()
+host_semaphores = {}
+host_blocked_until = {}
+host_blocked_logged = {}
+
+# When the rate limit of a host is reached, wait for the reset if it happens
+# within this amount of seconds
+rate_limit_wait_max = 15 * 60
+rate_limit_retries = 3
+
 
 def download(args, url, prefix, cache=True, loglevel=logging.INFO,
              allow_404=False):
@@ -62,9 +77,61 @@ def download(args, url, prefix, cache=True, loglevel=logging.INFO,
     return path
 
 
+def wait_for_host(host):
+    """Sleep until the rate limit of a host is reset, if it was reached.
+
+    :raises RuntimeError: if the reset is more than rate_limit_wait_max
+                          seconds away
+    """
+    with host_lock:
+        blocked_until = host_blocked_until.get(host, 0)
+        wait = blocked_until - time.time()
+        log = wait > 0 and host_blocked_logged.get(host) != blocked_until
+        if log:
+            host_blocked_logged[host] = blocked_until
+    if wait <= 0:
+        return
+    if wait > rate_limit_wait_max:
+        raise RuntimeError(f"Rate limit of {host} reached, it gets reset in"
+                           f" {round(wait / 60)} min. Try again later.")
+    if log:
+        logging.info(f"NOTE: rate limit of {host} reached, waiting"
+                     f" {round(wait)}s for the reset")
+    time.sleep(wait)
+
+
+def get_rate_limit_wait(headers):
+    """Get the time until the rate limit resets from the response headers.
+
+    GitHub and GitLab send X-RateLimit-Remaining/X-RateLimit-Reset (GitLab
+    also without the X- prefix) with the epoch time of the reset, other
+    servers send Retry-After with the amount of seconds to wait.
+
+    :param headers: headers of the HTTP response
+    :returns: seconds to wait before sending the next request, or None if
+              the rate limit was not reached
+    """
+    retry_after = headers.get("Retry-After")
+    if retry_after and retry_after.isdigit():
+        return int(retry_after)
+
+    for prefix in ["X-RateLimit-", "RateLimit-"]:
+        remaining = headers.get(f"{prefix}Remaining")
+        reset = headers.get(f"{prefix}Reset")
+        if remaining == "0" and reset and reset.isdigit():
+            return max(0, int(reset) - time.time())
+    return None
+
+
 def retrieve(url, headers=None, allow_404=False):
     """Fetch the content of a URL and returns it as string.
 
+    This may be called from multiple threads. At most host_limit requests to
+    the same host run at the same time, and when the server reports that the
+    rate limit was reached, the following requests to the host wait until it
+    gets reset. If that is more than rate_limit_wait_max seconds away, they
+    fail instead.
+
     :param url: the http(s) address of to the resource to fetch
     :param headers: dict of HTTP headers to use
     :param allow_404: do not raise an exception when the server responds with a 
@@ -78,16 +145,39 @@ def retrieve(url, headers=None, allow_404=False):
     if headers is None:
         headers = {}
 
+    host = urllib.parse.urlparse(url).netloc
+    with host_lock:
+        if host not in host_semaphores:
+            host_semaphores[host] = threading.Semaphore(host_limit)
+        semaphore = host_semaphores[host]
+
     req = urllib.request.Request(url, headers=headers)
-    try:
-        with urllib.request.urlopen(req) as response:
-            return response.read()
-    # Handle 404
-    except urllib.error.HTTPError as e:
-        if e.code == 404 and allow_404:
-            logging.warning("WARNING: failed to retrieve content from: " + url)
-            return None
-        raise
+    for attempt in range(rate_limit_retries + 1):
+        wait_for_host(host)
+        try:
+            with semaphore, urllib.request.urlopen(req) as response:
+                wait = get_rate_limit_wait(response.headers)
+                if wait:
+                    with host_lock:
+                        host_blocked_until[host] = time.time() + wait
+                return response.read()
+        except urllib.error.HTTPError as e:
+            # Handle 404
+            if e.code == 404 and allow_404:
+                logging.warning("WARNING: failed to retrieve content from: "
+                                + url)
+                return None
+
+            # Rate limit reached: wait for the reset and try again
+            wait = get_rate_limit_wait(e.headers)
+            if e.code not in [403, 429] or wait is None or \
+                    wait > rate_limit_wait_max or \
+                    attempt == rate_limit_retries:
+                raise
+            logging.info(f"NOTE: rate limit of {host} reached, retrying in"
+                         f" {round(wait)}s")
+            with host_lock:
+                host_blocked_until[host] = time.time() + wait
 
 
 def retrieve_json(*args, **kwargs):
@@ -96,3 +186,32 @@ def retrieve_json(*args, **kwargs):
     See retrieve() for the list of all parameters.
     """
     return json.loads(retrieve(*args, **kwargs))
+
+
+def retrieve_json_cached(args, url, headers=None, allow_404=False,
+                         ttl=3600):
+    """Like retrieve_json(), but cache the response in the work dir.
+
+    :param ttl: seconds after which the cached response gets fetched again
+    :returns: parsed JSON data, or None on 404 (with allow_404)
+    """
+    path = (f"{args.work}/cache_http/json_"
+            f"{hashlib.sha256(url.encode('utf-8')).hexdigest()}")
+    if os.path.exists(path) and time.time() - os.path.getmtime(path) < ttl:
+        logging.verbose(f"Retrieving {url} (cached)")
+        with open(path, "rb") as handle:
+            return json.loads(handle.read())
+
+    if args.offline:
+        raise RuntimeError("URL not found in cache and offline flag is"
+                           f" enabled: {url}")
+
+    content = retrieve(url, headers, allow_404)
+    if content is None:
+        return None
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    path_tmp = f"{path}.{threading.get_ident()}.tmp"
+    with open(path_tmp, "wb") as handle:
+        handle.write(content)
+    os.replace(path_tmp, path)
+    return json.loads(content)
@@ -1,7 +1,10 @@
 # Copyright 2023 Danct12 <danct12@disroot.org>
 # SPDX-License-Identifier: GPL-3.0-or-later
+import concurrent.futures
+import hashlib
 import logging
 import os
+import sys
 
 import pmb.chroot
 import pmb.chroot.apk
@@ -10,10 +13,59 @@ import pmb.helpers.run
 import pmb.helpers.pmaports
 
 
-def check(args, pkgnames):
+def get_cache_key(apkbuild, content, atools_version, options):
+    """:param apkbuild: path to the APKBUILD relative to pmaports (it is
+                        part of the lint output)
+    :param content: content of the APKBUILD as bytes
+    :returns: key for the lint result of an APKBUILD"""
+    ret = hashlib.sha256()
+    ret.update(f"{atools_version}\0{options}\0{apkbuild}\0".encode())
+    ret.update(content)
+    return ret.hexdigest()
+
+
+def split_output(output, apkbuilds):
+    """Assign the lines of apkbuild-lint's output to the APKBUILDs.
+
+    :param output: output of apkbuild-lint
+    :param apkbuilds: the APKBUILD paths apkbuild-lint ran with
+    :returns: {apkbuild: output_lines, ...}, or None if a line doesn't
+              belong to one of the APKBUILDs
+    """
+    ret = {apkbuild: "" for apkbuild in apkbuilds}
+    for line in output.splitlines(keepends=True):
+        for part in line.split(":"):
+            apkbuild = part[2:] if part.startswith("./") else part
+            if apkbuild in ret:
+                ret[apkbuild] += line
+                break
+        else:
+            return None
+    return ret
+
+
+def lint_shard(args, apkbuilds, pmaports, env):
+    """Run apkbuild-lint on some APKBUILDs (in a separate thread).
+
+    :param pmaports: mount point of pmaports inside the chroot
+    :returns: output of apkbuild-lint
+    """
+    return pmb.chroot.root(args, ["apkbuild-lint"] + apkbuilds, check=False,
+                           output="log", output_return=True,
+                           working_dir=pmaports, env=env, auto_init=False)
+
+
+def check(args, pkgnames, jobs=None):
     """Run apkbuild-lint on the supplied packages.
 
+    The APKBUILDs get split into one shard per CPU, and apkbuild-lint runs
+    on the shards in parallel. The result for each APKBUILD gets cached in
+    $WORK/cache_lint, so APKBUILDs are only linted again when they, atools
+    or the custom valid options change.
+
     :param pkgnames: Names of the packages to lint
+    :param jobs: number of apkbuild-lint processes, default: CPU count
+    :returns: output of apkbuild-lint
     """
     pmb.chroot.apk.install(args, ["atools"])
 
@@ -33,14 +85,56 @@ def check(args, pkgnames):
         relpath = os.path.relpath(aport, args.aports)
         apkbuilds.append(f"{relpath}/APKBUILD")
 
+    # Find cached results
+    options = " ".join(pmb.config.apkbuild_custom_valid_options)
+    atools_version = pmb.chroot.apk.installed(args)["atools"]["version"]
+    cache_dir = f"{args.work}/cache_lint"
+    keys = {}
+    results = {}
+    for apkbuild in apkbuilds:
+        with open(f"{args.aports}/{apkbuild}", "rb") as handle:
+            keys[apkbuild] = get_cache_key(apkbuild, handle.read(),
+                                           atools_version, options)
+        path = f"{cache_dir}/{keys[apkbuild]}"
+        if os.path.exists(path):
+            with open(path) as handle:
+                results[apkbuild] = handle.read()
+    todo = [apkbuild for apkbuild in apkbuilds if apkbuild not in results]
+
     # Run apkbuild-lint in chroot from the pmaports mount point. This will
     # print a nice source identifier à la "./cross/grub-x86/APKBUILD" for
     # each violation.
     pkgstr = ", ".join(pkgnames)
-    logging.info(f"(native) linting {pkgstr} with apkbuild-lint")
-    options = pmb.config.apkbuild_custom_valid_options
-    return pmb.chroot.root(args, ["apkbuild-lint"] + apkbuilds,
-                           check=False, output="stdout",
-                           output_return=True,
-                           working_dir=pmaports,
-                           env={"CUSTOM_VALID_OPTIONS": " ".join(options)})
+    if len(pkgstr) > 100:
+        pkgstr = f"{len(pkgnames)} packages"
+    logging.info(f"(native) linting {pkgstr} with apkbuild-lint"
+                 f" ({len(apkbuilds) - len(todo)} cached)")
+    env = {"CUSTOM_VALID_OPTIONS": options}
+    jobs = min(jobs or os.cpu_count() or 1, len(todo))
+    shards = [todo[i::jobs] for i in range(jobs)]
+    with concurrent.futures.ThreadPoolExecutor(max(jobs, 1)) as executor:
+        futures = [executor.submit(lint_shard, args, shard, pmaports,
+                                   env)
+                   for shard in shards]
+        outputs = [future.result() for future in futures]
+
+    os.makedirs(cache_dir, exist_ok=True)
+    unassigned = ""
+    for shard, output in zip(shards, outputs):
+        shard_results = split_output(output, shard)
+        if shard_results is None:
+            # Unexpected output, don't cache it
+            unassigned += output
+            continue
+        for apkbuild, result in shard_results.items():
+            results[apkbuild] = result
+            path = f"{cache_dir}/{keys[apkbuild]}"
+            with open(f"{path}.new", "w") as handle:
+                handle.write(result)
+            os.replace(f"{path}.new", path)
+
+    ret = "".join(results.get(apkbuild, "") for apkbuild in apkbuilds)
+    ret += unassigned
+    sys.stdout.write(ret)
+    sys.stdout.flush()
+    return ret
@@ -1,16 +1,35 @@
 # Copyright 2023 Oliver Smith
 # SPDX-License-Identifier: GPL-3.0-or-later
+import atexit
 import logging
 import os
+import queue
 import sys
+import threading
+import time
 import pmb.config
 
 logfd = None
 
+# Log messages get written to logfd by a background thread in batches. The
+# queue is bounded, so logging blocks instead of using lots of memory if the
+# thread can't keep up. See flush() for writing everything immediately.
+# Output of subprocesses goes through the same queue (see write()), so only
+# logthread writes to logfd while it is running.
+logqueue = None
+logthread = None
+loglock = threading.Lock()
+logqueue_size = 10000
+logqueue_batch = 500
+logqueue_flush_interval = 0.5
+
 
 class log_handler(logging.StreamHandler):
     """Write to stdout and to the already opened log file."""
     _args = None
+    _pid = ""
+    _styles = []
+    _style_end = ""
 
     def emit(self, record):
         try:
@@ -20,48 +39,20 @@ class log_handler(logging.StreamHandler):
             if (not self._args.details_to_stdout and
                 not self._args.quiet and
                     record.levelno >= logging.INFO):
-                stream = self.stream
-
-                styles = pmb.config.styles
-
-                msg_col = (
-                    msg.replace(
-                        "NOTE:",
-                        f"{styles['BLUE']}NOTE:{styles['END']}",
-                        1,
-                    )
-                    .replace(
-                        "WARNING:",
-                        f"{styles['YELLOW']}WARNING:{styles['END']}",
-                        1,
-                    )
-                    .replace(
-                        "ERROR:",
-                        f"{styles['RED']}ERROR:{styles['END']}",
-                        1,
-                    )
-                    .replace(
-                        "DONE!",
-                        f"{styles['GREEN']}DONE!{styles['END']}",
-                        1,
-                    )
-                    .replace(
-                        "*** ",
-                        f"{styles['GREEN']}*** ",
-                        1,
-                    )
-                )
-
-                msg_col += styles["END"]
-
-                stream.write(msg_col)
-                stream.write(self.terminator)
+                msg_col = msg
+                for keyword, keyword_col in self._styles:
+                    if keyword in msg_col:
+                        msg_col = msg_col.replace(keyword, keyword_col, 1)
+                msg_col += self._style_end
+
+                self.stream.write(msg_col)
+                self.stream.write(self.terminator)
                 self.flush()
 
             # Everything: Write to logfd
-            msg = "(" + str(os.getpid()).zfill(6) + ") " + msg
-            logfd.write(msg + "\n")
-            logfd.flush()
+            write(f"{self._pid}{msg}\n")
+            if not logqueue:
+                logfd.flush()
 
         except (KeyboardInterrupt, SystemExit):
             raise
@@ -69,6 +60,136 @@ class log_handler(logging.StreamHandler):
             self.handleError(record)
 
 
+def init_styles(stream):
+    """Prepare the keywords that get colored in the stdout output once, or
+    disable colors if the stream is not a terminal."""
+    if not stream.isatty():
+        log_handler._styles = []
+        log_handler._style_end = ""
+        return
+
+    styles = pmb.config.styles
+    log_handler._styles = [
+        ("NOTE:", f"{styles['BLUE']}NOTE:{styles['END']}"),
+        ("WARNING:", f"{styles['YELLOW']}WARNING:{styles['END']}"),
+        ("ERROR:", f"{styles['RED']}ERROR:{styles['END']}"),
+        ("DONE!", f"{styles['GREEN']}DONE!{styles['END']}"),
+        ("*** ", f"{styles['GREEN']}*** "),
+    ]
+    log_handler._style_end = styles["END"]
+
+
+def write(data):
+    """Write to the log file, after all log messages that were queued before.
+
+    :param data: str (log message) or bytes (e.g. output of a subprocess)
+    """
+    if logqueue:
+        logqueue.put(data)
+    elif isinstance(data, bytes):
+        logfd.buffer.write(data)
+    else:
+        logfd.write(data)
+
+
+def writer():
+    """Write queued log messages to logfd in batches, flush it after
+    logqueue_flush_interval seconds. This runs in logthread.
+
+    Everything gets written to the binary buffer of logfd, the text layer is
+    not used while logthread runs."""
+    fd = logfd
+    encoding = fd.encoding or "utf-8"
+    dirty = False
+    last_flush = time.monotonic()
+    while True:
+        # Wait for the next message, or flush after the timeout
+        try:
+            batch = [logqueue.get(timeout=logqueue_flush_interval if dirty
+                                  else None)]
+        except queue.Empty:
+            batch = []
+        while batch and batch[-1] is not None and \
+                len(batch) < logqueue_batch:
+            try:
+                batch.append(logqueue.get_nowait())
+            except queue.Empty:
+                break
+
+        # None gets queued by stop()
+        stop = bool(batch) and batch[-1] is None
+        msgs = batch[:-1] if stop else batch
+
+        try:
+            with loglock:
+                if msgs:
+                    fd.buffer.write(b"".join(
+                        msg if isinstance(msg, bytes)
+                        else msg.encode(encoding, "replace")
+                        for msg in msgs))
+                    dirty = True
+                now = time.monotonic()
+                if dirty and (stop or not batch or
+                              now - last_flush >= logqueue_flush_interval):
+                    fd.flush()
+                    dirty = False
+                    last_flush = now
+        except ValueError:
+            # logfd was closed already (testsuite)
+            pass
+
+        for _ in batch:
+            logqueue.task_done()
+        if stop:
+            return
+
+
+def flush():
+    """Wait until all queued log messages are written, and flush logfd. Call
+    this before writing to logfd directly (e.g. by a subprocess)."""
+    if logqueue:
+        logqueue.join()
+    with loglock:
+        if logfd and not logfd.closed:
+            logfd.flush()
+
+
+def stop():
+    """Write all queued log messages and stop logthread."""
+    global logqueue, logthread
+    if not logthread:
+        return
+    logqueue.put(None)
+    logthread.join()
+    logqueue = None
+    logthread = None
+    flush()
+
+
+def before_fork():
+    """Write the queued messages and flush logfd before forking, so they come
+    before the messages of the child, and so the child doesn't inherit
+    buffered data and write it a second time."""
+    if logqueue:
+        logqueue.join()
+    loglock.acquire()
+    if logfd and not logfd.closed:
+        logfd.flush()
+
+
+def after_fork_parent():
+    loglock.release()
+
+
+def after_fork_child():
+    """logthread doesn't exist in the child process, write to logfd directly
+    instead of queueing messages that nobody reads."""
+    global logqueue, logthread, loglock
+    logqueue = None
+    logthread = None
+    loglock = threading.Lock()
+
+
 def add_verbose_log_level():
     """Add a new log level "verbose", which is below "debug".
 
@@ -90,7 +211,9 @@ def add_verbose_log_level():
 
 def init(args):
     """Set log format and add the log file descriptor to logfd, add the verbose log level."""
-    global logfd
+    global logfd, logqueue, logthread
+    stop()
+
     # Set log file descriptor (logfd)
     if args.details_to_stdout:
         logfd = sys.stdout
@@ -113,15 +236,26 @@ def init(args):
     formatter = logging.Formatter("[%(asctime)s] %(message)s",
                                   datefmt="%H:%M:%S")
 
-    # Set log level
+    # Set log level. Replace logging.verbose() with a function that does
+    # nothing if the level is disabled, so it doesn't even create a log record.
     add_verbose_log_level()
     root_logger.setLevel(logging.DEBUG)
     if args.verbose:
         root_logger.setLevel(logging.VERBOSE)
+    else:
+        logging.verbose = lambda msg, *args, **kwargs: None
+
+    # Write to the log file in the background
+    if not args.details_to_stdout:
+        logqueue = queue.Queue(logqueue_size)
+        logthread = threading.Thread(target=writer, daemon=True)
+        logthread.start()
 
     # Add a custom log handler
     handler = log_handler()
     log_handler._args = args
+    log_handler._pid = "(" + str(os.getpid()).zfill(6) + ") "
+    init_styles(handler.stream)
     handler.setFormatter(formatter)
     root_logger.addHandler(handler)
 
@@ -129,3 +263,8 @@ def init(args):
 def disable():
     logger = logging.getLogger()
     logger.disabled = True
+
+
+atexit.register(stop)
+os.register_at_fork(before=before_fork, after_in_parent=after_fork_parent,
+                    after_in_child=after_fork_child)
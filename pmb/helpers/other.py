@@ -1,32 +1,27 @@
 # Copyright 2023 Oliver Smith
 # SPDX-License-Identifier: GPL-3.0-or-later
 import glob
+import importlib
 import logging
+import math
 import os
 import re
-import pmb.chroot
 import pmb.config
-import pmb.config.init
+import pmb.helpers.du
 import pmb.helpers.pmaports
 import pmb.helpers.run
 
 
-def folder_size(args, path):
-    """Run `du` to calculate the size of a folder.
+def folder_size(args, path, cache=None):
+    """Calculate the size of a folder, like "du -ks" (see pmb.helpers.du).
 
-    (this is less code and faster than doing the same task in pure Python)
     This result is only approximatelly right, but good enough for pmbootstrap's use case (#760).
 
+    :param cache: optional dict, pass the same one to multiple calls to only
+                  scan the sub folders again that changed in between
     :returns: folder size in kilobytes
     """
-    output = pmb.helpers.run.root(args, ["du", "-ks",
-                                         path], output_return=True)
-
-    # Only look at last line to filter out sudo garbage (#1766)
-    last_line = output.split("\n")[-2]
-
-    ret = int(last_line.split("\t")[0])
-    return ret
+    return math.ceil(pmb.helpers.du.size(args, path, cache) / 1024)
 
 
 def check_grsec():
@@ -89,6 +84,10 @@ def migrate_work_folder(args):
                  " (from version " + str(current) + " to " + str(required) +
                  ")!")
 
+    # Only load the chroot code if there is something to migrate
+    for module in ["pmb.chroot", "pmb.config.init", "pmb.helpers.cli"]:
+        importlib.import_module(module)
+
     # 0 => 1
     if current == 0:
         # Ask for confirmation
@@ -306,10 +305,12 @@ def init_cache():
              "apkbuild": {},
              "apk_min_version_checked": [],
              "apk_repository_list_updated": [],
+             "pmb.chroot.apk.installed": {},
              "built": {},
              "find_aport": {},
              "pmb.helpers.package.depends_recurse": {},
              "pmb.helpers.package.get": {},
+             "pmb.helpers.rdepends.index": {},
              "pmb.helpers.repo.update": repo_update,
              "pmb.helpers.git.parse_channels_cfg": {},
              "pmb.config.pmaports.read_config": None,
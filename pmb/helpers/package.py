@@ -11,8 +11,10 @@ See also:
 import copy
 import logging
 
+import pmb.build
 import pmb.helpers.pmaports
 import pmb.helpers.repo
+import pmb.parse.apkindex
 
 
 def remove_operators(package):
@@ -2,10 +2,13 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 import logging
 
+import pmb.config
 import pmb.helpers.file
 import pmb.helpers.pmaports
 import pmb.helpers.repo
 import pmb.parse
+import pmb.parse.apkindex
+import pmb.parse.version
 
 
 def package(args, pkgname, reason="", dry=False):
@@ -16,8 +19,7 @@ def package(args, pkgname, reason="", dry=False):
     :param dry: don't modify the APKBUILD, just print the message
     """
     # Current and new pkgrel
-    path = pmb.helpers.pmaports.find(args, pkgname) + "/APKBUILD"
-    apkbuild = pmb.parse.apkbuild(path)
+    apkbuild = pmb.helpers.pmaports.get(args, pkgname)
     pkgrel = int(apkbuild["pkgrel"])
     pkgrel_new = pkgrel + 1
 
@@ -27,34 +29,62 @@ def package(args, pkgname, reason="", dry=False):
     if dry:
         return
 
-    # Increase
-    old = "\npkgrel=" + str(pkgrel) + "\n"
-    new = "\npkgrel=" + str(pkgrel_new) + "\n"
-    pmb.helpers.file.replace(path, old, new)
+    # Increase and verify
+    pmb.helpers.file.replace_apkbuild_values(args, pkgname,
+                                             {"pkgrel": pkgrel_new})
 
-    # Verify
-    del pmb.helpers.other.cache["apkbuild"][path]
-    apkbuild = pmb.parse.apkbuild(path)
-    if int(apkbuild["pkgrel"]) != pkgrel_new:
-        raise RuntimeError("Failed to bump pkgrel for package '" + pkgname +
-                           "'. Make sure that there's a line with exactly the"
-                           " string '" + old + "' and nothing else in: " +
-                           path)
 
+def missing_depends(indexes, indexes_pmos):
+    """Find the binary packages of one architecture with dependencies that
+    are not provided by any package anymore. Instead of looking up the
+    providers of each dependency, all provided names get collected in one
+    set first. This runs in a separate thread for each architecture, see
+    auto().
+
+    :param indexes: paths to all APKINDEX files of the architecture
+    :param indexes_pmos: paths to the APKINDEX files with the binary
+                         packages to check
+    :returns: dict of (origin, version) to the sorted list of missing
+              dependencies of all binary packages built from the origin with
+              that version, e.g.: {("hello-world", "1-r4"): ["so:libc.so.6"]}
+    """
+    provided = set()
+    for path in indexes:
+        provided.update(pmb.parse.apkindex.parse(path))
+
+    required = {}
+    for path in indexes_pmos:
+        for pkgname, apk in pmb.parse.apkindex.parse(path, False).items():
+            # Skip the entries of provided names, and ignore
+            # conflict-dependencies
+            if pkgname != apk["pkgname"]:
+                continue
+            key = (apk["origin"], apk["version"])
+            required.setdefault(key, set()).update(
+                depend for depend in apk["depends"]
+                if not depend.startswith("!"))
+
+    ret = {}
+    for key, depends in required.items():
+        missing = depends - provided
+        if missing:
+            ret[key] = sorted(missing)
+    return ret
 
-def auto_apkindex_package(args, arch, aport, apk, dry=False):
-    """Bump the pkgrel of a specific package if it is outdated in the given APKINDEX.
 
-    :param arch: the architecture, e.g. "armhf"
-    :param aport: parsed APKBUILD of the binary package's origin:
+def auto_origin(args, aport, version_apk, missing, dry=False):
+    """Bump the pkgrel of an aport if its binary packages have missing
+    dependencies.
+
+    :param aport: parsed APKBUILD of the binary packages' origin:
                   {"pkgname": ..., "pkgver": ..., "pkgrel": ..., ...}
-    :param apk: information about the binary package from the APKINDEX:
-                {"version": ..., "depends": [...], ...}
+    :param version_apk: version of the binary packages
+    :param missing: dependencies that are not provided by any package, from
+                    missing_depends()
     :param dry: don't modify the APKBUILD, just print the message
     :returns: True when there was an APKBUILD that needed to be changed.
     """
     version_aport = aport["pkgver"] + "-r" + aport["pkgrel"]
-    version_apk = apk["version"]
     pkgname = aport["pkgname"]
 
     # Skip when aport version != binary package version
@@ -72,25 +102,12 @@ def auto_apkindex_package(args, arch, aport, apk, dry=False):
                                                              version_apk))
         return
 
-    # Find missing depends
-    depends = apk["depends"]
-    logging.verbose("{}: checking depends: {}".format(pkgname,
-                                                      ", ".join(depends)))
-    missing = []
-    for depend in depends:
-        if depend.startswith("!"):
-            # Ignore conflict-dependencies
-            continue
-
-        providers = pmb.parse.apkindex.providers(args, depend, arch,
-                                                 must_exist=False)
-        if providers == {}:
-            # We're only interested in missing depends starting with "so:"
-            # (which means dynamic libraries that the package was linked
-            # against) and packages for which no aport exists.
-            if (depend.startswith("so:") or
-                    not pmb.helpers.pmaports.find(args, depend, False)):
-                missing.append(depend)
+    # We're only interested in missing depends starting with "so:" (which
+    # means dynamic libraries that the package was linked against) and
+    # packages for which no aport exists.
+    missing = [depend for depend in missing
+               if depend.startswith("so:") or
+               not pmb.helpers.pmaports.find(args, depend, False)]
 
     # Increase pkgrel
     if len(missing):
@@ -100,26 +117,31 @@ def auto_apkindex_package(args, arch, aport, apk, dry=False):
 
 
 def auto(args, dry=False):
-    """:returns: list of aport names, where the pkgrel needed to be changed"""
+    """Bump the pkgrel of all aports with binary packages in the pmOS
+    repositories that depend on packages that don't exist anymore (e.g.
+    because a library's soname changed).
+
+    :returns: list of aport names, where the pkgrel needed to be changed
+    """
     ret = []
     for arch in pmb.config.build_device_architectures:
         paths = pmb.helpers.repo.apkindex_files(args, arch, alpine=False)
         for path in paths:
             logging.info("scan " + path)
-            index = pmb.parse.apkindex.parse(path, False)
-            for pkgname, apk in index.items():
-                origin = apk["origin"]
-                # Only increase once!
-                if origin in ret:
-                    logging.verbose(
-                        f"{pkgname}: origin '{origin}' found again")
-                    continue
-                aport_path = pmb.helpers.pmaports.find(args, origin, False)
-                if not aport_path:
-                    logging.warning("{}: origin '{}' aport not found".format(
-                                    pkgname, origin))
-                    continue
-                aport = pmb.parse.apkbuild(f"{aport_path}/APKBUILD")
-                if auto_apkindex_package(args, arch, aport, apk, dry):
-                    ret.append(pkgname)
+        indexes = pmb.helpers.repo.apkindex_files(args, arch)
+        for (origin, version), missing in missing_depends(indexes,
+                                                          paths).items():
+            # Only increase once!
+            if origin in ret:
+                logging.verbose(f"{origin}: found again ({arch})")
+                continue
+            logging.verbose(f"{origin}: missing depends ({arch}):"
+                            f" {', '.join(missing)}")
+            aport_path = pmb.helpers.pmaports.find(args, origin, False)
+            if not aport_path:
+                logging.warning(f"{origin}: aport not found")
+                continue
+            aport = pmb.parse.apkbuild(f"{aport_path}/APKBUILD")
+            if auto_origin(args, aport, version, missing, dry):
+                ret.append(origin)
     return ret
@@ -7,6 +7,7 @@ See also:
 - pmb/helpers/package.py (work with both)
 """
 import glob
+import importlib
 import logging
 import os
 
@@ -208,6 +209,8 @@ def get(args, pkgname, must_exist=True, subpackages=True):
                   "options": [],
                   ... }
     """
+    # Imported here, it loads the chroot code (see pmb.helpers.frontend)
+    importlib.import_module("pmb.helpers.package")
     pkgname = pmb.helpers.package.remove_operators(pkgname)
     if subpackages:
         aport = find(args, pkgname, must_exist)
@@ -0,0 +1,191 @@
+# Copyright 2023 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""Reverse dependency index: which packages depend on a package.
+
+The index is built from the parsed APKBUILDs in pmaports (depends,
+makedepends, checkdepends and the depends of subpackages) and from the
+dependencies of the binary packages in the APKINDEX files ("D:" lines).
+It gets stored in $WORK/cache_rdepends and updated incrementally: only
+APKBUILDs and APKINDEX files that were modified since the last run get
+parsed again.
+
+Package names from pmaports and binary repositories are merged, so the
+result for "hello-world" contains both aports that have it in their
+makedepends and binary packages that depend on it.
+"""
+import json
+import logging
+import os
+
+import pmb.config
+import pmb.helpers.package
+import pmb.helpers.pmaports
+import pmb.helpers.repo
+import pmb.parse
+import pmb.parse.apkindex
+
+# Increase when the format of the stored index changes
+index_version = 1
+
+
+def get_index_path(args, arch):
+    return f"{args.work}/cache_rdepends/{arch}.json"
+
+
+def parse_apkbuild(path):
+    """:returns: {"provides": [...], "depends": [...]} of an APKBUILD,
+                 including its subpackages"""
+    apkbuild = pmb.parse.apkbuild(path)
+    provides = {apkbuild["pkgname"]}
+    depends = set(apkbuild["depends"] + apkbuild["makedepends"] +
+                  apkbuild["checkdepends"])
+    provides.update(apkbuild["provides"])
+    for subpkgname, subpkg in apkbuild["subpackages"].items():
+        provides.add(subpkgname)
+        if subpkg:
+            provides.update(subpkg["provides"])
+            depends.update(subpkg["depends"])
+
+    provides = {pmb.helpers.package.remove_operators(name)
+                for name in provides}
+    depends = {pmb.helpers.package.remove_operators(name)
+               for name in depends if not name.startswith("!")}
+    return {"provides": sorted(provides),
+            "depends": sorted(depends - provides)}
+
+
+def parse_apkindex(path):
+    """:returns: {pkgname: {"provides": [...], "depends": [...]}, ...} for
+                 all binary packages in an APKINDEX file"""
+    ret = {}
+    for pkgname, block in pmb.parse.apkindex.parse(path, False).items():
+        # Skip the entries of provided names
+        if pkgname != block["pkgname"]:
+            continue
+        ret[pkgname] = {"provides": sorted(set(block["provides"])),
+                        "depends": sorted(depend for depend in
+                                          set(block["depends"])
+                                          if not depend.startswith("!"))}
+    return ret
+
+
+def read_index(args, arch):
+    """:returns: the stored index, or an empty one if it can't be used"""
+    ret = {"version": index_version, "aports": args.aports,
+           "apkbuilds": {}, "apkindexes": {}}
+    path = get_index_path(args, arch)
+    if not os.path.exists(path):
+        return ret
+    with open(path) as handle:
+        try:
+            index = json.load(handle)
+        except ValueError:
+            logging.debug(f"rdepends: failed to parse {path}")
+            return ret
+    if index.get("version") != ret["version"] or \
+            index.get("aports") != ret["aports"]:
+        return ret
+    return index
+
+
+def update_index(args, arch):
+    """Parse the APKBUILDs and APKINDEX files that changed since the index
+    was stored, and store the updated index.
+
+    :param arch: architecture of the APKINDEX files (e.g. "armhf")
+    :returns: {"apkbuilds": {pkgname: {"path": ..., "stat": [mtime, size],
+              "provides": [...], "depends": [...]}, ...},
+              "apkindexes": {path: {"stat": [...], "packages": {...}}, ...}}
+    """
+    cache_key = "pmb.helpers.rdepends.index"
+    if arch in pmb.helpers.other.cache[cache_key]:
+        return pmb.helpers.other.cache[cache_key][arch]
+
+    index = read_index(args, arch)
+    changed = False
+
+    # APKBUILDs
+    apkbuilds = {}
+    for pkgname in pmb.helpers.pmaports.get_list(args):
+        path = pmb.helpers.pmaports.find(args, pkgname) + "/APKBUILD"
+        stat = os.stat(path)
+        stamp = [stat.st_mtime_ns, stat.st_size]
+        entry = index["apkbuilds"].get(pkgname)
+        if not entry or entry["path"] != path or entry["stat"] != stamp:
+            logging.verbose(f"rdepends: parsing {path}")
+            entry = dict(parse_apkbuild(path), path=path, stat=stamp)
+            changed = True
+        apkbuilds[pkgname] = entry
+    changed = changed or len(apkbuilds) != len(index["apkbuilds"])
+    index["apkbuilds"] = apkbuilds
+
+    # APKINDEX files
+    apkindexes = {}
+    for path in pmb.helpers.repo.apkindex_files(args, arch):
+        if not os.path.exists(path):
+            continue
+        stat = os.stat(path)
+        stamp = [stat.st_mtime_ns, stat.st_size]
+        entry = index["apkindexes"].get(path)
+        if not entry or entry["stat"] != stamp:
+            logging.verbose(f"rdepends: parsing {path}")
+            entry = {"stat": stamp, "packages": parse_apkindex(path)}
+            changed = True
+        apkindexes[path] = entry
+    changed = changed or len(apkindexes) != len(index["apkindexes"])
+    index["apkindexes"] = apkindexes
+
+    if changed:
+        path = get_index_path(args, arch)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.new", "w") as handle:
+            json.dump(index, handle)
+        os.replace(f"{path}.new", path)
+
+    pmb.helpers.other.cache[cache_key][arch] = index
+    return index
+
+
+def get_packages(args, arch):
+    """:returns: (provides, rdepends) with provides: {pkgname: set of names
+                 provided by the package} and rdepends: {name: set of pkgnames
+                 that depend on it} for all packages in pmaports and the
+                 APKINDEX files"""
+    index = update_index(args, arch)
+    provides = {}
+    rdepends = {}
+    packages = list(index["apkbuilds"].items())
+    for apkindex in index["apkindexes"].values():
+        packages += apkindex["packages"].items()
+
+    for pkgname, package in packages:
+        provides.setdefault(pkgname, {pkgname}).update(package["provides"])
+        for depend in package["depends"]:
+            rdepends.setdefault(depend, set()).add(pkgname)
+    return (provides, rdepends)
+
+
+def get(args, pkgname, arch=None, recursive=False):
+    """Get the packages that depend on a package, or on one of the names it
+    provides (its subpackages, so: names, etc.).
+
+    :param pkgname: package name, e.g. "hello-world"
+    :param arch: architecture of the binary packages, default: native
+    :param recursive: also get the packages that depend on these packages,
+                      and so on
+    :returns: sorted list of pmaports pkgnames and binary package names
+    """
+    arch = arch or pmb.config.arch_native
+    provides, rdepends = get_packages(args, arch)
+    ret = set()
+    queue = [pkgname]
+    while queue:
+        name = queue.pop()
+        for provided in provides.get(name, {name}):
+            for rdepend in rdepends.get(provided, []):
+                if rdepend == pkgname or rdepend in ret:
+                    continue
+                ret.add(rdepend)
+                if recursive:
+                    queue.append(rdepend)
+    return sorted(ret)
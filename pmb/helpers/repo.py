@@ -11,6 +11,8 @@ import os
 import hashlib
 import logging
 import pmb.config.pmaports
+import pmb.helpers.cli
+import pmb.helpers.file
 import pmb.helpers.http
 import pmb.helpers.run
 
@@ -3,8 +3,11 @@
 import logging
 import glob
 
+import pmb.build
+import pmb.chroot
 import pmb.config.pmaports
 import pmb.helpers.repo
+import pmb.parse.apkindex
 
 
 progress_done = 0
@@ -1,10 +1,16 @@
 # Copyright 2023 Oliver Smith
 # SPDX-License-Identifier: GPL-3.0-or-later
+import json
 import logging
+import os
 
 import pmb.build
+import pmb.config.pmaports
+import pmb.helpers.git
 import pmb.helpers.package
 import pmb.helpers.pmaports
+import pmb.helpers.repo
+import pmb.parse.apkindex
 
 
 def filter_missing_packages(args, arch, pkgnames):
@@ -112,12 +118,170 @@ def generate_output_format(args, arch, pkgnames):
     return ret
 
 
-def generate(args, arch, overview, pkgname=None, built=False):
+def get_state_path(args, arch, built=False):
+    suffix = "_built" if built else ""
+    return f"{args.work}/cache_repo_missing/{arch}{suffix}.json"
+
+
+def get_binary_versions(args, arch, pkgnames):
+    """Get the binary packages providing each pkgname from the APKINDEX
+    files, to find out which ones changed since the last run.
+
+    :param arch: architecture (e.g. "armhf")
+    :param pkgnames: list of package names (e.g. ["hello-world", "test12"])
+    :returns: {pkgname: [[provider, version], ...], ...}
+    """
+    ret = {pkgname: [] for pkgname in pkgnames}
+    for path in pmb.helpers.repo.apkindex_files(args, arch):
+        index = pmb.parse.apkindex.parse(path)
+        for pkgname in pkgnames:
+            for provider, block in index.get(pkgname, {}).items():
+                ret[pkgname].append([provider, block["version"]])
+    return ret
+
+
+def get_provides(args, pkgname):
+    """:returns: sorted list of the pkgname, its subpackages and provides"""
+    apkbuild = pmb.helpers.pmaports.get(args, pkgname)
+    ret = {pkgname}
+    ret.update(apkbuild["subpackages"].keys())
+    ret.update(pmb.helpers.package.remove_operators(provide)
+               for provide in apkbuild["provides"])
+    return sorted(ret)
+
+
+def get_changed_packages(changed, pkgnames):
+    """:param changed: files changed in pmaports, from
+                       pmb.helpers.git.get_changed_files()
+    :param pkgnames: set of package names
+    :returns: set of the pkgnames with files in changed (the aport folders
+              have the same name as the package)
+    """
+    ret = set()
+    for path in changed:
+        ret.update(pkgnames.intersection(path.split("/")[:-1]))
+    return ret
+
+
+def check_packages(args, arch, pkgnames, built, binary):
+    """Check a list of packages like get_relevant_packages() does for all
+    packages, and generate the output format for the relevant ones.
+
+    :param arch: architecture (e.g. "armhf")
+    :param pkgnames: list of package names (e.g. ["hello-world", "test12"])
+    :param built: include packages that have already been built
+    :param binary: from get_binary_versions()
+    :returns: {pkgname: {"provides": [...], "binary": [...], "entry": entry
+              from generate_output_format(), or None if not relevant}, ...}
+    """
+    relevant = filter_arch_packages(args, arch, pkgnames)
+    if built:
+        relevant = filter_aport_packages(args, arch, relevant)
+    else:
+        relevant = filter_missing_packages(args, arch, relevant)
+
+    ret = {}
+    for pkgname in pkgnames:
+        entry = None
+        if pkgname in relevant:
+            entry = generate_output_format(args, arch, [pkgname])[0]
+        ret[pkgname] = {"provides": get_provides(args, pkgname),
+                        "binary": binary[pkgname],
+                        "entry": entry}
+    return ret
+
+
+def get_previous_state(args, arch, built, state):
+    """:param state: "aports" and "channel" of the current run
+    :returns: the state of the previous run, or None if it can't be used"""
+    path = get_state_path(args, arch, built)
+    if not os.path.exists(path):
+        return None
+    with open(path) as handle:
+        try:
+            previous = json.load(handle)
+        except ValueError:
+            logging.debug(f"repo_missing: failed to parse {path}")
+            return None
+    for key, value in state.items():
+        if previous.get(key) != value:
+            logging.debug(f"repo_missing: {key} changed since the last run")
+            return None
+    return previous
+
+
+def get_relevant_packages_incremental(args, arch, built=False):
+    """Like get_relevant_packages() for all packages, but only check the
+    packages again that may have changed since the last run: aports with
+    changes in git (since the pmaports commit of the last run), the packages
+    depending on them, and packages that changed in the APKINDEX files.
+
+    :param arch: architecture (e.g. "armhf")
+    :param built: include packages that have already been built
+    :returns: (pkgnames, packages) with pkgnames like the return value of
+              get_relevant_packages() and packages from check_packages() for
+              all pmaports
+    """
+    state = {"aports": args.aports,
+             "channel": pmb.config.pmaports.read_config(args)["channel"]}
+    commit = pmb.helpers.git.rev_parse(args, args.aports)
+    pkgnames = pmb.helpers.pmaports.get_list(args)
+    binary = get_binary_versions(args, arch, pkgnames)
+
+    todo = set(pkgnames)
+    packages = {}
+    previous = get_previous_state(args, arch, built, state)
+    if previous:
+        changed = pmb.helpers.git.get_changed_files(args, args.aports,
+                                                    previous["commit"])
+        if changed is None:
+            logging.debug("repo_missing: commit of the last run not found")
+        elif "pmaports.cfg" in changed:
+            logging.debug("repo_missing: pmaports.cfg changed")
+        else:
+            packages = previous["packages"]
+            changed = get_changed_packages(changed, set(pkgnames) |
+                                           set(packages))
+
+            # Packages depending on the changed packages
+            provides = set()
+            for pkgname in changed:
+                if pkgname in packages:
+                    provides.update(packages[pkgname]["provides"])
+                if pkgname in binary:
+                    provides.update(get_provides(args, pkgname))
+            rdepends = {pkgname for pkgname, package in packages.items()
+                        if package["entry"] and
+                        provides.intersection(package["entry"]["depends"])}
+
+            todo = {pkgname for pkgname in pkgnames
+                    if pkgname in changed or pkgname in rdepends or
+                    pkgname not in packages or
+                    packages[pkgname]["binary"] != binary[pkgname]}
+
+    logging.info(f"Checking {len(todo)} of {len(pkgnames)} packages")
+    packages.update(check_packages(args, arch, sorted(todo), built, binary))
+    packages = {pkgname: packages[pkgname] for pkgname in pkgnames}
+
+    path = get_state_path(args, arch, built)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.new", "w") as handle:
+        json.dump(dict(state, commit=commit, packages=packages), handle)
+    os.replace(f"{path}.new", path)
+
+    ret = [pkgname for pkgname in pkgnames if packages[pkgname]["entry"]]
+    return (ret, packages)
+
+
+def generate(args, arch, overview, pkgname=None, built=False,
+             incremental=False):
     """Get packages that need to be built, with all their dependencies.
 
     :param arch: architecture (e.g. "armhf")
     :param pkgname: only look at a specific package
     :param built: include packages that have already been built
+    :param incremental: only check the packages that changed since the last
+                        run (see get_relevant_packages_incremental())
     :returns: a list like the following:
         [{"pkgname": "hello-world", "repo": "main", "version": "1-r4"},
         {"pkgname": "package-depending-on-hello-world", "version": "0.5-r0", "repo": "main"}]
@@ -127,6 +291,15 @@ def generate(args, arch, overview, pkgname=None, built=False):
     logging.info("Calculate packages that need to be built ({}, {})"
                  "".format(packages_str, arch))
 
+    if incremental:
+        if pkgname:
+            raise RuntimeError("--incremental can only be used for all"
+                               " packages, not with a specific package")
+        ret, packages = get_relevant_packages_incremental(args, arch, built)
+        if overview:
+            return ret
+        return [packages[pkgname]["entry"] for pkgname in ret]
+
     # Order relevant packages
     ret = get_relevant_packages(args, arch, pkgname, built)
 
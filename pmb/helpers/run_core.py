@@ -15,6 +15,14 @@ import pmb.helpers.run
    core() at the bottom. All other functions in this file get (indirectly)
    called by core(). """
 
+# Output of processes in foreground_pipe() gets read in chunks of this size
+pipe_read_size = 64 * 1024
+
+# Flush the log (and stdout) when this amount of seconds has passed or this
+# amount of bytes has been read since the last flush
+pipe_flush_interval = 0.1
+pipe_flush_size = 1024 * 1024
+
 
 def flat_cmd(cmd, working_dir=None, env={}):
     """Convert a shell command passed as list into a flat shell string with proper escaping.
@@ -82,33 +90,49 @@ def pipe(cmd, working_dir=None):
 
 def pipe_read(process, output_to_stdout=False, output_return=False,
               output_return_buffer=False):
-    """Read all output from a subprocess, copy it to the log and optionally stdout and a buffer variable.
+    """Read all currently available output from a subprocess, copy it to the log and optionally stdout and a buffer variable.
 
-    This is only meant to be called by foreground_pipe() below.
+    The output is read in chunks of pipe_read_size bytes (not line by line)
+    and written to the buffered log file and stdout, without flushing them.
+    Use pipe_flush() for that. This is only meant to be called by
+    foreground_pipe() below.
 
-    :param process: subprocess.Popen instance
+    :param process: subprocess.Popen instance, with non-blocking stdout
     :param output_to_stdout: copy all output to pmbootstrap's stdout
     :param output_return: when set to True, output_return_buffer will be
                           extended
     :param output_return_buffer: list of bytes that gets extended with the
                                  current output in case output_return is True.
+    :returns: amount of bytes read
     """
+    handle = process.stdout.fileno()
+    ret = 0
     while True:
         # Copy available output
-        out = process.stdout.readline()
+        try:
+            out = os.read(handle, pipe_read_size)
+        except BlockingIOError:
+            out = b""
         if len(out):
-            pmb.helpers.logging.logfd.buffer.write(out)
+            pmb.helpers.logging.write(out)
             if output_to_stdout:
                 sys.stdout.buffer.write(out)
             if output_return:
                 output_return_buffer.append(out)
+            ret += len(out)
             continue
 
-        # No more output (flush buffers)
+        # No more output
+        return ret
+
+
+def pipe_flush(output_to_stdout=False):
+    """Flush the log file and optionally stdout after pipe_read(). The log
+    file only needs to be flushed if it isn't written by the log thread."""
+    if not pmb.helpers.logging.logqueue:
         pmb.helpers.logging.logfd.flush()
-        if output_to_stdout:
-            sys.stdout.flush()
-        return
+    if output_to_stdout:
+        sys.stdout.flush()
 
 
 def kill_process_tree(args, pid, ppids, sudo):
@@ -179,34 +203,53 @@ def foreground_pipe(args, cmd, working_dir=None, output_to_stdout=False,
     flags = fcntl.fcntl(handle, fcntl.F_GETFL)
     fcntl.fcntl(handle, fcntl.F_SETFL, flags | os.O_NONBLOCK)
 
-    # While process exists wait for output (with timeout)
+    # While process exists wait for output (with timeout). The log file and
+    # stdout get flushed after pipe_flush_interval seconds or when
+    # pipe_flush_size bytes have been read since the last flush, instead of
+    # after each read.
     output_buffer = []
     sel = selectors.DefaultSelector()
     sel.register(process.stdout, selectors.EVENT_READ)
     timeout = args.timeout if output_timeout else None
+    last_output = last_flush = time.perf_counter()
+    unflushed = 0
     while process.poll() is None:
-        wait_start = time.perf_counter() if output_timeout else None
-        sel.select(timeout)
+        select_timeout = timeout
+        if unflushed and (timeout is None or timeout > pipe_flush_interval):
+            select_timeout = pipe_flush_interval
+        sel.select(select_timeout)
+
+        # Read all currently available output
+        size = pipe_read(process, output_to_stdout, output_return,
+                         output_buffer)
+        now = time.perf_counter()
+        if size:
+            last_output = now
+            unflushed += size
 
         # On timeout raise error (we need to measure time on our own, because
         # select() may exit early even if there is no data to read and the
         # timeout was not reached.)
-        if output_timeout:
-            wait_end = time.perf_counter()
-            if wait_end - wait_start >= args.timeout:
-                logging.info("Process did not write any output for " +
-                             str(args.timeout) + " seconds. Killing it.")
-                logging.info("NOTE: The timeout can be increased with"
-                             " 'pmbootstrap -t'.")
-                kill_command(args, process.pid, sudo)
-                continue
+        elif output_timeout and now - last_output >= args.timeout:
+            pipe_flush(output_to_stdout)
+            unflushed = 0
+            logging.info("Process did not write any output for " +
+                         str(args.timeout) + " seconds. Killing it.")
+            logging.info("NOTE: The timeout can be increased with"
+                         " 'pmbootstrap -t'.")
+            kill_command(args, process.pid, sudo)
+            last_output = now
+            continue
 
-        # Read all currently available output
-        pipe_read(process, output_to_stdout, output_return,
-                  output_buffer)
+        if unflushed and (unflushed >= pipe_flush_size or
+                          now - last_flush >= pipe_flush_interval):
+            pipe_flush(output_to_stdout)
+            unflushed = 0
+            last_flush = now
 
     # There may still be output after the process quit
     pipe_read(process, output_to_stdout, output_return, output_buffer)
+    pipe_flush(output_to_stdout)
 
     # Return the return code and output (the output gets built as list of
     # output chunks and combined at the end, this is faster than extending the
@@ -350,6 +393,9 @@ def core(args, log_message, cmd, working_dir=None, output="log",
     logging.debug(log_message)
     logging.verbose("run: " + str(cmd))
 
+    # Write queued log messages before the command's output
+    pmb.helpers.logging.flush()
+
     # Background
     if output == "background":
         return background(cmd, working_dir)
@@ -2,6 +2,7 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 import os
 import glob
+import importlib
 import pmb.helpers.pmaports
 import pmb.parse
 
@@ -12,6 +13,7 @@ def list(args, arch):
     :param arch: device architecture, for which the UIs must be available
     :returns: [("none", "No graphical..."), ("weston", "Wayland reference...")]
     """
+    importlib.import_module("pmb.helpers.package")
     ret = [("none", "Bare minimum OS image for testing and manual"
                     " customization. The \"console\" UI should be selected if"
                     " a graphical UI is not desired.")]
@@ -7,6 +7,7 @@ import glob
 import shlex
 import sys
 
+import pmb.build
 import pmb.chroot
 import pmb.chroot.apk
 import pmb.chroot.other
@@ -16,6 +17,8 @@ import pmb.config.pmaports
 import pmb.helpers.devices
 import pmb.helpers.run
 import pmb.install.blockdevice
+import pmb.install.image
+import pmb.install.sparse
 import pmb.install.recovery
 import pmb.install.ui
 import pmb.install
@@ -152,11 +155,13 @@ def copy_files_from_chroot(args, suffix):
                         working_dir=mountpoint)
 
 
-def create_home_from_skel(args):
+def create_home_from_skel(args, rootfs="/mnt/install"):
     """
     Create /home/{user} from /etc/skel
+
+    :param rootfs: path to the root file system inside the native chroot
     """
-    rootfs = args.work + "/chroot_native/mnt/install"
+    rootfs = f"{args.work}/chroot_native{rootfs}"
     # In btrfs, home subvol & home dir is created in format.py
     if args.filesystem != "btrfs":
         pmb.helpers.run.root(args, ["mkdir", rootfs + "/home"])
@@ -168,11 +173,13 @@ def create_home_from_skel(args):
     pmb.helpers.run.root(args, ["chown", "-R", "10000", homedir])
 
 
-def configure_apk(args):
+def configure_apk(args, rootfs="/mnt/install"):
     """
     Copy over all official keys, and the keys used to compile local packages
     (unless --no-local-pkgs is set). Then copy the corresponding APKINDEX files
     and remove the /mnt/pmbootstrap/packages repository.
+
+    :param rootfs: path to the root file system inside the native chroot
     """
     # Official keys
     pattern = f"{pmb.config.apk_keys_path}/*.pub"
@@ -182,7 +189,7 @@ def configure_apk(args):
         pattern = f"{args.work}/config_apk_keys/*.pub"
 
     # Copy over keys
-    rootfs = args.work + "/chroot_native/mnt/install"
+    rootfs = f"{args.work}/chroot_native{rootfs}"
     for key in glob.glob(pattern):
         pmb.helpers.run.root(args, ["cp", key, rootfs + "/etc/apk/keys/"])
 
@@ -292,9 +299,11 @@ def setup_login(args, suffix):
         pmb.chroot.root(args, ["passwd", "-l", "root"], suffix)
 
 
-def copy_ssh_keys(args):
+def copy_ssh_keys(args, rootfs="/mnt/install"):
     """
     If requested, copy user's SSH public keys to the device if they exist
+
+    :param rootfs: path to the root file system inside the native chroot
     """
     if not args.ssh_keys:
         return
@@ -315,7 +324,7 @@ def copy_ssh_keys(args):
         outfile.write("%s" % key)
     outfile.close()
 
-    target = f"{args.work}/chroot_native/mnt/install/home/{args.user}/.ssh"
+    target = f"{args.work}/chroot_native{rootfs}/home/{args.user}/.ssh"
     pmb.helpers.run.root(args, ["mkdir", target])
     pmb.helpers.run.root(args, ["chmod", "700", target])
     pmb.helpers.run.root(args, ["cp", authorized_keys, target +
@@ -582,7 +591,7 @@ def generate_binary_list(args, suffix, step):
     return binary_list
 
 
-def embed_firmware(args, suffix):
+def embed_firmware(args, suffix, target="/dev/install"):
     """
     This method will embed firmware, located at /usr/share, that are specified
     by the "sd_embed_firmware" deviceinfo parameter into the SD card image
@@ -592,6 +601,7 @@ def embed_firmware(args, suffix):
 
     :param suffix: of the chroot, which holds the firmware files (either the
                    f"rootfs_{args.device}", or f"installer_{args.device}")
+    :param target: block device or image file inside the native chroot
     """
     if not args.deviceinfo["sd_embed_firmware"]:
         return
@@ -614,8 +624,9 @@ def embed_firmware(args, suffix):
         logging.info("Embed firmware {} in the SD card image at offset {} with"
                      " step size {}".format(binary, offset, step))
         filename = os.path.join(device_rootfs, binary_file.lstrip("/"))
-        pmb.chroot.root(args, ["dd", "if=" + filename, "of=/dev/install",
-                               "bs=" + str(step), "seek=" + str(offset)])
+        pmb.chroot.root(args, ["dd", "if=" + filename, "of=" + target,
+                               "bs=" + str(step), "seek=" + str(offset),
+                               "conv=notrunc"])
 
 
 def write_cgpt_kpart(args, layout, suffix):
@@ -760,12 +771,15 @@ def create_crypttab(args, layout, suffix):
     pmb.chroot.root(args, ["mv", "/tmp/crypttab", "/etc/crypttab"], suffix)
 
 
-def create_fstab(args, layout, suffix):
+def create_fstab(args, layout, suffix, uuids=None):
     """
     Create /etc/fstab config
 
     :param layout: partition layout from get_partition_layout()
     :param suffix: of the chroot, which fstab will be created to
+    :param uuids: UUIDs of the file systems that will be created, e.g.
+                  {"boot": "...", "root": "..."} (default: get them with
+                  blkid from the partitions)
     """
 
     # Do not install fstab into target rootfs when using on-device
@@ -773,12 +787,14 @@ def create_fstab(args, layout, suffix):
     if args.on_device_installer and "rootfs_" in suffix:
         return
 
-    boot_dev = f"/dev/installp{layout['boot']}"
-    root_dev = f"/dev/installp{layout['root']}"
+    if not uuids:
+        uuids = {"boot": get_uuid(args, f"/dev/installp{layout['boot']}")}
+        if not args.full_disk_encryption:
+            uuids["root"] = get_uuid(args, f"/dev/installp{layout['root']}")
 
-    boot_mount_point = f"UUID={get_uuid(args, boot_dev)}"
+    boot_mount_point = f"UUID={uuids['boot']}"
     root_mount_point = "/dev/mapper/root" if args.full_disk_encryption \
-        else f"UUID={get_uuid(args, root_dev)}"
+        else f"UUID={uuids['root']}"
 
     boot_options = "nodev,nosuid,noexec"
     boot_filesystem = args.deviceinfo["boot_filesystem"] or "ext2"
@@ -813,6 +829,59 @@ def create_fstab(args, layout, suffix):
     pmb.chroot.root(args, ["mv", "/tmp/fstab", "/etc/fstab"], suffix)
 
 
+def mkinitfs_and_umount(args, suffix):
+    """
+    Run mkinitfs to pass UUIDs to cmdline, then clean up the rootfs chroot so
+    it can be copied to the image.
+
+    :param suffix: of the rootfs chroot (e.g. "rootfs_qemu-amd64")
+    """
+    logging.info(f"({suffix}) mkinitfs")
+    pmb.chroot.root(args, ["mkinitfs"], suffix)
+
+    # Clean up after running mkinitfs in chroot
+    pmb.helpers.mount.umount_all(args, f"{args.work}/chroot_{suffix}")
+    pmb.helpers.run.root(args, ["rm", f"{args.work}/chroot_{suffix}/in-pmbootstrap"])
+    pmb.chroot.remove_mnt_pmbootstrap(args, suffix)
+
+
+def make_sparse_image(args, split, disk):
+    """
+    Convert the rootfs image to the Android sparse format, if the device or
+    --sparse requests it.
+
+    :param split: separate images for boot and root partitions were created
+    :param disk: path to disk block device (e.g. /dev/mmcblk0) or None
+    """
+    sparse = args.sparse
+    if sparse is None:
+        sparse = args.deviceinfo["flash_sparse"] == "true"
+    if not sparse or split or disk:
+        return
+
+    # Convert rootfs to sparse, the result only has the size of the data in
+    # the image (see pmb.install.sparse)
+    logging.info("(native) make sparse rootfs")
+    sys_image = f"/home/pmos/rootfs/{args.device}.img"
+    sys_image_sparse = f"/tmp/{args.device}-sparse.img"
+    pmb.install.sparse.convert(f"{args.work}/chroot_native{sys_image}",
+                               f"{args.work}/chroot_native{sys_image_sparse}")
+    pmb.chroot.root(args, ["mv", "-f", sys_image_sparse, sys_image])
+
+    # patch sparse image for Samsung devices if specified
+    samsungify_strategy = args.deviceinfo["flash_sparse_samsung_format"]
+    if samsungify_strategy:
+        logging.info("(native) convert sparse image into Samsung's sparse image format")
+        pmb.chroot.apk.install(args, ["sm-sparse-image-tool"])
+        sys_image = f"{args.device}.img"
+        sys_image_patched = f"{args.device}-patched.img"
+        pmb.chroot.user(args, ["sm_sparse_image_tool", "samsungify", "--strategy",
+                               samsungify_strategy, sys_image, sys_image_patched],
+                        working_dir="/home/pmos/rootfs/")
+        pmb.chroot.user(args, ["mv", "-f", sys_image_patched, sys_image],
+                        working_dir="/home/pmos/rootfs/")
+
+
 def install_system_image(args, size_reserve, suffix, step, steps,
                          boot_label="pmOS_boot", root_label="pmOS_root",
                          split=False, disk=None):
@@ -827,12 +896,40 @@ def install_system_image(args, size_reserve, suffix, step, steps,
     :param split: create separate images for boot and root partitions
     :param disk: path to disk block device (e.g. /dev/mmcblk0) or None
     """
+    if args.direct_image:
+        pmb.install.image.create(args, size_reserve, suffix, step, steps,
+                                 boot_label, root_label, split)
+        make_sparse_image(args, split, disk)
+        return
+
     # Partition and fill image file/disk block device
     logging.info(f"*** ({step}/{steps}) PREPARE INSTALL BLOCKDEVICE ***")
     pmb.chroot.shutdown(args, True)
     (size_boot, size_root) = get_subpartitions_size(args, suffix)
     layout = get_partition_layout(size_reserve, args.deviceinfo["cgpt_kpart"] \
              and args.install_cgpt)
+
+    # Update the image file(s) of the previous installation with --rsync
+    image_state = None
+    if not disk:
+        image_state = pmb.install.blockdevice.get_image_state(
+            args, layout, size_boot, size_root, size_reserve, boot_label,
+            root_label, split)
+        if args.rsync:
+            previous = pmb.install.blockdevice.get_previous_image_state(
+                args, image_state)
+            if previous:
+                logging.info("(native) update the previous image with rsync")
+                image_state = previous
+                pmb.install.blockdevice.mount_image(args, split)
+                if not split:
+                    pmb.chroot.root(args, ["partx", "-a", "/dev/install"],
+                                    check=False)
+            else:
+                logging.info("NOTE: the previous image can't be updated (see"
+                             " 'pmbootstrap log'), creating a new one")
+                args.rsync = False
+
     if not args.rsync:
         pmb.install.blockdevice.create(args, size_boot, size_root,
                                        size_reserve, split, disk)
@@ -854,14 +951,7 @@ def install_system_image(args, size_reserve, suffix, step, steps,
         logging.info("(native) create /etc/crypttab")
         create_crypttab(args, layout, suffix)
 
-    # Run mkinitfs to pass UUIDs to cmdline
-    logging.info(f"({suffix}) mkinitfs")
-    pmb.chroot.root(args, ["mkinitfs"], suffix)
-
-    # Clean up after running mkinitfs in chroot
-    pmb.helpers.mount.umount_all(args, f"{args.work}/chroot_{suffix}")
-    pmb.helpers.run.root(args, ["rm", f"{args.work}/chroot_{suffix}/in-pmbootstrap"])
-    pmb.chroot.remove_mnt_pmbootstrap(args, suffix)
+    mkinitfs_and_umount(args, suffix)
 
     # Just copy all the files
     logging.info(f"*** ({step + 1}/{steps}) FILL INSTALL BLOCKDEVICE ***")
@@ -881,33 +971,9 @@ def install_system_image(args, size_reserve, suffix, step, steps,
                      "to sync, please wait)")
     pmb.chroot.shutdown(args, True)
 
-    # Convert rootfs to sparse using img2simg
-    sparse = args.sparse
-    if sparse is None:
-        sparse = args.deviceinfo["flash_sparse"] == "true"
-
-    if sparse and not split and not disk:
-        logging.info("(native) make sparse rootfs")
-        pmb.chroot.apk.install(args, ["android-tools"])
-        sys_image = args.device + ".img"
-        sys_image_sparse = args.device + "-sparse.img"
-        pmb.chroot.user(args, ["img2simg", sys_image, sys_image_sparse],
-                        working_dir="/home/pmos/rootfs/")
-        pmb.chroot.user(args, ["mv", "-f", sys_image_sparse, sys_image],
-                        working_dir="/home/pmos/rootfs/")
-
-        # patch sparse image for Samsung devices if specified
-        samsungify_strategy = args.deviceinfo["flash_sparse_samsung_format"]
-        if samsungify_strategy:
-            logging.info("(native) convert sparse image into Samsung's sparse image format")
-            pmb.chroot.apk.install(args, ["sm-sparse-image-tool"])
-            sys_image = f"{args.device}.img"
-            sys_image_patched = f"{args.device}-patched.img"
-            pmb.chroot.user(args, ["sm_sparse_image_tool", "samsungify", "--strategy",
-                                   samsungify_strategy, sys_image, sys_image_patched],
-                            working_dir="/home/pmos/rootfs/")
-            pmb.chroot.user(args, ["mv", "-f", sys_image_patched, sys_image],
-                            working_dir="/home/pmos/rootfs/")
+    if image_state:
+        pmb.install.blockdevice.save_image_state(args, image_state)
+    make_sparse_image(args, split, disk)
 
 
 def print_flash_info(args):
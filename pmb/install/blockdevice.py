@@ -1,12 +1,14 @@
 # Copyright 2023 Oliver Smith
 # SPDX-License-Identifier: GPL-3.0-or-later
+import glob
+import json
 import logging
 import os
-import glob
 import pmb.helpers.mount
 import pmb.install.losetup
 import pmb.helpers.cli
 import pmb.config
+import pmb.install
 
 
 def previous_install(args, path):
@@ -111,13 +113,31 @@ def create_and_mount_image(args, size_boot, size_root, size_reserve,
                      f"({size_mb})")
         pmb.chroot.root(args, ["truncate", "-s", size_mb, img_path])
 
-    # Mount to /dev/install
-    mount_image_paths = {img_path_full: "/dev/install"}
+    mount_image(args, split)
+
+
+def get_image_paths(args, split=False):
+    """
+    :param split: separate images for boot and root partitions
+    :returns: dict of image paths inside the native chroot to the block
+              device they get mounted to, e.g.
+              {"/home/pmos/rootfs/qemu-amd64.img": "/dev/install"}
+    """
+    img_path_prefix = "/home/pmos/rootfs/" + args.device
     if split:
-        mount_image_paths = {img_path_boot: "/dev/installp1",
-                             img_path_root: "/dev/installp2"}
+        return {f"{img_path_prefix}-boot.img": "/dev/installp1",
+                f"{img_path_prefix}-root.img": "/dev/installp2"}
+    return {f"{img_path_prefix}.img": "/dev/install"}
+
 
-    for img_path, mount_point in mount_image_paths.items():
+def mount_image(args, split=False):
+    """
+    Mount existing image file(s) as /dev/install (or /dev/installp1 and
+    /dev/installp2 for split images).
+
+    :param split: separate images for boot and root partitions
+    """
+    for img_path, mount_point in get_image_paths(args, split).items():
         logging.info("(native) mount " + mount_point +
                      " (" + os.path.basename(img_path) + ")")
         pmb.install.losetup.mount(args, img_path)
@@ -126,6 +146,111 @@ def create_and_mount_image(args, size_boot, size_root, size_reserve,
                                     args.work + "/chroot_native" + mount_point)
 
 
+def get_image_state(args, layout, size_boot, size_root, size_reserve,
+                    boot_label, root_label, split=False):
+    """
+    Describe the image file(s) that install_system_image() creates, so the
+    next "pmbootstrap install --rsync" can tell if they can be reused.
+
+    :param layout: partition layout from get_partition_layout()
+    :param size_boot: size of the boot partition in MiB
+    :param size_root: size of the root partition in MiB
+    :param size_reserve: empty partition between root and boot in MiB (pma#463)
+    :param boot_label: label of the boot partition (e.g. "pmOS_boot")
+    :param root_label: label of the root partition (e.g. "pmOS_root")
+    :param split: separate images for boot and root partitions
+    :returns: dict, e.g. {"layout": {...}, "size_root": 1234, ...,
+              "images": {}}. "images" gets filled by save_image_state().
+    """
+    return {"layout": layout,
+            "split": split,
+            "size_boot": round(size_boot),
+            "size_reserve": round(size_reserve),
+            "size_root": round(size_root),
+            "boot_label": boot_label,
+            "root_label": root_label,
+            "boot_filesystem": args.deviceinfo["boot_filesystem"] or "ext2",
+            "root_filesystem": pmb.install.get_root_filesystem(args),
+            "boot_part_start": args.deviceinfo["boot_part_start"] or "2048",
+            "partition_type": args.deviceinfo["partition_type"] or "msdos",
+            "images": {}}
+
+
+def get_image_state_path(args):
+    return f"{args.work}/cache_install/{args.device}.json"
+
+
+def get_image_stats(args, split=False):
+    """
+    :returns: {img_path: [size, mtime_ns]} of the existing image file(s),
+              or None if one of them is missing
+    """
+    ret = {}
+    for img_path in get_image_paths(args, split):
+        path = f"{args.work}/chroot_native{img_path}"
+        if not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        ret[img_path] = [stat.st_size, stat.st_mtime_ns]
+    return ret
+
+
+def save_image_state(args, state):
+    """
+    Remember the state of the image file(s) after creating or updating them.
+
+    :param state: from get_image_state()
+    """
+    state = dict(state)
+    state["images"] = get_image_stats(args, state["split"])
+    path = get_image_state_path(args)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as handle:
+        json.dump(state, handle)
+
+
+def get_previous_image_state(args, state):
+    """
+    Check if the image file(s) from the previous installation can be updated
+    in place, instead of creating new ones. This is the case if they were not
+    modified since (e.g. by converting them to a sparse image), were created
+    with the same partition layout, labels and file systems, and the root
+    partition is still big enough.
+
+    :param state: for the new installation, from get_image_state()
+    :returns: state of the previous image, or None if it can't be reused
+    """
+    path = get_image_state_path(args)
+    if not os.path.exists(path):
+        logging.debug("Previous image: no state file found")
+        return None
+    with open(path) as handle:
+        try:
+            previous = json.load(handle)
+        except ValueError:
+            logging.debug(f"Previous image: failed to parse {path}")
+            return None
+
+    for key, value in state.items():
+        if key in ["images", "size_root"]:
+            continue
+        if previous.get(key) != value:
+            logging.debug(f"Previous image: {key} changed ({previous.get(key)}"
+                          f" -> {value})")
+            return None
+
+    if previous["size_root"] < state["size_root"]:
+        logging.debug("Previous image: root partition too small"
+                      f" ({previous['size_root']}M < {state['size_root']}M)")
+        return None
+
+    if previous["images"] != get_image_stats(args, state["split"]):
+        logging.debug("Previous image: image file(s) missing or modified")
+        return None
+
+    return previous
+
+
 def create(args, size_boot, size_root, size_reserve, split, disk):
     """
     Create /dev/install (the "install blockdevice").
@@ -158,9 +158,8 @@ def format_and_mount_root(args, device, root_label, disk):
     :param disk: path to disk block device (e.g. /dev/mmcblk0) or None
     """
     # Format
+    filesystem = get_root_filesystem(args)
     if not args.rsync:
-        filesystem = get_root_filesystem(args)
-
         if filesystem == "ext4":
             # Some downstream kernels don't support metadata_csum (#1364).
             # When changing the options of mkfs.ext4, also change them in the
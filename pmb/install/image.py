@@ -0,0 +1,330 @@
+# Copyright 2023 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""Create the disk image without loop devices (pmbootstrap install
+--direct-image).
+
+Instead of partitioning a loop device, formatting and mounting the partitions
+and copying the rootfs into them, the file systems get created from a
+directory with the rootfs content (mkfs.ext4 -d, mkfs.fat + mcopy). They are
+written directly at the offsets of their partitions in the image file, so
+nothing gets mounted and the files are only copied once.
+"""
+import logging
+import os
+import uuid
+
+import pmb.chroot
+import pmb.chroot.apk
+import pmb.config
+import pmb.helpers.run
+import pmb.install
+import pmb.install._install
+import pmb.install.losetup
+import pmb.parse.arch
+from pmb.install.format import install_fsprogs
+
+
+def check_supported(args):
+    """Make sure that --direct-image works with the selected options and the
+    device, before spending time on creating the rootfs.
+
+    :raises ValueError: with the reason why it can't be used
+    """
+    reasons = []
+    if args.disk:
+        reasons += ["--disk (only image files are supported)"]
+    if args.rsync:
+        reasons += ["--rsync"]
+    if args.full_disk_encryption:
+        reasons += ["--fde"]
+    if args.deviceinfo["cgpt_kpart"] and args.install_cgpt:
+        reasons += ["ChromeOS kernel partition (use --no-cgpt)"]
+    if args.deviceinfo["rootfs_image_sector_size"]:
+        reasons += ["deviceinfo_rootfs_image_sector_size"]
+
+    root_filesystem = pmb.install.get_root_filesystem(args)
+    if root_filesystem != "ext4":
+        reasons += [f"root filesystem {root_filesystem}"]
+    boot_filesystem = args.deviceinfo["boot_filesystem"] or "ext2"
+    if boot_filesystem not in ["ext2", "fat16", "fat32"]:
+        reasons += [f"boot filesystem {boot_filesystem}"]
+
+    if reasons:
+        raise ValueError("--direct-image cannot be used with: " +
+                         ", ".join(reasons))
+
+
+def get_uuids(args):
+    """Generate the UUIDs of the file systems before creating them, so they
+    can be written to /etc/fstab.
+
+    :returns: {"boot": "XXXX-XXXX", "root": "01234567-89ab-cdef-..."}, the
+              boot UUID is a FAT volume ID or a regular UUID for ext2
+    """
+    boot_filesystem = args.deviceinfo["boot_filesystem"] or "ext2"
+    if boot_filesystem in ["fat16", "fat32"]:
+        volume_id = uuid.uuid4().hex[:8].upper()
+        boot = f"{volume_id[:4]}-{volume_id[4:]}"
+    else:
+        boot = str(uuid.uuid4())
+    return {"boot": boot, "root": str(uuid.uuid4())}
+
+
+def get_partitions(args, layout, size_boot, size_root, size_reserve,
+                   split=False):
+    """Calculate where the partitions are in the image file(s).
+
+    :param layout: partition layout from get_partition_layout()
+    :param size_boot: size of the boot partition in MiB
+    :param size_root: size of the root partition in MiB
+    :param size_reserve: empty partition between root and boot in MiB (pma#463)
+    :param split: create separate images for boot and root partitions
+    :returns: dict of partition name ("boot", "reserve", "root") to a dict
+              with the image path inside the native chroot, the first and
+              last sector (512 bytes) inside that image file, and the total
+              size of the image file in bytes, e.g.:
+              {"boot": {"img": "/home/pmos/rootfs/qemu-amd64.img",
+                        "start": 2048, "end": 262143,
+                        "img_size": 1048576000}, ...}
+    """
+    sector = 512
+    mib = 1024 * 1024 // sector
+    img_prefix = f"/home/pmos/rootfs/{args.device}"
+    mib_boot = round(size_boot)
+    mib_reserve = round(size_reserve)
+    mib_root = round(size_root)
+
+    if split:
+        return {"boot": {"img": f"{img_prefix}-boot.img",
+                         "start": 0,
+                         "end": mib_boot * mib - 1,
+                         "img_size": mib_boot * mib * sector},
+                "root": {"img": f"{img_prefix}-root.img",
+                         "start": 0,
+                         "end": mib_root * mib - 1,
+                         "img_size": mib_root * mib * sector}}
+
+    img = f"{img_prefix}.img"
+    img_size = round(size_boot + size_reserve + size_root) * mib * sector
+    boot_part_start = int(args.deviceinfo["boot_part_start"] or "2048")
+    partition_type = args.deviceinfo["partition_type"] or "msdos"
+
+    # The backup GPT is in the last 33 sectors of the disk
+    end = img_size // sector - 1
+    if partition_type.lower() == "gpt":
+        end -= 33
+
+    ret = {"boot": {"start": boot_part_start,
+                    "end": mib_boot * mib - 1}}
+    if layout["reserve"]:
+        ret["reserve"] = {"start": mib_boot * mib,
+                          "end": (mib_boot + mib_reserve) * mib - 1}
+    ret["root"] = {"start": (mib_boot + mib_reserve) * mib,
+                   "end": end}
+
+    for name, partition in ret.items():
+        if partition["start"] >= partition["end"]:
+            raise RuntimeError(f"Not enough space for the {name} partition in"
+                               f" the image (start: {partition['start']},"
+                               f" end: {partition['end']})")
+        partition["img"] = img
+        partition["img_size"] = img_size
+    return ret
+
+
+def create_images(args, partitions, split=False):
+    """Create the empty image file(s) and the partition table.
+
+    :param partitions: from get_partitions()
+    :param split: create separate images for boot and root partitions
+    """
+    # Delete existing images
+    for img_path in [f"/home/pmos/rootfs/{args.device}{suffix}.img"
+                     for suffix in ["", "-boot", "-root"]]:
+        if os.path.exists(f"{args.work}/chroot_native{img_path}"):
+            pmb.install.losetup.umount(args, img_path)
+            pmb.chroot.root(args, ["rm", img_path])
+
+    # Make sure there is enough free space
+    images = {p["img"]: p["img_size"] for p in partitions.values()}
+    size_mb = round(sum(images.values()) / 1024 / 1024)
+    disk_data = os.statvfs(args.work)
+    free = round((disk_data.f_bsize * disk_data.f_bavail) / (1024**2))
+    if size_mb > free:
+        raise RuntimeError("Not enough free space to create rootfs image! "
+                           f"(free: {free}M, required: {size_mb}M)")
+
+    pmb.chroot.user(args, ["mkdir", "-p", "/home/pmos/rootfs"])
+    for img_path, size in images.items():
+        logging.info(f"(native) create {os.path.basename(img_path)} "
+                     f"({round(size / 1024 / 1024)}M)")
+        pmb.chroot.root(args, ["truncate", "-s", str(size), img_path])
+
+    if split:
+        return
+
+    # Partition the image file directly, no loop device needed
+    img_path = partitions["boot"]["img"]
+    filesystem = args.deviceinfo["boot_filesystem"] or "ext2"
+    partition_type = args.deviceinfo["partition_type"] or "msdos"
+    logging.info(f"(native) partition {os.path.basename(img_path)}")
+    commands = [["mktable", partition_type]]
+    for name, partition in partitions.items():
+        fs_arg = [filesystem] if name == "boot" else []
+        commands += [["mkpart", "primary"] + fs_arg +
+                     [f"{partition['start']}s", f"{partition['end']}s"]]
+    commands += [["set", "1", "boot", "on"]]
+    if partition_type.lower() == "gpt":
+        commands += [["set", "1", "esp", "on"]]
+
+    for command in commands:
+        pmb.chroot.root(args, ["parted", "-s", img_path] + command)
+
+
+def prepare_rootfs_dirs(args, suffix):
+    """Prepare the content of the boot and root file systems in the native
+    chroot. The files are hardlinked to the ones in the rootfs chroot, so
+    this is fast and doesn't use additional space.
+
+    :param suffix: the chroot suffix, where the rootfs that will be installed
+                   on the device has been created (e.g. "rootfs_qemu-amd64")
+    :returns: (boot, root) paths inside the native chroot
+    """
+    chroot = f"{args.work}/chroot_{suffix}"
+    target = "/mnt/image"
+    target_outside = f"{args.work}/chroot_native{target}"
+    boot = f"{target_outside}/boot"
+    root = f"{target_outside}/root"
+
+    logging.info(f"(native) prepare {suffix} content in {target}")
+    pmb.helpers.run.root(args, ["rm", "-rf", target_outside])
+    pmb.helpers.run.root(args, ["mkdir", "-p", target_outside])
+    if pmb.helpers.run.root(args, ["cp", "-al", chroot, root],
+                            check=False):
+        # Different file systems, e.g. the chroot is in a tmpfs
+        logging.info("NOTE: failed to hardlink the rootfs, copying it")
+        pmb.helpers.run.root(args, ["rm", "-rf", root])
+        pmb.helpers.run.root(args, ["cp", "-a", chroot, root])
+
+    # Skip /home (created from /etc/skel later) and hidden files, like
+    # copy_files_from_chroot() does
+    remove = [f"{root}/home"]
+    remove += [f"{root}/{name}" for name in os.listdir(root)
+               if name.startswith(".")]
+
+    # Remove empty qemu-user binary stub (where the binary was bind-mounted)
+    arch_qemu = pmb.parse.arch.alpine_to_qemu(args.deviceinfo["arch"])
+    remove += [f"{root}/usr/bin/qemu-{arch_qemu}-static"]
+
+    # Remove apk progress fifo
+    remove += [f"{root}/tmp/apk_progress_fifo"]
+    pmb.helpers.run.root(args, ["rm", "-rf"] + remove)
+
+    # configure_apk() writes to these, don't modify the files of the chroot
+    keys = f"{root}/etc/apk/keys"
+    if os.path.exists(keys):
+        pmb.helpers.run.root(args, ["rm", "-rf", keys])
+        pmb.helpers.run.root(args, ["cp", "-a", f"{chroot}/etc/apk/keys",
+                                    keys])
+
+    # The boot partition gets mounted at /boot
+    pmb.helpers.run.root(args, ["mv", f"{root}/boot", boot])
+    pmb.helpers.run.root(args, ["mkdir", f"{root}/boot"])
+    return (f"{target}/boot", f"{target}/root")
+
+
+def mkfs_boot(args, partition, path, label, fs_uuid):
+    """Create the boot file system with the content of a directory.
+
+    :param partition: the boot partition from get_partitions()
+    :param path: directory inside the native chroot with the content
+    :param label: label of the boot partition (e.g. "pmOS_boot")
+    :param fs_uuid: from get_uuids()
+    """
+    filesystem = args.deviceinfo["boot_filesystem"] or "ext2"
+    install_fsprogs(args, filesystem)
+    offset = partition["start"] * 512
+    size_kib = (partition["end"] - partition["start"] + 1) // 2
+    img_path = partition["img"]
+
+    logging.info(f"(native) format boot partition ({filesystem}) in"
+                 f" {os.path.basename(img_path)}")
+    if filesystem == "ext2":
+        pmb.chroot.root(args, ["mkfs.ext2", "-F", "-q", "-L", label,
+                               "-U", fs_uuid, "-d", path,
+                               "-E", f"offset={offset},nodiscard",
+                               img_path, f"{size_kib}k"])
+        return
+
+    fat_bits = filesystem[len("fat"):]
+    pmb.chroot.apk.install(args, ["mtools"], build=False)
+    pmb.chroot.root(args, ["mkfs.fat", "-F", fat_bits, "-n", label,
+                           "-i", fs_uuid.replace("-", ""),
+                           "--offset", str(partition["start"]),
+                           img_path, str(size_kib)])
+    files = [f"{path}/{name}" for name in
+             sorted(os.listdir(f"{args.work}/chroot_native{path}"))]
+    if files:
+        pmb.chroot.root(args, ["mcopy", "-s", "-p", "-m", "-Q",
+                               "-i", f"{img_path}@@{offset}"] + files +
+                        ["::/"], env={"MTOOLS_SKIP_CHECK": "1"})
+
+
+def mkfs_root(args, partition, path, label, fs_uuid):
+    """Create the root file system with the content of a directory.
+
+    :param partition: the root partition from get_partitions()
+    :param path: directory inside the native chroot with the content
+    :param label: label of the root partition (e.g. "pmOS_root")
+    :param fs_uuid: from get_uuids()
+    """
+    install_fsprogs(args, "ext4")
+    offset = partition["start"] * 512
+    size_kib = (partition["end"] - partition["start"] + 1) // 2
+    img_path = partition["img"]
+
+    # Same options as in pmb.install.format.format_and_mount_root()
+    logging.info(f"(native) format root partition (ext4) in"
+                 f" {os.path.basename(img_path)}")
+    pmb.chroot.root(args, ["mkfs.ext4", "-O", "^metadata_csum", "-F", "-q",
+                           "-L", label, "-N", "100000", "-U", fs_uuid,
+                           "-d", path, "-E", f"offset={offset},nodiscard",
+                           img_path, f"{size_kib}k"])
+
+
+def create(args, size_reserve, suffix, step, steps, boot_label, root_label,
+           split=False):
+    """Create the image file(s) of install_system_image() without loop
+    devices. See install_system_image() for the parameters.
+
+    :returns: layout from get_partition_layout()
+    """
+    logging.info(f"*** ({step}/{steps}) PREPARE INSTALL IMAGE ***")
+    pmb.chroot.shutdown(args, True)
+    (size_boot, size_root) = pmb.install._install.get_subpartitions_size(
+        args, suffix)
+    layout = pmb.install._install.get_partition_layout(size_reserve, False)
+    partitions = get_partitions(args, layout, size_boot, size_root,
+                                size_reserve, split)
+    create_images(args, partitions, split)
+
+    # Create /etc/fstab with the UUIDs the file systems will get
+    uuids = get_uuids(args)
+    logging.info("(native) create /etc/fstab")
+    pmb.install._install.create_fstab(args, layout, suffix, uuids)
+    pmb.install._install.mkinitfs_and_umount(args, suffix)
+
+    logging.info(f"*** ({step + 1}/{steps}) FILL INSTALL IMAGE ***")
+    boot, root = prepare_rootfs_dirs(args, suffix)
+    pmb.install._install.create_home_from_skel(args, root)
+    pmb.install._install.configure_apk(args, root)
+    pmb.install._install.copy_ssh_keys(args, root)
+
+    mkfs_boot(args, partitions["boot"], boot, boot_label, uuids["boot"])
+    mkfs_root(args, partitions["root"], root, root_label, uuids["root"])
+    pmb.chroot.root(args, ["rm", "-rf", os.path.dirname(root)])
+
+    if not split:
+        pmb.install._install.embed_firmware(args, suffix,
+                                            partitions["boot"]["img"])
+    return layout
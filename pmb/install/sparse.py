@@ -0,0 +1,212 @@
+# Copyright 2023 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""Convert raw disk images to Android's sparse image format.
+
+This is used instead of img2simg from android-tools, which would need to be
+installed in the native chroot. The raw image gets read once: holes in the
+file (which is what most of a freshly created image consists of) are found
+with SEEK_DATA/SEEK_HOLE and become DONT_CARE chunks without reading them.
+Blocks with data are checked for being filled with the same 32-bit value (e.g.
+zeros) and become FILL chunks, all other blocks are copied into RAW chunks.
+
+Format reference: system/core/libsparse/sparse_format.h in AOSP.
+"""
+import errno
+import logging
+import os
+import struct
+
+# sparse_header_t: magic, major_version, minor_version, file_hdr_sz,
+# chunk_hdr_sz, blk_sz, total_blks, total_chunks, image_checksum
+header_format = "<IHHHHIIII"
+header_magic = 0xed26ff3a
+header_size = struct.calcsize(header_format)
+
+# chunk_header_t: chunk_type, reserved1, chunk_sz (in blocks), total_sz (in
+# bytes, including this header)
+chunk_format = "<HHII"
+chunk_size = struct.calcsize(chunk_format)
+chunk_raw = 0xcac1
+chunk_fill = 0xcac2
+chunk_dont_care = 0xcac3
+
+block_size = 4096
+
+# Amount of data that gets read at once, and the maximum size of one RAW
+# chunk (total_sz is a 32-bit field)
+read_size = 1024 * 1024
+raw_chunk_max = 64 * 1024 * 1024
+
+
+def data_ranges(fd, size):
+    """Find the parts of a file that are not holes.
+
+    :param fd: file descriptor of the raw image
+    :param size: size of the file in bytes
+    :returns: generator of (start, end) byte offsets, aligned to the block
+              size. If the file system doesn't support SEEK_DATA, the whole
+              file is returned as one range.
+    """
+    pos = 0
+    while pos < size:
+        try:
+            start = os.lseek(fd, pos, os.SEEK_DATA)
+            end = os.lseek(fd, start, os.SEEK_HOLE)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # No data after pos
+                return
+            if e.errno not in [errno.EINVAL, errno.EOPNOTSUPP]:
+                raise
+            yield (pos, size)
+            return
+        start -= start % block_size
+        end = min(size, end + (-end % block_size))
+        yield (max(start, pos), end)
+        pos = end
+
+
+class Writer:
+    """Write the chunks of a sparse image to a seekable file, merging
+    consecutive chunks of the same type. The header gets written last, when
+    the amount of chunks is known."""
+
+    def __init__(self, handle):
+        self.handle = handle
+        self.total_blocks = 0
+        self.total_chunks = 0
+
+        # Currently open chunk: (type, blocks, fill value or offset of the
+        # RAW chunk's header in the output file)
+        self.chunk = None
+        handle.write(b"\0" * header_size)
+
+    def close_chunk(self):
+        if not self.chunk:
+            return
+        chunk_type, blocks, extra = self.chunk
+        self.chunk = None
+        self.total_chunks += 1
+        self.total_blocks += blocks
+
+        if chunk_type == chunk_raw:
+            header = struct.pack(chunk_format, chunk_raw, 0, blocks,
+                                 chunk_size + blocks * block_size)
+            end = self.handle.tell()
+            self.handle.seek(extra)
+            self.handle.write(header)
+            self.handle.seek(end)
+        elif chunk_type == chunk_fill:
+            self.handle.write(struct.pack(chunk_format, chunk_fill, 0, blocks,
+                                          chunk_size + 4) + extra)
+        else:
+            self.handle.write(struct.pack(chunk_format, chunk_dont_care, 0,
+                                          blocks, chunk_size))
+
+    def dont_care(self, blocks):
+        if not blocks:
+            return
+        if self.chunk and self.chunk[0] == chunk_dont_care:
+            self.chunk = (chunk_dont_care, self.chunk[1] + blocks, None)
+            return
+        self.close_chunk()
+        self.chunk = (chunk_dont_care, blocks, None)
+
+    def fill(self, value, blocks):
+        """:param value: 4 bytes, the block is filled with"""
+        if self.chunk and self.chunk[0] == chunk_fill and \
+                self.chunk[2] == value:
+            self.chunk = (chunk_fill, self.chunk[1] + blocks, value)
+            return
+        self.close_chunk()
+        self.chunk = (chunk_fill, blocks, value)
+
+    def raw(self, data):
+        """:param data: bytes, length must be a multiple of the block size"""
+        while data:
+            if not self.chunk or self.chunk[0] != chunk_raw or \
+                    self.chunk[1] * block_size >= raw_chunk_max:
+                self.close_chunk()
+                self.chunk = (chunk_raw, 0, self.handle.tell())
+                self.handle.write(b"\0" * chunk_size)
+
+            length = min(len(data), raw_chunk_max -
+                         self.chunk[1] * block_size)
+            self.handle.write(data[:length])
+            self.chunk = (chunk_raw, self.chunk[1] + length // block_size,
+                          self.chunk[2])
+            data = data[length:]
+
+    def finish(self):
+        self.close_chunk()
+        self.handle.seek(0)
+        self.handle.write(struct.pack(header_format, header_magic, 1, 0,
+                                      header_size, chunk_size, block_size,
+                                      self.total_blocks, self.total_chunks,
+                                      0))
+
+
+def write_blocks(writer, data):
+    """Add blocks of data from the raw image to the sparse image.
+
+    :param writer: Writer instance
+    :param data: bytes, length must be a multiple of the block size
+    """
+    # Whole buffer filled with the same value (usually zeros). Comparing
+    # bytes objects runs in C (memcmp), so check all at once first.
+    value = data[:4]
+    if data == value * (len(data) // 4):
+        writer.fill(value, len(data) // block_size)
+        return
+
+    words = block_size // 4
+    raw_start = None
+    for offset in range(0, len(data), block_size):
+        block = data[offset:offset + block_size]
+        value = block[:4]
+        if block[-4:] != value or block != value * words:
+            if raw_start is None:
+                raw_start = offset
+            continue
+        if raw_start is not None:
+            writer.raw(data[raw_start:offset])
+            raw_start = None
+        writer.fill(value, 1)
+    if raw_start is not None:
+        writer.raw(data[raw_start:])
+
+
+def convert(path_raw, path_sparse):
+    """Convert a raw image to the Android sparse format.
+
+    :param path_raw: path to the raw image
+    :param path_sparse: path to the sparse image, which gets created
+    :returns: size of the sparse image in bytes
+    """
+    with open(path_raw, "rb") as handle_raw, \
+            open(path_sparse, "wb") as handle_sparse:
+        fd = handle_raw.fileno()
+        size = os.fstat(fd).st_size
+        writer = Writer(handle_sparse)
+        pos = 0
+        for start, end in data_ranges(fd, size):
+            writer.dont_care((start - pos) // block_size)
+            handle_raw.seek(start)
+            pos = start
+            while pos < end:
+                data = handle_raw.read(min(read_size, end - pos))
+                if not data:
+                    raise RuntimeError(f"Unexpected end of file: {path_raw}")
+                pos += len(data)
+                if len(data) % block_size:
+                    # Last block of an image that isn't block aligned
+                    data += b"\0" * (-len(data) % block_size)
+                write_blocks(writer, data)
+        writer.dont_care((size - pos + block_size - 1) // block_size)
+        writer.finish()
+
+        ret = handle_sparse.seek(0, os.SEEK_END)
+
+    logging.debug(f"sparse: {path_raw} ({size} bytes) -> {path_sparse}"
+                  f" ({ret} bytes, {writer.total_chunks} chunks)")
+    return ret
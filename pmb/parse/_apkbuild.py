@@ -30,15 +30,14 @@ revar5 = re.compile(r"([a-zA-Z_]+[a-zA-Z0-9_]*)=")
 
 def replace_variable(apkbuild, value: str) -> str:
     def log_key_not_found(match):
-        logging.verbose(f"{apkbuild['pkgname']}: key '{match.group(1)}' for"
-                        f" replacing '{match.group(0)}' not found, ignoring")
+        logging.verbose("%s: key '%s' for replacing '%s' not found, ignoring",
+                        apkbuild["pkgname"], match.group(1), match.group(0))
 
     # ${foo}
     for match in revar.finditer(value):
         try:
-            logging.verbose("{}: replace '{}' with '{}'".format(
-                            apkbuild["pkgname"], match.group(0),
-                            apkbuild[match.group(1)]))
+            logging.verbose("%s: replace '%s' with '%s'", apkbuild["pkgname"],
+                            match.group(0), apkbuild[match.group(1)])
             value = value.replace(match.group(0), apkbuild[match.group(1)], 1)
         except KeyError:
             log_key_not_found(match)
@@ -47,9 +46,8 @@ def replace_variable(apkbuild, value: str) -> str:
     for match in revar2.finditer(value):
         try:
             newvalue = apkbuild[match.group(1)]
-            logging.verbose("{}: replace '{}' with '{}'".format(
-                            apkbuild["pkgname"], match.group(0),
-                            newvalue))
+            logging.verbose("%s: replace '%s' with '%s'", apkbuild["pkgname"],
+                            match.group(0), newvalue)
             value = value.replace(match.group(0), newvalue, 1)
         except KeyError:
             log_key_not_found(match)
@@ -63,8 +61,8 @@ def replace_variable(apkbuild, value: str) -> str:
             if replacement is None:  # arg 3 is optional
                 replacement = ""
             newvalue = newvalue.replace(search, replacement, 1)
-            logging.verbose("{}: replace '{}' with '{}'".format(
-                            apkbuild["pkgname"], match.group(0), newvalue))
+            logging.verbose("%s: replace '%s' with '%s'", apkbuild["pkgname"],
+                            match.group(0), newvalue)
             value = value.replace(match.group(0), newvalue, 1)
         except KeyError:
             log_key_not_found(match)
@@ -77,8 +75,8 @@ def replace_variable(apkbuild, value: str) -> str:
             substr = match.group(2)
             if newvalue.startswith(substr):
                 newvalue = newvalue.replace(substr, "", 1)
-            logging.verbose("{}: replace '{}' with '{}'".format(
-                            apkbuild["pkgname"], match.group(0), newvalue))
+            logging.verbose("%s: replace '%s' with '%s'", apkbuild["pkgname"],
+                            match.group(0), newvalue)
             value = value.replace(match.group(0), newvalue, 1)
         except KeyError:
             log_key_not_found(match)
@@ -200,8 +200,8 @@ def parse(path, multiple_providers=True):
 
         # Skip virtual packages
         if "timestamp" not in block:
-            logging.verbose("Skipped virtual package " + str(block) + " in"
-                            " file: " + path)
+            logging.verbose("Skipped virtual package %s in file: %s", block,
+                            path)
             continue
 
         # Add the next package and all aliases
@@ -294,15 +294,14 @@ def providers(args, package, arch=None, must_exist=True, indexes=None):
             if provider_pkgname in ret:
                 version_last = ret[provider_pkgname]["version"]
                 if pmb.parse.version.compare(version, version_last) == -1:
-                    logging.verbose(package + ": provided by: " +
-                                    provider_pkgname + "-" + version + " in " +
-                                    path + " (but " + version_last + " is"
-                                    " higher)")
+                    logging.verbose("%s: provided by: %s-%s in %s (but %s is"
+                                    " higher)", package, provider_pkgname,
+                                    version, path, version_last)
                     continue
 
             # Add the provider to ret
-            logging.verbose(package + ": provided by: " + provider_pkgname +
-                            "-" + version + " in " + path)
+            logging.verbose("%s: provided by: %s-%s in %s", package,
+                            provider_pkgname, version, path)
             ret[provider_pkgname] = provider
 
     if ret == {} and must_exist:
@@ -3,6 +3,7 @@
 import argparse
 import copy
 import os
+import shlex
 import sys
 
 try:
@@ -73,10 +74,7 @@ def type_ondev_cp(val):
     return ret
 
 
-def arguments_install(subparser):
-    ret = subparser.add_parser("install", help="set up device specific"
-                               " chroot and install to SD card or image file")
-
+def arguments_install(ret):
     # Other arguments (that don't fit categories below)
     ret.add_argument("--no-sshd", action="store_true",
                      help="do not enable the SSH daemon by default")
@@ -116,10 +114,17 @@ def arguments_install(subparser):
                        action="store_true", dest="android_recovery_zip")
     group.add_argument("--no-image", help="do not generate an image",
                        action="store_true", dest="no_image")
-
-    # Image type "--disk" related
-    group = ret.add_argument_group("optional image type 'disk' arguments")
-    group.add_argument("--rsync", help="update the disk using rsync",
+    group_desc.add_argument("--direct-image", action="store_true",
+                            help="create the file systems directly in the"
+                            " image file from the rootfs, without loop"
+                            " devices and mounting (ext4 root only)")
+
+    # Image type "--disk" and image file related
+    group = ret.add_argument_group("optional rsync arguments")
+    group.add_argument("--rsync", help="update the disk or the image file(s)"
+                       " of the previous installation using rsync, instead of"
+                       " formatting the root partition (a new image gets"
+                       " created if the previous one doesn't fit)",
                        action="store_true")
 
     # Image type "--android-recovery-zip" related
@@ -198,11 +203,7 @@ def arguments_install(subparser):
                        choices=["ext4", "f2fs", "btrfs"])
 
 
-def arguments_export(subparser):
-    ret = subparser.add_parser("export", help="create convenience symlinks"
-                               " to generated image files (system, kernel,"
-                               " initramfs, boot.img, ...)")
-
+def arguments_export(ret):
     ret.add_argument("export_folder", help="export folder, defaults to"
                                            " /tmp/postmarketOS-export",
                      default="/tmp/postmarketOS-export", nargs="?")
@@ -211,12 +212,13 @@ def arguments_export(subparser):
                      action="store_true", dest="odin_flashable_tar")
     ret.add_argument("--no-install", dest="autoinstall", default=True,
                      help="skip updating kernel/initfs", action="store_false")
-    return ret
+    ret.add_argument("--compress", choices=["zstd", "xz"],
+                     help="also export the rootfs image(s) compressed with"
+                     " multithreaded zstd or xz, with a block map (.bmap) for"
+                     " bmaptool")
 
 
-def arguments_sideload(subparser):
-    ret = subparser.add_parser("sideload", help="Push packages to a running"
-                               " phone connected over usb or wifi")
+def arguments_sideload(ret):
     add_packages_arg(ret, nargs="+")
     ret.add_argument("--host", help="ip of the device over wifi"
                                     " (defaults to 172.16.42.1)",
@@ -231,12 +233,9 @@ def arguments_sideload(subparser):
     ret.add_argument("--install-key", help="install the apk key from this"
                      " machine if needed",
                      action="store_true", dest="install_key")
-    return ret
 
 
-def arguments_flasher(subparser):
-    ret = subparser.add_parser("flasher", help="flash something to the"
-                               " target device")
+def arguments_flasher(ret):
     ret.add_argument("--method", help="override flash method",
                      dest="flash_method", default=None)
     sub = ret.add_subparsers(dest="action_flasher")
@@ -309,12 +308,9 @@ def arguments_flasher(subparser):
                        help="resume flashing after using --no-reboot",
                        action="store_true")
 
-    return ret
 
 
-def arguments_initfs(subparser):
-    ret = subparser.add_parser(
-        "initfs", help="do something with the initramfs")
+def arguments_initfs(ret):
     sub = ret.add_subparsers(dest="action_initfs")
 
     # hook ls
@@ -333,14 +329,21 @@ def arguments_initfs(subparser):
     # ls, build, extract
     sub.add_parser("ls", help="list initramfs contents")
     sub.add_parser("build", help="(re)build the initramfs")
-    sub.add_parser("extract",
-                   help="extract the initramfs to a temporary folder")
+    extract = sub.add_parser("extract",
+                             help="extract the initramfs to a temporary"
+                                  " folder")
+    extract.add_argument("files", nargs="*", help="only extract these files"
+                         " or folders (wildcards are allowed, e.g."
+                         " 'lib/modules/*')")
+    diff = sub.add_parser("diff", help="show the size changes of all files"
+                          " between two initramfs builds")
+    diff.add_argument("old", help="path to the old initramfs")
+    diff.add_argument("new", nargs="?", help="path to the new initramfs"
+                      " (default: initramfs of the installed kernel)")
 
-    return ret
 
 
-def arguments_qemu(subparser):
-    ret = subparser.add_parser("qemu")
+def arguments_qemu(ret):
     ret.add_argument("--cmdline", help="override kernel commandline")
     ret.add_argument("--image-size", default="4G",
                      help="set rootfs size, e.g. 2048M or 2G (default: 4G)")
@@ -394,13 +397,9 @@ def arguments_qemu(subparser):
 
     ret.add_argument("--efi", action="store_true",
                      help="Use EFI boot (default: direct kernel image boot)")
-    return ret
 
 
-def arguments_pkgrel_bump(subparser):
-    ret = subparser.add_parser("pkgrel_bump", help="increase the pkgrel to"
-                               " indicate that a package must be rebuilt"
-                               " because of a dependency change")
+def arguments_pkgrel_bump(ret):
     ret.add_argument("--dry", action="store_true", help="instead of modifying"
                      " APKBUILDs, exit with >0 when a package would have been"
                      " bumped")
@@ -411,12 +410,9 @@ def arguments_pkgrel_bump(subparser):
                       " depend on a library which had an incompatible update"
                       " (libraries with a soname bump)")
     mode.add_argument("packages", nargs="*", default=[])
-    return ret
 
 
-def arguments_aportupgrade(subparser):
-    ret = subparser.add_parser("aportupgrade", help="check for outdated"
-                               " packages that need upgrading")
+def arguments_aportupgrade(ret):
     ret.add_argument("--dry", action="store_true", help="instead of modifying"
                      " APKBUILDs, print the changes that would be made")
     ret.add_argument("--ref", help="git ref (tag, commit, etc) to use")
@@ -430,10 +426,9 @@ def arguments_aportupgrade(subparser):
     mode.add_argument("--all-git", action="store_true", help="iterate through"
                       " all git packages")
     mode.add_argument("packages", nargs="*", default=[])
-    return ret
 
 
-def arguments_newapkbuild(subparser):
+def arguments_newapkbuild(ret):
     """
     Wrapper for Alpine's "newapkbuild" command.
 
@@ -442,45 +437,42 @@ def arguments_newapkbuild(subparser):
     them through in "pmb/helpers/frontend.py". The order of the parameters is
     kept the same as in "newapkbuild -h".
     """
-    sub = subparser.add_parser("newapkbuild", help="get a template to package"
-                               " new software")
-    sub.add_argument("--folder", help="set postmarketOS aports folder"
+    ret.add_argument("--folder", help="set postmarketOS aports folder"
                      " (default: main)", default="main")
 
     # Passthrough: Strings (e.g. -d "my description")
     for entry in pmb.config.newapkbuild_arguments_strings:
-        sub.add_argument(entry[0], dest=entry[1], help=entry[2])
+        ret.add_argument(entry[0], dest=entry[1], help=entry[2])
 
     # Passthrough: Package type switches (e.g. -C for CMake)
-    group = sub.add_mutually_exclusive_group()
+    group = ret.add_mutually_exclusive_group()
     for entry in pmb.config.newapkbuild_arguments_switches_pkgtypes:
         group.add_argument(entry[0], dest=entry[1], help=entry[2],
                            action="store_true")
 
     # Passthrough: Other switches (e.g. -c for copying sample files)
     for entry in pmb.config.newapkbuild_arguments_switches_other:
-        sub.add_argument(entry[0], dest=entry[1], help=entry[2],
+        ret.add_argument(entry[0], dest=entry[1], help=entry[2],
                          action="store_true")
 
     # Force switch
-    sub.add_argument("-f", dest="force", action="store_true",
+    ret.add_argument("-f", dest="force", action="store_true",
                      help="force even if directory already exists")
 
     # Passthrough: PKGNAME[-PKGVER] | SRCURL
-    sub.add_argument("pkgname_pkgver_srcurl",
+    ret.add_argument("pkgname_pkgver_srcurl",
                      metavar="PKGNAME[-PKGVER] | SRCURL",
                      help="set either the package name (optionally with the"
                      " PKGVER at the end, e.g. 'hello-world-1.0') or the"
                      " download link to the source archive")
 
 
-def arguments_kconfig(subparser):
+def arguments_kconfig(ret):
     # Allowed architectures
     arch_native = pmb.config.arch_native
     arch_choices = set(pmb.config.build_device_architectures + [arch_native])
 
     # Kconfig subparser
-    ret = subparser.add_parser("kconfig", help="change or edit kernel configs")
     sub = ret.add_subparsers(dest="action_kconfig")
     sub.required = True
 
@@ -496,6 +488,13 @@ def arguments_kconfig(subparser):
                        dest="kconfig_check_details",
                        help="print one generic error per component instead of"
                             " listing each option that needs to be adjusted")
+    check.add_argument("--json", metavar="PATH",
+                       help="write a summary of the results for each config"
+                            " as JSON to PATH ('-' for stdout)")
+    check.add_argument("--no-cache", action="store_true", dest="no_cache",
+                       help="check all configs again, instead of using the"
+                            " results from the last run for configs that did"
+                            " not change")
     for name in pmb.parse.kconfig.get_all_component_names():
         check.add_argument(f"--{name}", action="store_true",
                            dest=f"kconfig_check_{name}",
@@ -523,19 +522,16 @@ def arguments_kconfig(subparser):
     add_kernel_arg(migrate)
 
 
-def arguments_repo_bootstrap(subparser):
+def arguments_repo_bootstrap(ret):
     arch_native = pmb.config.arch_native
     arch_choices = set(pmb.config.build_device_architectures + [arch_native])
 
-    ret = subparser.add_parser("repo_bootstrap")
     ret.add_argument("repository",
                      help="which repository to bootstrap (e.g. systemd)")
     ret.add_argument("--arch", choices=arch_choices, dest="arch")
-    return ret
 
 
-def arguments_repo_missing(subparser):
-    ret = subparser.add_parser("repo_missing")
+def arguments_repo_missing(ret):
     package = ret.add_argument("package", nargs="?", help="only look at a"
                                " specific package and its dependencies")
     if "argcomplete" in sys.modules:
@@ -546,24 +542,32 @@ def arguments_repo_missing(subparser):
                      help="include packages which exist in the binary repos")
     ret.add_argument("--overview", action="store_true",
                      help="only print the pkgnames without any details")
-    return ret
+    ret.add_argument("--incremental", action="store_true",
+                     help="only check the packages again that changed since"
+                     " the last run with --incremental (changes in"
+                     " pmaports git, packages depending on them and changes"
+                     " in the binary repos)")
 
 
-def arguments_lint(subparser):
-    lint = subparser.add_parser("lint", help="run quality checks on pmaports"
-                                             " (required to pass CI)")
-    add_packages_arg(lint, nargs="*")
+def arguments_rdepends(ret):
+    package = ret.add_argument("package", help="package name, e.g."
+                               " hello-world or so:libc.musl-x86_64.so.1")
+    if "argcomplete" in sys.modules:
+        package.completer = package_completer
+    arch_native = pmb.config.arch_native
+    arch_choices = set(pmb.config.build_device_architectures + [arch_native])
+    ret.add_argument("--arch", choices=arch_choices, default=arch_native,
+                     help="architecture of the binary packages")
+    ret.add_argument("-r", "--recursive", action="store_true",
+                     help="also list the packages depending on these"
+                     " packages, and so on")
 
 
-def arguments_status(subparser):
-    ret = subparser.add_parser("status",
-                               help="show a config and pmaports overview")
-    return ret
+def arguments_lint(ret):
+    add_packages_arg(ret, nargs="*")
 
 
-def arguments_netboot(subparser):
-    ret = subparser.add_parser("netboot",
-                               help="launch nbd server with pmOS rootfs")
+def arguments_netboot(ret):
     sub = ret.add_subparsers(dest="action_netboot")
     sub.required = True
 
@@ -571,22 +575,22 @@ def arguments_netboot(subparser):
     start.add_argument("--replace", action="store_true",
                        help="replace stored netboot image")
 
-    return ret
 
 
-def arguments_ci(subparser):
-    ret = subparser.add_parser("ci", help="run continuous integration scripts"
-                                          " locally of git repo in current"
-                                          " directory")
+def arguments_ci(ret):
     script_args = ret.add_mutually_exclusive_group()
     script_args.add_argument("-a", "--all", action="store_true",
                              help="run all scripts")
     script_args.add_argument("-f", "--fast", action="store_true",
                              help="run fast scripts only")
+    ret.add_argument("-P", "--parallel", type=int, metavar="JOBS",
+                     help="run up to JOBS scripts at the same time, each"
+                          " chroot script in its own copy of the git"
+                          " repository (the output gets shown when a script"
+                          " is done)")
     ret.add_argument("scripts", nargs="*", metavar="script",
                      help="name of the CI script to run, depending on the git"
                           " repository")
-    return ret
 
 
 def package_completer(prefix, action, parser=None, parsed_args=None):
@@ -630,10 +634,290 @@ def add_kernel_arg(subparser, name="package", nargs="?", *args, **kwargs):
         arg.completer = kernel_completer
 
 
-def get_parser():
-    parser = argparse.ArgumentParser(prog="pmbootstrap")
+def arguments_log(ret):
+    ret.add_argument("-n", "--lines", default="60",
+                     help="count of initial output lines")
+    ret.add_argument("-c", "--clear", help="clear the log",
+                     action="store_true", dest="clear_log")
+
+
+def arguments_zap(ret):
+    ret.add_argument("--dry", action="store_true", help="instead of actually"
+                     " deleting anything, print out what would have been"
+                     " deleted")
+    ret.add_argument("-hc", "--http", action="store_true", help="also delete"
+                     " http cache")
+    ret.add_argument("-d", "--distfiles", action="store_true", help="also"
+                     " delete downloaded source tarballs")
+    ret.add_argument("-p", "--pkgs-local", action="store_true",
+                     dest="pkgs_local",
+                     help="also delete *all* locally compiled packages")
+    ret.add_argument("-m", "--pkgs-local-mismatch", action="store_true",
+                     dest="pkgs_local_mismatch",
+                     help="also delete locally compiled packages without"
+                     " existing aport of same version")
+    ret.add_argument("-n", "--netboot", action="store_true",
+                     help="also delete stored images for netboot")
+    ret.add_argument("-o", "--pkgs-online-mismatch", action="store_true",
+                     dest="pkgs_online_mismatch",
+                     help="also delete outdated packages from online mirrors"
+                     " (that have been downloaded to the apk cache)")
+    ret.add_argument("-r", "--rust", action="store_true",
+                     help="also delete rust related caches")
+    ret.add_argument("--background", action="store_true",
+                     help="don't wait until the chroot folders are deleted"
+                     " (they get moved out of the way first, so pmbootstrap"
+                     " can be used right away)")
+    ret.add_argument("--dedup", action="store_true",
+                     help="hardlink identical packages between the apk caches"
+                     " of all arches, to save space")
+
+    zap_all_delete_args = ["http", "distfiles", "pkgs_local",
+                           "pkgs_local_mismatch", "netboot", "pkgs_online_mismatch",
+                           "rust"]
+    zap_all_delete_args_print = [arg.replace("_", "-")
+                                 for arg in zap_all_delete_args]
+    ret.add_argument("-a", "--all",
+                     action=toggle_other_boolean_flags(*zap_all_delete_args),
+                     help="delete everything, equivalent to: "
+                     f"--{' --'.join(zap_all_delete_args_print)}")
+
+
+def arguments_stats(ret):
+    arch_native = pmb.config.arch_native
+    arch_choices = set(pmb.config.build_device_architectures + [arch_native])
+    ret.add_argument("--arch", default=arch_native, choices=arch_choices)
+
+
+def arguments_update(ret):
+    arch_native = pmb.config.arch_native
+    arch_choices = set(pmb.config.build_device_architectures + [arch_native])
+    ret.add_argument("--arch", default=None, choices=arch_choices,
+                     help="only update a specific architecture")
+    ret.add_argument("--non-existing", action="store_true", help="do not"
+                     " only update the existing APKINDEX files, but all of"
+                     " them", dest="non_existing")
+
+
+def arguments_suffix(ret, rootfs=False):
+    """Add the arguments to select the chroot for build_init and chroot."""
+    arch_native = pmb.config.arch_native
+    arch_choices = set(pmb.config.build_device_architectures + [arch_native])
+
+    suffix = ret.add_mutually_exclusive_group()
+    if rootfs:
+        suffix.add_argument("-r", "--rootfs", action="store_true",
+                            help="Chroot for the device root file system")
+    suffix.add_argument("-b", "--buildroot", nargs="?", const="device",
+                        choices={"device"} | arch_choices,
+                        help="Chroot for building packages, defaults to"
+                        " device architecture")
+    suffix.add_argument("-s", "--suffix", default=None,
+                        help="Specify any chroot suffix, defaults to"
+                             " 'native'")
+
+
+def arguments_build_init(ret):
+    arguments_suffix(ret)
+
+
+def arguments_chroot(ret):
+    ret.add_argument("--add", help="build/install comma separated list of"
+                     " packages in the chroot before entering it")
+    ret.add_argument("--user", help="run the command as user, not as root",
+                     action="store_true")
+    ret.add_argument("--output", choices=["log", "stdout", "interactive",
+                     "tui", "background"], help="how the output of the"
+                     " program should be handled, choose from: 'log',"
+                     " 'stdout', 'interactive', 'tui' (default),"
+                     " 'background'. Details: pmb/helpers/run_core.py",
+                     default="tui")
+    ret.add_argument("command", default=["sh", "-i"], help="command"
+                     " to execute inside the chroot. default: sh",
+                     nargs='*')
+    ret.add_argument("-x", "--xauth", action="store_true",
+                     help="Copy .Xauthority and set environment variables,"
+                          " so X11 applications can be started (native"
+                          " chroot only)")
+    ret.add_argument("-i", "--install-blockdev", action="store_true",
+                     help="Create a sparse image file and mount it as"
+                           " /dev/install, just like during the"
+                           " installation process.")
+    arguments_suffix(ret, rootfs=True)
+
+
+def arguments_checksum(ret):
+    ret.add_argument("--verify", action="store_true", help="download"
+                     " sources and verify that the checksums of the"
+                     " APKBUILD match, instead of updating them")
+    add_packages_arg(ret, nargs="+")
+
+
+def arguments_aportgen(ret):
+    aportgen_fork_alpine = ret.add_mutually_exclusive_group()
+    aportgen_fork_alpine.add_argument("-a", "--fork-alpine",
+                                      help="fork the alpine upstream package",
+                                      action="store_true", dest="fork_alpine")
+    aportgen_fork_alpine.add_argument("-r", "--fork-alpine-retain-branch",
+                                      help="fork the alpine upstream, but don't change "
+                                      "branch to match the current channel",
+                                      action="store_true",
+                                      dest="fork_alpine_retain_branch")
+    add_packages_arg(ret, nargs="+")
+
+
+def arguments_build(ret):
     arch_native = pmb.config.arch_native
     arch_choices = set(pmb.config.build_device_architectures + [arch_native])
+
+    ret.add_argument("--arch", choices=arch_choices, default=None,
+                     help="CPU architecture to build for (default: " +
+                     arch_native + " or first available architecture in"
+                     " APKBUILD)")
+    ret.add_argument("--force", action="store_true", help="even build if not"
+                     " necessary")
+    ret.add_argument("--strict", action="store_true", help="(slower) zap and"
+                     " install only required depends when building, to"
+                     " detect dependency errors")
+    ret.add_argument("--src", help="override source used to build the"
+                     " package with a local folder (the APKBUILD must"
+                     " expect the source to be in $builddir, so you might"
+                     " need to adjust it)",
+                     nargs=1)
+    ret.add_argument("-i", "--ignore-depends", action="store_true",
+                     help="only build and install makedepends from an"
+                     " APKBUILD, ignore the depends (old behavior). This is"
+                     " faster for device packages for example, because then"
+                     " you don't need to build and install the kernel. But"
+                     " it is incompatible with how Alpine's abuild handles"
+                     " it.",
+                     dest="ignore_depends")
+    ret.add_argument("-n", "--no-depends", action="store_true",
+                     help="never build dependencies, abort instead",
+                     dest="no_depends")
+    ret.add_argument("--go-mod-cache", action="store_true", default=None,
+                     help="for go packages: Usually they should bundle the"
+                          " dependency sources instead of downloading them"
+                          " at build time. But if they don't (e.g. with"
+                          " pmbootstrap build --src), then this option can"
+                          " be used to let GOMODCACHE point into"
+                          " pmbootstrap's work dir to only download"
+                          " dependencies once. (default: true with --src,"
+                          " false otherwise)")
+    ret.add_argument("--no-go-mod-cache",
+                     action="store_false", dest="go_mod_cache", default=None,
+                     help="don't set GOMODCACHE")
+    ret.add_argument("--envkernel", action="store_true",
+                     help="Create an apk package from the build output of"
+                     " a kernel compiled locally on the host or with envkernel.sh.")
+    add_packages_arg(ret, nargs="+")
+
+
+def arguments_deviceinfo_parse(ret):
+    ret.add_argument("devices", nargs="*")
+    ret.add_argument("--kernel", help="the kernel to select (for"
+                     " device packages with multiple kernels),"
+                     " e.g. 'downstream', 'mainline'",
+                     dest="deviceinfo_parse_kernel",
+                     metavar="KERNEL")
+
+
+def arguments_apkbuild_parse(ret):
+    add_packages_arg(ret, nargs="*")
+
+
+def arguments_apkindex_parse(ret):
+    ret.add_argument("apkindex_path")
+    add_packages_arg(ret, "package", nargs="?")
+
+
+def arguments_config(ret):
+    ret.add_argument("-r", "--reset", action="store_true",
+                     help="Reset config options with the given name to it's"
+                     " default.")
+    ret.add_argument("name", nargs="?", help="variable name, one of: " +
+                     ", ".join(sorted(pmb.config.config_keys)),
+                     choices=pmb.config.config_keys, metavar="name")
+    ret.add_argument("value", nargs="?", help="set variable to value")
+
+
+def arguments_bootimg_analyze(ret):
+    ret.add_argument("path", help="path to the boot.img")
+    ret.add_argument("--force", "-f", action="store_true",
+                     help="force even if the file seems to be"
+                          " invalid")
+
+
+# All actions in the order they appear in "pmbootstrap -h". Each action has
+# the keyword arguments for argparse's add_parser(), and the function that
+# adds the action's arguments to its parser (or None). The functions only run
+# for the action that is used, see get_parser().
+actions = {
+    "init": ({"help": "initialize config file"}, None),
+    "shutdown": ({"help": "umount, unregister binfmt"}, None),
+    "index": ({"help": "re-index all repositories with custom built packages"
+                       " (do this after manually removing package files)"},
+              None),
+    "work_migrate": ({"help": "run this before using pmbootstrap"
+                              " non-interactively to migrate the work folder"
+                              " version on demand"}, None),
+    "repo_bootstrap": ({}, arguments_repo_bootstrap),
+    "repo_missing": ({}, arguments_repo_missing),
+    "rdepends": ({"help": "list packages (pmaports and binary packages) that"
+                          " depend on a package"}, arguments_rdepends),
+    "kconfig": ({"help": "change or edit kernel configs"}, arguments_kconfig),
+    "export": ({"help": "create convenience symlinks to generated image files"
+                        " (system, kernel, initramfs, boot.img, ...)"},
+               arguments_export),
+    "sideload": ({"help": "Push packages to a running phone connected over"
+                          " usb or wifi"}, arguments_sideload),
+    "netboot": ({"help": "launch nbd server with pmOS rootfs"},
+                arguments_netboot),
+    "flasher": ({"help": "flash something to the target device"},
+                arguments_flasher),
+    "initfs": ({"help": "do something with the initramfs"}, arguments_initfs),
+    "qemu": ({}, arguments_qemu),
+    "pkgrel_bump": ({"help": "increase the pkgrel to indicate that a package"
+                             " must be rebuilt because of a dependency"
+                             " change"}, arguments_pkgrel_bump),
+    "aportupgrade": ({"help": "check for outdated packages that need"
+                              " upgrading"}, arguments_aportupgrade),
+    "newapkbuild": ({"help": "get a template to package new software"},
+                    arguments_newapkbuild),
+    "lint": ({"help": "run quality checks on pmaports (required to pass"
+                      " CI)"}, arguments_lint),
+    "status": ({"help": "show a config and pmaports overview"}, None),
+    "ci": ({"help": "run continuous integration scripts locally of git repo"
+                    " in current directory"}, arguments_ci),
+    "log": ({"help": "follow the pmbootstrap logfile"}, arguments_log),
+    "zap": ({"help": "safely delete chroot folders"}, arguments_zap),
+    "stats": ({"help": "show ccache stats"}, arguments_stats),
+    "update": ({"help": "update all existing APKINDEX files"},
+               arguments_update),
+    "build_init": ({"help": "initialize build environment (usually you do not"
+                            " need to call this)"}, arguments_build_init),
+    "chroot": ({"help": "start shell in chroot"}, arguments_chroot),
+    "install": ({"help": "set up device specific chroot and install to SD"
+                         " card or image file"}, arguments_install),
+    "checksum": ({"help": "update aport checksums"}, arguments_checksum),
+    "aportgen": ({"help": "generate a postmarketOS specific package build"
+                          " recipe (aport/APKBUILD)"}, arguments_aportgen),
+    "build": ({"help": "create a package for a specific architecture"},
+              arguments_build),
+    "deviceinfo_parse": ({}, arguments_deviceinfo_parse),
+    "apkbuild_parse": ({}, arguments_apkbuild_parse),
+    "apkindex_parse": ({}, arguments_apkindex_parse),
+    "config": ({"help": "get and set pmbootstrap options"}, arguments_config),
+    "bootimg_analyze": ({"help": "Extract all the information from an"
+                                 " existing boot.img"},
+                        arguments_bootimg_analyze),
+    "pull": ({"help": "update all git repositories that pmbootstrap cloned"
+                      " (pmaports, etc.)"}, None),
+}
+
+
+def arguments_global(parser):
+    """Add the arguments that come before the action."""
     mirrors_pmos_default = pmb.config.defaults["mirrors_postmarketos"]
 
     # Other
@@ -703,235 +987,86 @@ def get_parser():
     parser.add_argument("-q", "--quiet", dest="quiet", action="store_true",
                         help="do not output any log messages")
 
-    # Actions
-    sub = parser.add_subparsers(title="action", dest="action")
-    sub.add_parser("init", help="initialize config file")
-    sub.add_parser("shutdown", help="umount, unregister binfmt")
-    sub.add_parser("index", help="re-index all repositories with custom built"
-                   " packages (do this after manually removing package files)")
-    sub.add_parser("work_migrate", help="run this before using pmbootstrap"
-                                        " non-interactively to migrate the"
-                                        " work folder version on demand")
-    arguments_repo_bootstrap(sub)
-    arguments_repo_missing(sub)
-    arguments_kconfig(sub)
-    arguments_export(sub)
-    arguments_sideload(sub)
-    arguments_netboot(sub)
-    arguments_flasher(sub)
-    arguments_initfs(sub)
-    arguments_qemu(sub)
-    arguments_pkgrel_bump(sub)
-    arguments_aportupgrade(sub)
-    arguments_newapkbuild(sub)
-    arguments_lint(sub)
-    arguments_status(sub)
-    arguments_ci(sub)
-
-    # Action: log
-    log = sub.add_parser("log", help="follow the pmbootstrap logfile")
-    log.add_argument("-n", "--lines", default="60",
-                     help="count of initial output lines")
-    log.add_argument("-c", "--clear", help="clear the log",
-                     action="store_true", dest="clear_log")
 
-    # Action: zap
-    zap = sub.add_parser("zap", help="safely delete chroot folders")
-    zap.add_argument("--dry", action="store_true", help="instead of actually"
-                     " deleting anything, print out what would have been"
-                     " deleted")
-    zap.add_argument("-hc", "--http", action="store_true", help="also delete"
-                     " http cache")
-    zap.add_argument("-d", "--distfiles", action="store_true", help="also"
-                     " delete downloaded source tarballs")
-    zap.add_argument("-p", "--pkgs-local", action="store_true",
-                     dest="pkgs_local",
-                     help="also delete *all* locally compiled packages")
-    zap.add_argument("-m", "--pkgs-local-mismatch", action="store_true",
-                     dest="pkgs_local_mismatch",
-                     help="also delete locally compiled packages without"
-                     " existing aport of same version")
-    zap.add_argument("-n", "--netboot", action="store_true",
-                     help="also delete stored images for netboot")
-    zap.add_argument("-o", "--pkgs-online-mismatch", action="store_true",
-                     dest="pkgs_online_mismatch",
-                     help="also delete outdated packages from online mirrors"
-                     " (that have been downloaded to the apk cache)")
-    zap.add_argument("-r", "--rust", action="store_true",
-                     help="also delete rust related caches")
+class ActionNotFound(Exception):
+    pass
 
-    zap_all_delete_args = ["http", "distfiles", "pkgs_local",
-                           "pkgs_local_mismatch", "netboot", "pkgs_online_mismatch",
-                           "rust"]
-    zap_all_delete_args_print = [arg.replace("_", "-")
-                                 for arg in zap_all_delete_args]
-    zap.add_argument("-a", "--all",
-                     action=toggle_other_boolean_flags(*zap_all_delete_args),
-                     help="delete everything, equivalent to: "
-                     f"--{' --'.join(zap_all_delete_args_print)}")
 
-    # Action: stats
-    stats = sub.add_parser("stats", help="show ccache stats")
-    stats.add_argument("--arch", default=arch_native, choices=arch_choices)
-
-    # Action: update
-    update = sub.add_parser("update", help="update all existing APKINDEX"
-                            " files")
-    update.add_argument("--arch", default=None, choices=arch_choices,
-                        help="only update a specific architecture")
-    update.add_argument("--non-existing", action="store_true", help="do not"
-                        " only update the existing APKINDEX files, but all of"
-                        " them", dest="non_existing")
-
-    # Action: build_init / chroot
-    build_init = sub.add_parser("build_init", help="initialize build"
-                                " environment (usually you do not need to call"
-                                " this)")
-    chroot = sub.add_parser("chroot", help="start shell in chroot")
-    chroot.add_argument("--add", help="build/install comma separated list of"
-                        " packages in the chroot before entering it")
-    chroot.add_argument("--user", help="run the command as user, not as root",
-                        action="store_true")
-    chroot.add_argument("--output", choices=["log", "stdout", "interactive",
-                        "tui", "background"], help="how the output of the"
-                        " program should be handled, choose from: 'log',"
-                        " 'stdout', 'interactive', 'tui' (default),"
-                        " 'background'. Details: pmb/helpers/run_core.py",
-                        default="tui")
-    chroot.add_argument("command", default=["sh", "-i"], help="command"
-                        " to execute inside the chroot. default: sh",
-                        nargs='*')
-    chroot.add_argument("-x", "--xauth", action="store_true",
-                        help="Copy .Xauthority and set environment variables,"
-                             " so X11 applications can be started (native"
-                             " chroot only)")
-    chroot.add_argument("-i", "--install-blockdev", action="store_true",
-                        help="Create a sparse image file and mount it as"
-                              " /dev/install, just like during the"
-                              " installation process.")
-    for action in [build_init, chroot]:
-        suffix = action.add_mutually_exclusive_group()
-        if action == chroot:
-            suffix.add_argument("-r", "--rootfs", action="store_true",
-                                help="Chroot for the device root file system")
-        suffix.add_argument("-b", "--buildroot", nargs="?", const="device",
-                            choices={"device"} | arch_choices,
-                            help="Chroot for building packages, defaults to"
-                            " device architecture")
-        suffix.add_argument("-s", "--suffix", default=None,
-                            help="Specify any chroot suffix, defaults to"
-                                 " 'native'")
-
-    # Action: install
-    arguments_install(sub)
-
-    # Action: checksum
-    checksum = sub.add_parser("checksum", help="update aport checksums")
-    checksum.add_argument("--verify", action="store_true", help="download"
-                          " sources and verify that the checksums of the"
-                          " APKBUILD match, instead of updating them")
-    add_packages_arg(checksum, nargs="+")
-
-    # Action: aportgen
-    aportgen = sub.add_parser("aportgen", help="generate a postmarketOS"
-                              " specific package build recipe"
-                              " (aport/APKBUILD)")
-    aportgen_fork_alpine = aportgen.add_mutually_exclusive_group()
-    aportgen_fork_alpine.add_argument("-a", "--fork-alpine",
-                                      help="fork the alpine upstream package",
-                                      action="store_true", dest="fork_alpine")
-    aportgen_fork_alpine.add_argument("-r", "--fork-alpine-retain-branch",
-                                      help="fork the alpine upstream, but don't change "
-                                      "branch to match the current channel",
-                                      action="store_true",
-                                      dest="fork_alpine_retain_branch")
-    add_packages_arg(aportgen, nargs="+")
-
-    # Action: build
-    build = sub.add_parser("build", help="create a package for a"
-                           " specific architecture")
-    build.add_argument("--arch", choices=arch_choices, default=None,
-                       help="CPU architecture to build for (default: " +
-                       arch_native + " or first available architecture in"
-                       " APKBUILD)")
-    build.add_argument("--force", action="store_true", help="even build if not"
-                       " necessary")
-    build.add_argument("--strict", action="store_true", help="(slower) zap and"
-                       " install only required depends when building, to"
-                       " detect dependency errors")
-    build.add_argument("--src", help="override source used to build the"
-                       " package with a local folder (the APKBUILD must"
-                       " expect the source to be in $builddir, so you might"
-                       " need to adjust it)",
-                       nargs=1)
-    build.add_argument("-i", "--ignore-depends", action="store_true",
-                       help="only build and install makedepends from an"
-                       " APKBUILD, ignore the depends (old behavior). This is"
-                       " faster for device packages for example, because then"
-                       " you don't need to build and install the kernel. But"
-                       " it is incompatible with how Alpine's abuild handles"
-                       " it.",
-                       dest="ignore_depends")
-    build.add_argument("-n", "--no-depends", action="store_true",
-                       help="never build dependencies, abort instead",
-                       dest="no_depends")
-    build.add_argument("--go-mod-cache", action="store_true", default=None,
-                       help="for go packages: Usually they should bundle the"
-                            " dependency sources instead of downloading them"
-                            " at build time. But if they don't (e.g. with"
-                            " pmbootstrap build --src), then this option can"
-                            " be used to let GOMODCACHE point into"
-                            " pmbootstrap's work dir to only download"
-                            " dependencies once. (default: true with --src,"
-                            " false otherwise)")
-    build.add_argument("--no-go-mod-cache",
-                       action="store_false", dest="go_mod_cache", default=None,
-                       help="don't set GOMODCACHE")
-    build.add_argument("--envkernel", action="store_true",
-                       help="Create an apk package from the build output of"
-                       " a kernel compiled locally on the host or with envkernel.sh.")
-    add_packages_arg(build, nargs="+")
-
-    # Action: deviceinfo_parse
-    deviceinfo_parse = sub.add_parser("deviceinfo_parse")
-    deviceinfo_parse.add_argument("devices", nargs="*")
-    deviceinfo_parse.add_argument("--kernel", help="the kernel to select (for"
-                                  " device packages with multiple kernels),"
-                                  " e.g. 'downstream', 'mainline'",
-                                  dest="deviceinfo_parse_kernel",
-                                  metavar="KERNEL")
-
-    # Action: apkbuild_parse
-    apkbuild_parse = sub.add_parser("apkbuild_parse")
-    add_packages_arg(apkbuild_parse, nargs="*")
-
-    # Action: apkindex_parse
-    apkindex_parse = sub.add_parser("apkindex_parse")
-    apkindex_parse.add_argument("apkindex_path")
-    add_packages_arg(apkindex_parse, "package", nargs="?")
-
-    # Action: config
-    config = sub.add_parser("config",
-                            help="get and set pmbootstrap options")
-    config.add_argument("-r", "--reset", action="store_true",
-                        help="Reset config options with the given name to it's"
-                        " default.")
-    config.add_argument("name", nargs="?", help="variable name, one of: " +
-                        ", ".join(sorted(pmb.config.config_keys)),
-                        choices=pmb.config.config_keys, metavar="name")
-    config.add_argument("value", nargs="?", help="set variable to value")
-
-    # Action: bootimg_analyze
-    bootimg_analyze = sub.add_parser("bootimg_analyze", help="Extract all the"
-                                     " information from an existing boot.img")
-    bootimg_analyze.add_argument("path", help="path to the boot.img")
-    bootimg_analyze.add_argument("--force", "-f", action="store_true",
-                                 help="force even if the file seems to be"
-                                      " invalid")
-
-    # Action: pull
-    sub.add_parser("pull", help="update all git repositories that pmbootstrap"
-                   " cloned (pmaports, etc.)")
+class ActionParser(argparse.ArgumentParser):
+    """Parser for get_action(), which raises ActionNotFound instead of
+    printing errors or help and exiting."""
+
+    def error(self, message):
+        raise ActionNotFound(message)
+
+    def exit(self, status=0, message=None):
+        raise ActionNotFound(message)
+
+
+def get_action(argv, exit_on_error=True):
+    """Find the action in the command line arguments, without building the
+    parsers of all actions.
+
+    :param argv: command line arguments, without the program name
+    :param exit_on_error: print help or errors and exit like the full parser
+                          would. Otherwise raise ActionNotFound.
+    :returns: the action name, or None if there is no action
+    """
+    cls = argparse.ArgumentParser if exit_on_error else ActionParser
+    parser = cls(prog="pmbootstrap")
+    arguments_global(parser)
+    sub = parser.add_subparsers(title="action", dest="action")
+    for name, (kwargs, _) in actions.items():
+        sub.add_parser(name, add_help=False, **kwargs)
+    return parser.parse_known_args(argv)[0].action
+
+
+def get_argcomplete_argv():
+    """:returns: the completed words of the command line that argcomplete
+                 is completing, without the program name and the word that
+                 is being completed."""
+    line = os.environ.get("COMP_LINE", "")
+    line = line[:int(os.environ.get("COMP_POINT", len(line)))]
+    try:
+        words = shlex.split(line)
+    except ValueError:
+        return None
+    if words and not line[-1:].isspace():
+        words.pop()
+    return words[1:]
+
+
+def get_parser(action=None):
+    """Build the argument parser. Only the parser of the used action gets all
+    its arguments, the other actions get a parser without arguments, so they
+    show up in "pmbootstrap -h".
+
+    :param action: the action to build the full parser for. By default it
+                   gets detected from sys.argv, or from the command line that
+                   argcomplete is completing.
+    """
+    argcomplete_active = ("argcomplete" in sys.modules and
+                          "_ARGCOMPLETE" in os.environ)
+    build_all = False
+    if action is None:
+        if argcomplete_active:
+            argv = get_argcomplete_argv()
+            try:
+                action = get_action(argv, False) if argv is not None else None
+            except ActionNotFound:
+                build_all = True
+        else:
+            action = get_action(sys.argv[1:])
+
+    parser = argparse.ArgumentParser(prog="pmbootstrap")
+    arguments_global(parser)
+
+    # Actions
+    sub = parser.add_subparsers(title="action", dest="action")
+    for name, (kwargs, func) in actions.items():
+        ret = sub.add_parser(name, **kwargs)
+        if func and (build_all or name == action):
+            func(ret)
 
     if "argcomplete" in sys.modules:
         argcomplete.autocomplete(parser, always_complete_options="long")
@@ -941,7 +1076,7 @@ def get_parser():
 def arguments():
 
     # Parse and extend arguments (also backup unmodified result from argparse)
-    args = get_parser().parse_args()
+    args = get_parser().parse_args(namespace=pmb.helpers.args.Args())
 
     setattr(args, "from_argparse", copy.deepcopy(args))
     setattr(args.from_argparse, "from_argparse", args.from_argparse)
@@ -1,6 +1,7 @@
 # Copyright 2023 Oliver Smith
 # SPDX-License-Identifier: GPL-3.0-or-later
 import os
+import importlib
 import logging
 import pmb
 
@@ -73,6 +74,8 @@ def bootimg(args, path):
     logging.info("NOTE: You will be prompted for your sudo/doas password, so"
                  " we can set up a chroot to extract and analyze your"
                  " boot.img file")
+    for module in ["pmb.chroot", "pmb.chroot.apk", "pmb.chroot.other"]:
+        importlib.import_module(module)
     pmb.chroot.apk.install(args, ["file", "unpackbootimg"])
 
     temp_path = pmb.chroot.other.tempfolder(args, "/tmp/bootimg_parser")
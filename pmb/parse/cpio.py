@@ -0,0 +1,328 @@
+# Copyright 2023 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""Read initramfs files (compressed cpio archives in the "newc" format).
+
+The archives get read as a stream: the entries can be listed, and the data
+of selected files can be extracted, without unpacking the whole archive
+first. gzip and xz are decompressed with Python's modules, zstd and lz4 with
+the programs from the host system.
+
+Format reference: https://docs.kernel.org/driver-api/early-userspace/buffer-format.html
+"""
+import fnmatch
+import gzip
+import logging
+import lzma
+import os
+import shutil
+import stat
+import subprocess
+import time
+
+# "070701", then 13 fields with 8 hex digits each
+header_magic = b"070701"
+header_size = 110
+header_fields = ["ino", "mode", "uid", "gid", "nlink", "mtime", "size",
+                 "devmajor", "devminor", "rdevmajor", "rdevminor", "namesize",
+                 "check"]
+trailer = "TRAILER!!!"
+
+# Magic bytes of the compression formats, and the programs that decompress
+# them to stdout (None: Python module)
+compressions = {"gzip": (b"\x1f\x8b", None),
+                "xz": (b"\xfd7zXZ\x00", None),
+                "zstd": (b"\x28\xb5\x2f\xfd", ["zstd", "-dcq"]),
+                "lz4": (b"\x04\x22\x4d\x18", ["lz4", "-dcq"]),
+                "lz4_legacy": (b"\x02\x21\x4c\x18", ["lz4", "-dcq"]),
+                "none": (header_magic, None)}
+
+read_size = 1024 * 1024
+
+
+def get_compression(path):
+    """:returns: key of compressions, detected by the magic bytes"""
+    with open(path, "rb") as handle:
+        magic = handle.read(6)
+    for compression, (compression_magic, _) in compressions.items():
+        if magic.startswith(compression_magic):
+            return compression
+    raise RuntimeError(f"Unknown initramfs compression: {path}")
+
+
+class Reader:
+    """Decompressed stream of a (compressed) cpio archive."""
+
+    def __init__(self, path):
+        self.path = path
+        self.process = None
+        compression = get_compression(path)
+        command = compressions[compression][1]
+        if compression == "gzip":
+            self.handle = gzip.open(path, "rb")
+        elif compression == "xz":
+            self.handle = lzma.open(path, "rb")
+        elif command:
+            if not shutil.which(command[0]):
+                raise RuntimeError(f"Reading {compression} compressed"
+                                   f" initramfs files requires the"
+                                   f" '{command[0]}' program. Please install"
+                                   " it on your host system.")
+            logging.debug(f"% {' '.join(command)} {path}")
+            self.process = subprocess.Popen(command + [path],
+                                            stdout=subprocess.PIPE)
+            self.handle = self.process.stdout
+        else:
+            self.handle = open(path, "rb")
+        self.pos = 0
+
+    def read(self, size):
+        """Read exactly size bytes (less only at the end of the stream)."""
+        ret = b""
+        while len(ret) < size:
+            data = self.handle.read(size - len(ret))
+            if not data:
+                break
+            ret += data
+        self.pos += len(ret)
+        return ret
+
+    def skip(self, size):
+        while size > 0:
+            data = self.read(min(size, read_size))
+            if not data:
+                raise RuntimeError(f"Unexpected end of file: {self.path}")
+            size -= len(data)
+
+    def align(self):
+        """Skip the padding to the next multiple of 4 bytes."""
+        self.skip(-self.pos % 4)
+
+    def close(self):
+        self.handle.close()
+        if self.process:
+            # The process gets killed if not all output was read
+            self.process.kill()
+            self.process.wait()
+
+
+def parse_header(path, data):
+    if data[:6] != header_magic:
+        raise RuntimeError(f"Invalid cpio header in {path}: {data[:6]}")
+    ret = {}
+    for i, field in enumerate(header_fields):
+        start = 6 + i * 8
+        ret[field] = int(data[start:start + 8], 16)
+    return ret
+
+
+def read_next_header(path, reader):
+    """:returns: the next header, or None at the end of the stream. Multiple
+                 archives may follow each other, with NUL bytes between
+                 them."""
+    data = reader.read(header_size)
+    while data and data[:4] == b"\0\0\0\0":
+        data = data[4:] + reader.read(4)
+    if not data.strip(b"\0"):
+        return None
+    if len(data) < header_size:
+        raise RuntimeError(f"Unexpected end of file: {path}")
+    return parse_header(path, data)
+
+
+def entries(path, extract=None):
+    """Read all entries of an initramfs file.
+
+    :param path: path to the initramfs file
+    :param extract: function that gets the entry and returns True if the
+                    data of the file should be read. The data of symlinks
+                    (the link target) is always read.
+    :returns: generator of (entry, data) with entry as dict: {"name": ...,
+              "mode": ..., "uid": ..., "gid": ..., "mtime": ..., "size": ...,
+              ...} (see header_fields) and data as bytes, or None if it was
+              not read
+    """
+    reader = Reader(path)
+    try:
+        while True:
+            entry = read_next_header(path, reader)
+            if entry is None:
+                return
+            name = reader.read(entry["namesize"])
+            entry["name"] = name.rstrip(b"\0").decode("utf-8",
+                                                      errors="replace")
+            reader.align()
+
+            if entry["name"] == trailer:
+                continue
+
+            data = None
+            if stat.S_ISLNK(entry["mode"]) or (extract and extract(entry)):
+                data = reader.read(entry["size"])
+                if len(data) != entry["size"]:
+                    raise RuntimeError(f"Unexpected end of file: {path}")
+            else:
+                reader.skip(entry["size"])
+            reader.align()
+            yield (entry, data)
+    finally:
+        reader.close()
+
+
+def format_entry(entry, data=None):
+    """:param data: the link target (of symlinks)
+    :returns: a line like "ls -l" would print for the entry"""
+    mtime = time.strftime("%Y-%m-%d %H:%M", time.gmtime(entry["mtime"]))
+    ret = (f"{stat.filemode(entry['mode'])} {entry['uid']:>4} "
+           f"{entry['gid']:>4} {entry['size']:>9} {mtime} {entry['name']}")
+    if stat.S_ISLNK(entry["mode"]) and data is not None:
+        ret += f" -> {data.decode('utf-8', errors='replace')}"
+    return ret
+
+
+def ls(path):
+    """:returns: list of lines like "ls -l" would print for all entries"""
+    return [format_entry(entry, data) for entry, data in entries(path)]
+
+
+def get_target_path(target, name):
+    """:returns: path of an entry below target, or None if the name would
+                 point outside of target: with "..", or through a symlink
+                 that was extracted before (initramfs files have absolute
+                 symlinks, e.g. /bin/sh -> /bin/busybox)"""
+    name = os.path.normpath(name.lstrip("/"))
+    if name == "." or name.startswith("../") or name == "..":
+        return None
+    path = target
+    for part in name.split("/")[:-1]:
+        path = f"{path}/{part}"
+        if os.path.islink(path):
+            return None
+    return f"{target}/{name}"
+
+
+def matches(name, patterns):
+    """:param patterns: list of fnmatch patterns, e.g. ["init", "lib/*"]. A
+                        folder's name also matches all files inside of it.
+    """
+    name = os.path.normpath(name.lstrip("/"))
+    for pattern in patterns:
+        pattern = os.path.normpath(pattern.lstrip("/"))
+        if fnmatch.fnmatch(name, pattern) or \
+                name.startswith(f"{pattern}/"):
+            return True
+    return False
+
+
+def extract(path, target, patterns=None):
+    """Extract files from an initramfs. Device nodes and other special files
+    can't be created without root privileges, so they get skipped.
+
+    :param path: path to the initramfs file
+    :param target: folder to extract the files to
+    :param patterns: only extract the files matching these fnmatch patterns,
+                     see matches(). Default: extract everything.
+    :returns: amount of extracted entries
+    """
+    def is_selected(entry):
+        return not patterns or matches(entry["name"], patterns)
+
+    def want_data(entry):
+        return stat.S_ISREG(entry["mode"]) and is_selected(entry)
+
+    ret = 0
+    dirs = []
+    os.makedirs(target, exist_ok=True)
+    for entry, data in entries(path, want_data):
+        if not is_selected(entry):
+            continue
+        # The root folder of the archive is the target folder itself
+        if os.path.normpath(entry["name"].lstrip("/")) == ".":
+            continue
+        path_target = get_target_path(target, entry["name"])
+        if not path_target:
+            logging.warning(f"WARNING: skipping {entry['name']}: outside of"
+                            " the target folder")
+            continue
+        mode = entry["mode"]
+        if not stat.S_ISDIR(mode) and os.path.isdir(path_target) and \
+                not os.path.islink(path_target):
+            logging.warning(f"WARNING: skipping {entry['name']}: a folder"
+                            " with the same name exists")
+            continue
+        os.makedirs(os.path.dirname(path_target), exist_ok=True)
+        if stat.S_ISDIR(mode):
+            # Replace symlinks, don't follow them
+            if os.path.islink(path_target):
+                os.unlink(path_target)
+            os.makedirs(path_target, exist_ok=True)
+            dirs.append((path_target, entry))
+        elif stat.S_ISREG(mode):
+            if os.path.lexists(path_target):
+                os.unlink(path_target)
+            with open(path_target, "wb") as handle:
+                handle.write(data)
+            os.chmod(path_target, stat.S_IMODE(mode))
+            os.utime(path_target, (entry["mtime"], entry["mtime"]))
+        elif stat.S_ISLNK(mode):
+            if os.path.lexists(path_target):
+                os.unlink(path_target)
+            os.symlink(data.decode("utf-8"), path_target)
+        else:
+            logging.verbose(f"initramfs: skipping special file"
+                            f" {entry['name']}")
+            continue
+        ret += 1
+
+    # Set folder permissions last, so files can be written into read-only
+    # folders first
+    for path_target, entry in reversed(dirs):
+        # A later entry may have replaced the folder with a symlink
+        if os.path.islink(path_target):
+            continue
+        os.chmod(path_target, stat.S_IMODE(entry["mode"]) | stat.S_IWUSR)
+        os.utime(path_target, (entry["mtime"], entry["mtime"]))
+    return ret
+
+
+def sizes(path):
+    """:returns: {name: size} of all entries (folders have size 0)"""
+    return {os.path.normpath(entry["name"].lstrip("/")): entry["size"]
+            for entry, _ in entries(path)}
+
+
+def diff(path_old, path_new):
+    """Compare the files of two initramfs builds.
+
+    :returns: sorted list of (name, size_old, size_new) for all entries that
+              were added, removed or changed their size. size_old/size_new
+              is None if the entry does not exist in that initramfs.
+    """
+    old = sizes(path_old)
+    new = sizes(path_new)
+    ret = []
+    for name in sorted(set(old) | set(new)):
+        size_old = old.get(name)
+        size_new = new.get(name)
+        if size_old != size_new:
+            ret.append((name, size_old, size_new))
+    return ret
+
+
+def format_diff(path_old, path_new, changes):
+    """:param changes: from diff()
+    :returns: lines of a table with the size changes"""
+    ret = []
+    total = 0
+    for name, size_old, size_new in changes:
+        change = (size_new or 0) - (size_old or 0)
+        total += change
+        if size_old is None:
+            state = "added"
+        elif size_new is None:
+            state = "removed"
+        else:
+            state = "changed"
+        ret.append(f"{change:>+10} {state:<7} {name}")
+    ret.append(f"{total:>+10} total (compressed:"
+               f" {os.path.getsize(path_new) - os.path.getsize(path_old):+})")
+    return ret
@@ -24,8 +24,8 @@ def package_from_aports(args, pkgname_depend):
     version = apkbuild["pkgver"] + "-r" + apkbuild["pkgrel"]
 
     # Return the dict
-    logging.verbose(
-        f"{pkgname_depend}: provided by: {pkgname}-{version} in {aport}")
+    logging.verbose("%s: provided by: %s-%s in %s", pkgname_depend, pkgname,
+                    version, aport)
     return {"pkgname": pkgname,
             "depends": apkbuild["depends"],
             "version": version}
@@ -46,7 +46,7 @@ def package_provider(args, pkgname, pkgnames_install, suffix="native"):
         return None
 
     # 1. Only one provider
-    logging.verbose(f"{pkgname}: provided by: {', '.join(providers)}")
+    logging.verbose("%s: provided by: %s", pkgname, ", ".join(providers))
     if len(providers) == 1:
         return list(providers.values())[0]
 
@@ -171,11 +171,12 @@ def recurse(args, pkgnames, suffix="native"):
 
         # Append to todo/ret (unless it is a duplicate)
         if pkgname in ret:
-            logging.verbose(f"{pkgname}: already found")
+            logging.verbose("%s: already found", pkgname)
         else:
             if not is_conflict:
                 depends = package["depends"]
-                logging.verbose(f"{pkgname}: depends on: {','.join(depends)}")
+                logging.verbose("%s: depends on: %s", pkgname,
+                                ",".join(depends))
                 if depends:
                     todo += depends
                     for dep in depends:
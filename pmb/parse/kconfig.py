@@ -1,11 +1,13 @@
 # Copyright 2023 Attila Szollosi
 # SPDX-License-Identifier: GPL-3.0-or-later
+import functools
 import glob
+import hashlib
+import json
 import logging
 import re
 import os
 
-import pmb.build
 import pmb.config
 import pmb.parse
 import pmb.helpers.pmaports
@@ -29,74 +31,115 @@ def get_all_component_names():
     return ret
 
 
+@functools.lru_cache(maxsize=16)
+def parse_config(config):
+    """
+    Parse a kernel config in one pass. Options that are not set ("# CONFIG_X
+    is not set") are not in the result, like options that don't exist.
+
+    :param config: full kernel config as string
+    :returns: dict of option name to value, e.g. {"EXT4_FS": "y",
+              "DEFAULT_HOSTNAME": '"(none)"'}. Don't modify it, the result
+              is cached.
+    """
+    ret = {}
+    for line in config.splitlines():
+        if not line.startswith("CONFIG_"):
+            continue
+        option, sep, value = line[7:].partition("=")
+        if sep and option not in ret:
+            ret[option] = value
+    return ret
+
+
+def get_str(config, option):
+    """
+    :param config: full kernel config as string, or the result of
+                   parse_config()
+    :param option: name of the option, e.g. DEFAULT_HOSTNAME
+    :returns: value of a string option without the quotes, or None if the
+              option is not set to a string
+    """
+    if isinstance(config, str):
+        config = parse_config(config)
+    value = config.get(option)
+    if value and len(value) > 1 and value[0] == value[-1] == '"':
+        return value[1:-1]
+    return None
+
+
 def is_set(config, option):
     """
     Check, whether a boolean or tristate option is enabled
     either as builtin or module.
 
-    :param config: full kernel config as string
+    :param config: full kernel config as string, or the result of
+                   parse_config()
     :param option: name of the option to check, e.g. EXT4_FS
     :returns: True if the check passed, False otherwise
     """
-    return re.search("^CONFIG_" + option + "=[ym]$", config, re.M) is not None
+    if isinstance(config, str):
+        config = parse_config(config)
+    return config.get(option) in ["y", "m"]
 
 
 def is_set_str(config, option, string):
     """
     Check, whether a config option contains a string as value.
 
-    :param config: full kernel config as string
+    :param config: full kernel config as string, or the result of
+                   parse_config()
     :param option: name of the option to check, e.g. EXT4_FS
     :param string: the expected string
     :returns: True if the check passed, False otherwise
     """
-    match = re.search("^CONFIG_" + option + "=\"(.*)\"$", config, re.M)
-    if match:
-        return string == match.group(1)
-    else:
-        return False
+    return get_str(config, option) == string
 
 
 def is_in_array(config, option, string):
     """
     Check, whether a config option contains string as an array element
 
-    :param config: full kernel config as string
+    :param config: full kernel config as string, or the result of
+                   parse_config()
     :param option: name of the option to check, e.g. EXT4_FS
     :param string: the string expected to be an element of the array
     :returns: True if the check passed, False otherwise
     """
-    match = re.search("^CONFIG_" + option + "=\"(.*)\"$", config, re.M)
-    if match:
-        values = match.group(1).split(",")
-        return string in values
-    else:
+    value = get_str(config, option)
+    if value is None:
         return False
+    return string in value.split(",")
 
 
 def check_option(component, details, config, config_path, option,
-                 option_value):
+                 option_value, warnings=None):
     """
     Check, whether one kernel config option has a given value.
 
     :param component: name of the component to test (postmarketOS, waydroid, …)
     :param details: print all warnings if True, otherwise one per component
-    :param config: full kernel config as string
+    :param config: full kernel config as string, or the result of
+                   parse_config()
     :param config_path: full path to kernel config file
     :param option: name of the option to check, e.g. EXT4_FS
     :param option_value: expected value, e.g. True, "str", ["str1", "str2"]
+    :param warnings: optional list, the printed warning gets appended
     :returns: True if the check passed, False otherwise
     """
     def warn_ret_false(should_str):
         config_name = os.path.basename(config_path)
         if details:
-            logging.warning(f"WARNING: {config_name}: CONFIG_{option} should"
-                            f" {should_str} ({component}):"
-                            f" https://wiki.postmarketos.org/wiki/kconfig#CONFIG_{option}")
+            message = (f"WARNING: {config_name}: CONFIG_{option} should"
+                       f" {should_str} ({component}):"
+                       f" https://wiki.postmarketos.org/wiki/kconfig#CONFIG_{option}")
         else:
-            logging.warning(f"WARNING: {config_name} isn't configured properly"
-                            f" ({component}), run 'pmbootstrap kconfig check'"
-                            " for details!")
+            message = (f"WARNING: {config_name} isn't configured properly"
+                       f" ({component}), run 'pmbootstrap kconfig check'"
+                       " for details!")
+        logging.warning(message)
+        if warnings is not None:
+            warnings.append(message)
         return False
 
     if isinstance(option_value, list):
@@ -118,7 +161,7 @@ def check_option(component, details, config, config_path, option,
 
 
 def check_config_options_set(config, config_path, config_arch, options,
-                             component, pkgver, details=False):
+                             component, pkgver, details=False, warnings=None):
     """
     Check, whether all the kernel config passes all rules of one component.
 
@@ -137,18 +180,41 @@ def check_config_options_set(config, config_path, config_arch, options,
     :param component: name of the component to test (postmarketOS, waydroid, …)
     :param pkgver: kernel version
     :param details: print all warnings if True, otherwise one per component
+    :param warnings: optional list, printed warnings get appended
     :returns: True if the check passed, False otherwise
     """
+    if isinstance(config, str):
+        config = parse_config(config)
+
     ret = True
+    for option, option_value in compile_options(options, config_arch,
+                                                pkgver):
+        if not check_option(component, details, config, config_path,
+                            option, option_value, warnings):
+            ret = False
+            # Stop after one non-detailed error
+            if not details:
+                return False
+    return ret
+
+
+def compile_options(options, config_arch, pkgver):
+    """
+    Select the rules of one component, that apply to a kernel version and
+    architecture.
+
+    :param options: kconfig_options* var passed from pmb/config/__init__.py,
+                    see check_config_options_set()
+    :param config_arch: architecture name (alpine format, e.g. aarch64, x86_64)
+    :param pkgver: kernel version
+    :returns: list of (option, option_value) tuples, e.g.
+              [("EXT4_FS", True), ("DEFAULT_HOSTNAME", "(none)")]
+    """
+    ret = []
     for rules, archs_options in options.items():
         # Skip options irrelevant for the current kernel's version
         # Example rules: ">=4.0 <5.0"
-        skip = False
-        for rule in rules.split(" "):
-            if not pmb.parse.version.check_string(pkgver, rule):
-                skip = True
-                break
-        if skip:
+        if not all(version_check(pkgver, rule) for rule in rules.split(" ")):
             continue
 
         for archs, options in archs_options.items():
@@ -159,19 +225,19 @@ def check_config_options_set(config, config_path, config_arch, options,
                 architectures = archs.split(" ")
                 if config_arch not in architectures:
                     continue
-
-            for option, option_value in options.items():
-                if not check_option(component, details, config, config_path,
-                                    option, option_value):
-                    ret = False
-                    # Stop after one non-detailed error
-                    if not details:
-                        return False
+            ret += options.items()
     return ret
 
 
+@functools.lru_cache(maxsize=None)
+def version_check(pkgver, rule):
+    """ Cached pmb.parse.version.check_string(), the same rules get checked
+        for each kernel config. """
+    return pmb.parse.version.check_string(pkgver, rule)
+
+
 def check_config(config_path, config_arch, pkgver, components_list=[],
-                 details=False, enforce_check=True):
+                 details=False, enforce_check=True, warnings=None):
     """
     Check, whether one kernel config passes the rules of multiple components.
 
@@ -183,12 +249,35 @@ def check_config(config_path, config_arch, pkgver, components_list=[],
     :param enforce_check: set to False to not fail kconfig check as long as
                           everything in kconfig_options is set correctly, even
                           if additional components are checked
+    :param warnings: optional list, printed warnings get appended
     :returns: True if the check passed, False otherwise
     """
     logging.debug(f"Check kconfig: {config_path}")
     with open(config_path) as handle:
-        config = handle.read()
+        config = parse_config(handle.read())
 
+    results = []
+    for component, options in get_components(components_list).items():
+        result = check_config_options_set(config, config_path, config_arch,
+                                          options, component, pkgver, details,
+                                          warnings)
+        # We always enforce "postmarketOS" component and when explicitly
+        # requested
+        if enforce_check or component == "postmarketOS":
+            results += [result]
+
+    return all(results)
+
+
+def get_components(components_list):
+    """
+    Get the rules of the components a kernel config gets checked for.
+
+    :param components_list: what to check for, e.g. ["waydroid", "iwd"]
+    :returns: dict of component name to its kconfig_options* variable from
+              pmb/config/__init__.py, e.g. {"postmarketOS": {...},
+              "waydroid": {...}}
+    """
     # Devices in all categories need basic options
     # https://wiki.postmarketos.org/wiki/Device_categorization
     components_list = ["postmarketOS"] + components_list
@@ -217,27 +306,20 @@ def check_config(config_path, config_arch, pkgver, components_list=[],
         components[name] = getattr(pmb.config, pmb_config_var, None)
         assert components[name], f"invalid kconfig component name: {name}"
 
-    results = []
-    for component, options in components.items():
-        result = check_config_options_set(config, config_path, config_arch,
-                                          options, component, pkgver, details)
-        # We always enforce "postmarketOS" component and when explicitly
-        # requested
-        if enforce_check or component == "postmarketOS":
-            results += [result]
-
-    return all(results)
+    return components
 
 
-def check(args, pkgname, components_list=[], details=False, must_exist=True):
+def get_configs(args, pkgname, components_list=[], must_exist=True):
     """
-    Check for necessary kernel config options in a package.
+    Find the kernel configs of a package and what to check them for.
 
     :param pkgname: the package to check for, optionally without "linux-"
     :param components_list: what to check for, e.g. ["waydroid", "iwd"]
-    :param details: print all warnings if True, otherwise one generic warning
     :param must_exist: if False, just return if the package does not exist
-    :returns: True when the check was successful, False otherwise
+    :returns: list of parameters for check_config(), like:
+              [{"config_path": ".../linux-nokia-n900/config-nokia-n900.armv7",
+                "config_arch": "armv7", "pkgver": "5.15",
+                "components_list": ["nftables"], "enforce_check": True}, ...]
               None if the aport cannot be found (only if must_exist=False)
     """
     # Don't modify the original component_list (arguments are passed as
@@ -251,7 +333,6 @@ def check(args, pkgname, components_list=[], details=False, must_exist=True):
         flavor = pkgname
 
     # Read all kernel configs in the aport
-    ret = True
     aport = pmb.helpers.pmaports.find(args, "linux-" + flavor, must_exist=must_exist)
     if aport is None:
         return None
@@ -266,7 +347,8 @@ def check(args, pkgname, components_list=[], details=False, must_exist=True):
                 name not in components_list:
             components_list += [name]
 
-    for config_path in glob.glob(aport + "/config-*"):
+    ret = []
+    for config_path in sorted(glob.glob(aport + "/config-*")):
         # The architecture of the config is in the name, so it just needs to be
         # extracted
         config_name = os.path.basename(config_path)
@@ -280,12 +362,106 @@ def check(args, pkgname, components_list=[], details=False, must_exist=True):
                               "and that there is no excess punctuation "
                               "elsewhere in the name.")
 
-        config_arch = config_name_split[1]
-        ret &= check_config(config_path, config_arch, pkgver, components_list,
-                            details=details, enforce_check=enforce_check)
+        ret += [{"config_path": config_path,
+                 "config_arch": config_name_split[1],
+                 "pkgver": pkgver,
+                 "components_list": components_list,
+                 "enforce_check": enforce_check}]
     return ret
 
 
+def get_cache_key(config, details):
+    """
+    :param config: check_config() parameters from get_configs()
+    :param details: print all warnings if True, otherwise one per component
+    :returns: hash of everything that the result of check_config() depends
+              on: the kernel config's content, the rules of the components it
+              gets checked for (from pmb/config/__init__.py), version, arch
+              and the parameters
+    """
+    digest = hashlib.sha256()
+    with open(config["config_path"], "rb") as handle:
+        for block in iter(lambda: handle.read(1024 * 1024), b""):
+            digest.update(block)
+    key = {"config": digest.hexdigest(),
+           "config_name": os.path.basename(config["config_path"]),
+           "config_arch": config["config_arch"],
+           "pkgver": config["pkgver"],
+           "components": get_components(config["components_list"]),
+           "enforce_check": config["enforce_check"],
+           "details": details}
+    key = json.dumps(key, sort_keys=True).encode()
+    return hashlib.sha256(key).hexdigest()
+
+
+def cache_read(cache_dir, key):
+    """ :returns: (result, warnings) of check_config(), or None """
+    try:
+        with open(f"{cache_dir}/{key}.json") as handle:
+            ret = json.load(handle)
+        return bool(ret["result"]), [str(w) for w in ret["warnings"]]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def cache_write(cache_dir, key, result, warnings):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = f"{cache_dir}/{key}.json"
+    with open(f"{path}.new", "w") as handle:
+        json.dump({"result": result, "warnings": warnings}, handle)
+    os.replace(f"{path}.new", path)
+
+
+def check_configs(configs, details=False, cache_dir=None):
+    """
+    Check multiple kernel configs.
+
+    :param configs: list of check_config() parameters from get_configs()
+    :param details: print all warnings if True, otherwise one per component
+    :param cache_dir: store the results in this directory, and use them
+                      instead of checking configs again that did not change
+                      (see get_cache_key()). The warnings of cached results
+                      get printed again.
+    :returns: list of results in the same order as configs, like:
+              [{"passed": True, "warnings": [], "cached": False}, ...]
+    """
+    ret = []
+    for config in configs:
+        key = get_cache_key(config, details) if cache_dir else None
+        cached = cache_read(cache_dir, key) if cache_dir else None
+        if cached:
+            result, warnings = cached
+            for warning in warnings:
+                logging.warning(warning)
+        else:
+            warnings = []
+            result = check_config(**config, details=details,
+                                  warnings=warnings)
+            if cache_dir:
+                cache_write(cache_dir, key, result, warnings)
+        ret += [{"passed": result,
+                 "warnings": warnings,
+                 "cached": cached is not None}]
+    return ret
+
+
+def check(args, pkgname, components_list=[], details=False, must_exist=True):
+    """
+    Check for necessary kernel config options in a package.
+
+    :param pkgname: the package to check for, optionally without "linux-"
+    :param components_list: what to check for, e.g. ["waydroid", "iwd"]
+    :param details: print all warnings if True, otherwise one generic warning
+    :param must_exist: if False, just return if the package does not exist
+    :returns: True when the check was successful, False otherwise
+              None if the aport cannot be found (only if must_exist=False)
+    """
+    configs = get_configs(args, pkgname, components_list, must_exist)
+    if configs is None:
+        return None
+    return all(result["passed"] for result in check_configs(configs, details))
+
+
 def extract_arch(config_path):
     # Extract the architecture out of the config
     with open(config_path) as f:
@@ -1,6 +1,7 @@
 # Copyright 2023 Oliver Smith
 # SPDX-License-Identifier: GPL-3.0-or-later
 import fnmatch
+import os
 import pytest
 import sys
 
@@ -83,13 +84,152 @@ def test_packages_get_locally_built_apks(monkeypatch, args):
     assert fnmatch.fnmatch(ret[0], "*/hello-world-*.apk")
 
 
+def test_world_get_final():
+    func = pmb.chroot.apk.world_get_final
+    world_old = ["alpine-base", "unl0kr", "postmarketos-base>=3"]
+
+    assert func(world_old, [], []) == world_old
+    assert func(world_old, ["hello-world", "alpine-base"], []) == \
+        ["alpine-base", "unl0kr", "postmarketos-base>=3", "hello-world"]
+    assert func(world_old, ["postmarketos-base"], ["unl0kr"]) == \
+        ["alpine-base", "postmarketos-base>=3"]
+
+
+def test_install_is_satisfied(monkeypatch, args):
+    func = pmb.chroot.apk.install_is_satisfied
+    arch = "x86_64"
+    suffix = "native"
+
+    def block(pkgname, version, timestamp="1"):
+        return {"pkgname": pkgname, "version": version,
+                "timestamp": timestamp}
+
+    world = ["hello-world"]
+    installed = {"hello-world": block("hello-world", "1-r6"),
+                 "musl": block("musl", "1.2.4-r0")}
+    repo = {"hello-world": block("hello-world", "1-r6"),
+            "musl": block("musl", "1.2.4-r0")}
+    monkeypatch.setattr(pmb.chroot.apk, "world",
+                        lambda args, suffix: world)
+    monkeypatch.setattr(pmb.chroot.apk, "installed",
+                        lambda args, suffix: installed)
+    monkeypatch.setattr(pmb.parse.apkindex, "package",
+                        lambda args, package, arch, must_exist:
+                        repo.get(package))
+
+    to_add = ["hello-world", "musl"]
+    assert func(args, to_add, ["hello-world"], [], arch, suffix)
+
+    # Explicitly requested package is only installed as dependency
+    assert not func(args, to_add, ["musl"], [], arch, suffix)
+
+    # Conflicting package is installed
+    assert not func(args, to_add, ["hello-world"], ["musl"], arch, suffix)
+
+    # Dependency is missing
+    assert not func(args, to_add + ["busybox"], ["hello-world"], [], arch,
+                    suffix)
+
+    # Locally rebuilt package with the same version
+    repo["hello-world"] = block("hello-world", "1-r6", "2")
+    assert not func(args, to_add, ["hello-world"], [], arch, suffix)
+
+
+def test_install_is_satisfied_installed(monkeypatch, args):
+    func = pmb.chroot.apk.install_is_satisfied_installed
+    arch = "x86_64"
+    suffix = "native"
+
+    def block(pkgname, version, depends=[]):
+        return {"pkgname": pkgname, "version": version, "timestamp": "1",
+                "depends": depends}
+
+    hello = block("hello-world", "1-r6", ["so:libc.musl-x86_64.so.1",
+                                          "/bin/sh"])
+    musl = block("musl", "1.2.4-r0")
+    snapshot = {"packages": {"hello-world": hello, "musl": musl,
+                             "so:libc.musl-x86_64.so.1": musl},
+                "satisfied": set()}
+    repo = {"hello-world": dict(hello), "musl": dict(musl)}
+    aports = {}
+    monkeypatch.setattr(pmb.chroot.apk, "installed_snapshot",
+                        lambda args, suffix: snapshot)
+    monkeypatch.setattr(pmb.chroot.apk, "world",
+                        lambda args, suffix: ["hello-world"])
+    monkeypatch.setattr(pmb.parse.apkindex, "package",
+                        lambda args, package, arch, must_exist:
+                        repo.get(package))
+    monkeypatch.setattr(pmb.parse.depends, "package_from_aports",
+                        lambda args, pkgname: aports.get(pkgname))
+
+    assert func(args, ["hello-world"], arch, suffix)
+    assert func(args, ["hello-world", "!unl0kr"], arch, suffix)
+
+    # Only installed as dependency, not in world
+    assert not func(args, ["musl"], arch, suffix)
+
+    # Not installed
+    assert not func(args, ["hello-world", "busybox"], arch, suffix)
+
+    # Conflicting package is installed
+    assert not func(args, ["hello-world", "!musl"], arch, suffix)
+
+    # Newer version of a dependency in the binary repository
+    repo["musl"] = block("musl", "1.2.4-r1")
+    assert not func(args, ["hello-world"], arch, suffix)
+    repo["musl"] = dict(musl)
+
+    # Newer version in pmaports, only relevant when building
+    aports["hello-world"] = {"pkgname": "hello-world", "version": "1-r7"}
+    assert not func(args, ["hello-world"], arch, suffix)
+    assert func(args, ["hello-world"], arch, suffix, build=False)
+
+    # Same version in pmaports, but the binary package is missing (e.g. after
+    # "pmbootstrap zap -p") and would need to be built again
+    aports["hello-world"] = {"pkgname": "hello-world", "version": "1-r6"}
+    assert func(args, ["hello-world"], arch, suffix)
+    del repo["hello-world"]
+    assert not func(args, ["hello-world"], arch, suffix)
+    assert func(args, ["hello-world"], arch, suffix, build=False)
+
+
+def test_installed_snapshot(monkeypatch, args, tmpdir):
+    args.work = str(tmpdir)
+    suffix = "native"
+    path = f"{args.work}/chroot_{suffix}/lib/apk/db/installed"
+    os.makedirs(os.path.dirname(path))
+    with open(path, "w") as handle:
+        handle.write("P:hello-world\nV:1-r6\nA:x86_64\nt:1\n\n")
+
+    snapshot = pmb.chroot.apk.installed_snapshot(args, suffix)
+    assert list(snapshot["packages"].keys()) == ["hello-world"]
+    snapshot["satisfied"].add((suffix, "x86_64", "hello-world"))
+
+    # Cached until cleared
+    assert pmb.chroot.apk.installed_snapshot(args, suffix) is snapshot
+    pmb.chroot.apk.installed_clear_cache(args, suffix)
+    snapshot_new = pmb.chroot.apk.installed_snapshot(args, suffix)
+    assert snapshot_new is not snapshot
+    assert snapshot_new["satisfied"] == set()
+
+
 def test_install_run_apk(monkeypatch, args):
     global cmds_progress
     global cmds
+    global worlds
 
     func = pmb.chroot.apk.install_run_apk
     suffix = "chroot_native"
 
+    monkeypatch.setattr(pmb.chroot.apk, "world", lambda args, suffix: [])
+    monkeypatch.setattr(pmb.chroot.apk, "installed_clear_cache",
+                        lambda args, suffix: None)
+
+    def fake_world_write(args, world, suffix):
+        global worlds
+        worlds += [world]
+    monkeypatch.setattr(pmb.chroot.apk, "world_write", fake_world_write)
+
     def fake_chroot_root(args, command, suffix):
         global cmds
         cmds += [command]
@@ -101,9 +241,10 @@ def test_install_run_apk(monkeypatch, args):
     monkeypatch.setattr(pmb.helpers.apk, "apk_with_progress", fake_apk_progress)
 
     def reset_cmds():
-        global cmds_progress, cmds
+        global cmds_progress, cmds, worlds
         cmds = []
         cmds_progress = []
+        worlds = []
 
     # Simple add
     reset_cmds()
@@ -114,6 +255,7 @@ def test_install_run_apk(monkeypatch, args):
     assert cmds_progress == [["apk", "add", "postmarketos-base", "device-ppp",
                               "--no-interactive"]]
     assert cmds == []
+    assert worlds == []
 
     # Add and delete
     reset_cmds()
@@ -123,8 +265,8 @@ def test_install_run_apk(monkeypatch, args):
     func(args, to_add, to_add_local, to_del, suffix)
     assert cmds_progress == [["apk", "add", "postmarketos-base", "device-ppp",
                               "--no-interactive"]]
-    assert cmds == [["apk", "--no-progress", "del", "unl0kr",
-                     "--no-interactive"]]
+    assert cmds == []
+    assert worlds == [["postmarketos-base", "device-ppp"]]
 
     # Add with local package
     reset_cmds()
@@ -132,12 +274,11 @@ def test_install_run_apk(monkeypatch, args):
     to_add_local = ["/tmp/device-ppp.apk"]
     to_del = []
     func(args, to_add, to_add_local, to_del, suffix)
-    assert cmds_progress == [["apk", "add", "postmarketos-base", "device-ppp",
-                              "--no-interactive"]]
-    assert cmds == [["apk", "--no-progress", "add", "-u", "--virtual",
-                     ".pmbootstrap", "/tmp/device-ppp.apk", "--no-interactive"],
-                    ["apk", "--no-progress", "del", ".pmbootstrap",
+    assert cmds_progress == [["apk", "add", "-u", "--virtual", ".pmbootstrap",
+                              "/tmp/device-ppp.apk", "--no-interactive"]]
+    assert cmds == [["apk", "--no-progress", "del", ".pmbootstrap",
                      "--no-interactive"]]
+    assert worlds == [["postmarketos-base", "device-ppp"]]
 
     # Add with --no-network
     reset_cmds()
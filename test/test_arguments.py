@@ -4,7 +4,9 @@ import argparse
 
 import pytest
 
-from pmb.parse.arguments import toggle_other_boolean_flags
+import pmb_test  # noqa
+from pmb.parse.arguments import ActionNotFound, actions, get_action, \
+    get_parser, toggle_other_boolean_flags
 
 
 @pytest.fixture
@@ -25,3 +27,33 @@ def test_toggle_other_boolean_flags(example_cli_with_flags):
     expected_flags_true = other_flags + ["flag12"]
     for flag in expected_flags_true:
         assert getattr(args, flag)
+
+
+def test_get_action():
+    func = get_action
+    assert func([]) is None
+    assert func(["build", "hello-world"]) == "build"
+    assert func(["-y", "--details-to-stdout", "zap", "-a"]) == "zap"
+    assert func(["-p", "/tmp/pmaports", "status"]) == "status"
+
+    with pytest.raises(ActionNotFound):
+        func(["invalid-action"], False)
+
+
+def test_get_parser_only_builds_action():
+    parser = get_parser("build")
+    subparsers = parser._subparsers._group_actions[0].choices
+
+    # All actions show up in the help output
+    assert list(subparsers) == list(actions)
+
+    # Only the parser of the used action has arguments
+    def options(action):
+        return {opt for arg in subparsers[action]._actions
+                for opt in arg.option_strings}
+    assert "--strict" in options("build")
+    assert options("zap") == {"-h", "--help"}
+
+    args = parser.parse_args(["build", "--force", "hello-world"])
+    assert args.force
+    assert args.packages == ["hello-world"]
@@ -0,0 +1,65 @@
+# Copyright 2023 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+import importlib
+import os
+import sys
+import pytest
+
+import pmb_test  # noqa
+import pmb.helpers.du
+import pmb.helpers.logging
+
+# pmb.chroot.zap is the zap() function, not the module
+zap = importlib.import_module("pmb.chroot.zap")
+
+
+@pytest.fixture
+def args(tmpdir, request):
+    import pmb.parse
+    sys.argv = ["pmbootstrap.py", "init"]
+    args = pmb.parse.arguments()
+    args.log = args.work + "/log_testsuite.txt"
+    pmb.helpers.logging.init(args)
+    request.addfinalizer(pmb.helpers.logging.logfd.close)
+    args.work = str(tmpdir)
+    return args
+
+
+def test_trash(args):
+    func = zap.move_to_trash
+    for name in ["chroot_native", "chroot_rootfs_qemu-amd64"]:
+        os.makedirs(f"{args.work}/{name}/usr/bin")
+        with open(f"{args.work}/{name}/usr/bin/sh", "w") as handle:
+            handle.write("#!/bin/sh\n")
+
+    path = func(args, f"{args.work}/chroot_native")
+    assert not os.path.exists(f"{args.work}/chroot_native")
+    assert path.startswith(f"{args.work}/trash/chroot_native.")
+    assert os.path.exists(f"{path}/usr/bin/sh")
+
+    # Leftovers of previous runs get deleted too
+    os.makedirs(f"{args.work}/trash/chroot_buildroot_armhf.1/root")
+    func(args, f"{args.work}/chroot_rootfs_qemu-amd64")
+    assert len(os.listdir(f"{args.work}/trash")) == 3
+    size = sum(pmb.helpers.du.size(args, f"{args.work}/trash/{name}")
+               for name in os.listdir(f"{args.work}/trash"))
+    assert size > 0
+    assert zap.empty_trash(args) == size
+    assert os.listdir(f"{args.work}/trash") == []
+
+    # Nothing to do
+    assert zap.empty_trash(args) == 0
+
+    # Deleting in background: the size is not measured
+    os.makedirs(f"{args.work}/trash/chroot_native.2")
+    assert zap.empty_trash(args, background=True) is None
+
+
+def test_remove_files(args):
+    paths = []
+    for i in range(3):
+        paths.append(f"{args.work}/hello-{i}.apk")
+        with open(paths[-1], "wb") as handle:
+            handle.write(b"x" * 100)
+    assert zap.remove_files(args, paths) == 300
+    assert os.listdir(args.work) == []
@@ -0,0 +1,101 @@
+# Copyright 2023 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+import os
+import subprocess
+import sys
+import time
+import pytest
+
+import pmb_test  # noqa
+import pmb.ci
+import pmb.helpers.git
+import pmb.helpers.logging
+
+
+@pytest.fixture
+def args(request):
+    import pmb.parse
+    sys.argv = ["pmbootstrap.py", "init"]
+    args = pmb.parse.arguments()
+    args.log = args.work + "/log_testsuite.txt"
+    pmb.helpers.logging.init(args)
+    request.addfinalizer(pmb.helpers.logging.logfd.close)
+    return args
+
+
+def write_script(topdir, name, content):
+    path = f"{topdir}/.ci/{name}.sh"
+    with open(path, "w") as handle:
+        handle.write("#!/bin/sh -e\n"
+                     "# Description: test script\n"
+                     "# Options: native\n"
+                     "# https://postmarketos.org/pmb-ci\n"
+                     f"{content}\n")
+    os.chmod(path, 0o755)
+
+
+def test_run_scripts_parallel(args, tmpdir, caplog):
+    topdir = str(tmpdir)
+    os.mkdir(f"{topdir}/.ci")
+    for i in range(3):
+        write_script(topdir, f"sleep{i}", f"sleep 0.5; echo done {i} >&2")
+    scripts = pmb.ci.get_ci_scripts(topdir)
+    assert len(scripts) == 3
+
+    begin = time.monotonic()
+    pmb.ci.run_scripts_parallel(args, topdir, scripts, 3)
+    assert time.monotonic() - begin < 1.4
+    assert "done 2" in caplog.text
+    assert "CI SUMMARY" in caplog.text
+
+    # All scripts run, even if one fails
+    write_script(topdir, "sleep1", "echo broken; exit 1")
+    caplog.clear()
+    with pytest.raises(SystemExit):
+        pmb.ci.run_scripts_parallel(args, topdir, scripts, 2)
+    assert "CI scripts failed: sleep1" in caplog.text
+    assert "broken" in caplog.text
+    assert "done 2" in caplog.text
+
+
+def test_get_sync_changes(args, tmpdir):
+    topdir = str(tmpdir)
+
+    def git(*arguments):
+        return subprocess.run(["git", "-c", "user.name=t", "-c",
+                               "user.email=t@t"] + list(arguments),
+                              cwd=topdir, check=True, capture_output=True)
+
+    def write(path, content="x"):
+        os.makedirs(os.path.dirname(f"{topdir}/{path}"), exist_ok=True)
+        with open(f"{topdir}/{path}", "w") as handle:
+            handle.write(content)
+
+    for path in ["a", "b", "dir/c", "dir/d e", "dirty"]:
+        write(path)
+    git("init", "-q", ".")
+    git("add", ".")
+    git("commit", "-q", "-m", "init")
+    write("dirty", "uncommitted")
+    state = {"commit": pmb.helpers.git.rev_parse(args, topdir),
+             "dirty": pmb.helpers.git.get_changed_files(
+                 args, topdir, pmb.helpers.git.rev_parse(args, topdir))}
+    assert state["dirty"] == ["dirty"]
+
+    # Nothing changed since the sync: the dirty file gets synced again
+    func = pmb.ci.get_sync_changes
+    assert func(args, topdir, state) == (["dirty"], [])
+
+    # Committed, uncommitted, untracked, deleted and reverted changes
+    write("a", "committed")
+    git("commit", "-q", "-a", "-m", "change a")
+    write("dir/d e", "uncommitted")
+    write("new/f")
+    os.unlink(f"{topdir}/b")
+    git("checkout", "dirty")
+    assert func(args, topdir, state) == (["a", "dir/d e", "dirty", "new/f"],
+                                         ["b"])
+
+    # Commit of the last sync doesn't exist
+    state["commit"] = "0" * 40
+    assert func(args, topdir, state) is None
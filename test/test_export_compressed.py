@@ -0,0 +1,53 @@
+# Copyright 2023 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+import hashlib
+import importlib
+import os
+import shutil
+import subprocess
+import pytest
+
+import pmb_test  # noqa
+
+# pmb.export.compressed is the compressed() function, not the module
+compressed = importlib.import_module("pmb.export.compressed")
+
+
+def test_bmap():
+    ret = compressed.bmap("test.img", 10 * 4096 + 1,
+                          [(0, 0, "a" * 64), (4, 9, "b" * 64)])
+    assert "<BlocksCount> 11 </BlocksCount>" in ret
+    assert "<MappedBlocksCount> 7 </MappedBlocksCount>" in ret
+    assert f'<Range chksum="{"a" * 64}"> 0 </Range>' in ret
+    assert f'<Range chksum="{"b" * 64}"> 4-9 </Range>' in ret
+
+    # Checksum of the file with zeros in place of the checksum
+    checksum = ret.split("<BmapFileChecksum> ")[1].split(" ")[0]
+    zeros = ret.replace(checksum, "0" * 64)
+    assert hashlib.sha256(zeros.encode()).hexdigest() == checksum
+
+
+@pytest.mark.parametrize("method", ["zstd", "xz"])
+def test_compress(tmpdir, method):
+    if not shutil.which(method):
+        pytest.skip(f"{method} is not installed")
+    path = f"{tmpdir}/test.img"
+    data = os.urandom(3 * 4096)
+    with open(path, "wb") as handle:
+        handle.seek(100 * 4096)
+        handle.write(data)
+        handle.truncate(1024 * 4096)
+
+    extension = compressed.compressors[method][1]
+    target = f"{tmpdir}/test.img.{extension}"
+    compressed.compress(path, target, method)
+
+    uncompressed = subprocess.check_output([method, "-d", "-c", target])
+    with open(path, "rb") as handle:
+        assert uncompressed == handle.read()
+
+    with open(f"{tmpdir}/test.img.bmap") as handle:
+        bmap = handle.read()
+    checksum = hashlib.sha256(data).hexdigest()
+    assert f'<Range chksum="{checksum}"> 100-102 </Range>' in bmap
+    assert "<MappedBlocksCount> 3 </MappedBlocksCount>" in bmap
@@ -6,6 +6,7 @@ import time
 import pytest
 
 import pmb_test  # noqa
+import pmb.helpers.file
 import pmb.helpers.git
 import pmb.helpers.logging
 import pmb.parse.version
@@ -34,3 +35,61 @@ def test_file_is_older_than(args, tmpdir):
     assert func(tempfile, 9) is True
     assert func(tempfile, 10) is True
     assert func(tempfile, 11) is False
+
+
+def create_apkbuild(path, pkgname):
+    os.makedirs(f"{path}/{pkgname}")
+    with open(f"{path}/{pkgname}/APKBUILD", "w") as handle:
+        handle.write(f"pkgname={pkgname}\n"
+                     "pkgver=1.0_git20230101\n"
+                     "pkgrel=3\n"
+                     '_commit="0000"\n'
+                     'arch="all"\n')
+    return f"{path}/{pkgname}/APKBUILD"
+
+
+def test_file_edit_apkbuild(args, tmpdir):
+    path = create_apkbuild(str(tmpdir), "hello")
+    os.chmod(path, 0o640)
+    func = pmb.helpers.file.edit_apkbuild
+    func(path, {"pkgver": "1.0_git20231224", "pkgrel": 0, "_commit": "1111"},
+         ["_commit"])
+    apkbuild = pmb.parse.apkbuild(path)
+    assert apkbuild["pkgver"] == "1.0_git20231224"
+    assert apkbuild["pkgrel"] == "0"
+    assert apkbuild["_commit"] == "1111"
+    assert os.stat(path).st_mode & 0o777 == 0o640
+
+    # _commit is not in quotes: nothing gets changed
+    with open(path) as handle:
+        text = handle.read()
+    with pytest.raises(RuntimeError) as e:
+        func(path, {"pkgrel": 1, "_commit": "2222"})
+    assert "'_commit'" in str(e.value)
+    assert "'pkgrel'" not in str(e.value)
+    with open(path) as handle:
+        assert handle.read() == text
+    assert pmb.parse.apkbuild(path)["pkgrel"] == "0"
+
+
+def test_file_replace_apkbuilds(args, tmpdir, monkeypatch):
+    paths = {}
+    for i in range(20):
+        paths[f"hello-{i}"] = create_apkbuild(str(tmpdir), f"hello-{i}")
+    monkeypatch.setattr(pmb.helpers.pmaports, "find",
+                        lambda args, pkgname: os.path.dirname(paths[pkgname]))
+
+    func = pmb.helpers.file.replace_apkbuilds
+    func(args, {pkgname: {"pkgrel": 4, "_commit": pkgname}
+                for pkgname in paths}, ["_commit"])
+    for pkgname, path in paths.items():
+        assert pmb.parse.apkbuild(path)["pkgrel"] == "4"
+        assert pmb.parse.apkbuild(path)["_commit"] == pkgname
+
+    # One failure: all APKBUILDs get rolled back
+    changes = {pkgname: {"pkgrel": 5} for pkgname in paths}
+    changes["hello-7"] = {"pkgrel": 5, "pkgver": "invalid version"}
+    with pytest.raises(RuntimeError):
+        func(args, changes)
+    for path in paths.values():
+        assert pmb.parse.apkbuild(path)["pkgrel"] == "4"
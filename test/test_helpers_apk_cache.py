@@ -0,0 +1,68 @@
+# Copyright 2023 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+import os
+import sys
+import pytest
+
+import pmb_test  # noqa
+import pmb.helpers.apk_cache
+import pmb.helpers.logging
+import pmb.helpers.run
+
+
+@pytest.fixture
+def args(tmpdir, request):
+    import pmb.parse
+    sys.argv = ["pmbootstrap.py", "init"]
+    args = pmb.parse.arguments()
+    args.log = args.work + "/log_testsuite.txt"
+    pmb.helpers.logging.init(args)
+    request.addfinalizer(pmb.helpers.logging.logfd.close)
+    return args
+
+
+def write_apk(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as handle:
+        handle.write(content)
+
+
+def test_dedup(monkeypatch, args, tmpdir):
+    args.work = str(tmpdir)
+
+    cmds = []
+
+    def fake_root(args, cmd):
+        assert cmd[:2] == ["ln", "-f"]
+        cmds.append(cmd)
+        for target in cmd[2:-1]:
+            path = f"{cmd[-1]}/{os.path.basename(target)}"
+            os.unlink(path)
+            os.link(target, path)
+    monkeypatch.setattr(pmb.helpers.run, "root", fake_root)
+
+    # noarch package: same name and content in all caches
+    firmware = "firmware-1-r0.abcd1234.apk"
+    for arch in ["aarch64", "armv7", "x86_64"]:
+        write_apk(f"{args.work}/cache_apk_{arch}/{firmware}", "firmware")
+
+    # arch specific package: same name, different content
+    musl = "musl-1.2.4-r0.abcd1234.apk"
+    write_apk(f"{args.work}/cache_apk_aarch64/{musl}", "musl-aarch64")
+    write_apk(f"{args.work}/cache_apk_x86_64/{musl}", "musl-x86_64")
+
+    func = pmb.helpers.apk_cache
+    assert func.saved(args) == 0
+    assert func.dedup(args, dry=True) == 2 * len("firmware")
+    assert func.saved(args) == 0
+
+    assert cmds == []
+
+    assert func.dedup(args) == 2 * len("firmware")
+    assert len(cmds) == 2
+    assert func.saved(args) == 2 * len("firmware")
+    assert os.stat(f"{args.work}/cache_apk_x86_64/{firmware}").st_nlink == 3
+    assert os.stat(f"{args.work}/cache_apk_x86_64/{musl}").st_nlink == 1
+
+    # Nothing left to do
+    assert func.dedup(args) == 0
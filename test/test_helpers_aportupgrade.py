@@ -0,0 +1,196 @@
+# Copyright 2023 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+import http.server
+import json
+import sys
+import threading
+import time
+import pytest
+
+import pmb_test  # noqa
+import pmb.helpers.aportupgrade
+import pmb.helpers.http
+import pmb.helpers.logging
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """Stand-in for the GitHub API: serves the JSON from the server's
+    "responses" dict, and responds with 429 for "rate_limited" requests
+    until the rate limit was "reset"."""
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(self.path)
+            server.active += 1
+            server.active_max = max(server.active, server.active_max)
+        time.sleep(0.02)
+
+        try:
+            if self.path in server.rate_limited:
+                server.rate_limited.remove(self.path)
+                self.send_response(429)
+                self.send_header("Retry-After", "1")
+                self.end_headers()
+                return
+
+            if self.path not in server.responses:
+                self.send_response(404)
+                self.end_headers()
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            for key, value in server.response_headers.items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(json.dumps(server.responses[self.path]).encode())
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server(request):
+    ret = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    ret.lock = threading.Lock()
+    ret.requests = []
+    ret.responses = {}
+    ret.rate_limited = []
+    ret.response_headers = {}
+    ret.active = 0
+    ret.active_max = 0
+    ret.url = f"http://127.0.0.1:{ret.server_address[1]}"
+    threading.Thread(target=ret.serve_forever, daemon=True).start()
+    request.addfinalizer(ret.shutdown)
+    return ret
+
+
+@pytest.fixture
+def args(tmpdir, request):
+    import pmb.parse
+    sys.argv = ["pmbootstrap.py", "init"]
+    args = pmb.parse.arguments()
+    args.log = args.work + "/log_testsuite.txt"
+    pmb.helpers.logging.init(args)
+    request.addfinalizer(pmb.helpers.logging.logfd.close)
+    args.work = str(tmpdir)
+    return args
+
+
+def test_retrieve_rate_limit(args, server, monkeypatch):
+    monkeypatch.setattr(pmb.helpers.http, "host_limit", 2)
+    server.responses = {f"/{i}": i for i in range(8)}
+    server.rate_limited = ["/3"]
+
+    threads = [threading.Thread(target=pmb.helpers.http.retrieve_json,
+                                args=(f"{server.url}/{i}",))
+               for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert server.active_max == 2
+    assert len(server.requests) == 9
+    assert server.requests.count("/3") == 2
+
+    # Waiting for the reset takes too long
+    monkeypatch.setattr(pmb.helpers.http, "rate_limit_wait_max", 0)
+    server.rate_limited = ["/3"]
+    with pytest.raises(pmb.helpers.http.urllib.error.HTTPError):
+        pmb.helpers.http.retrieve_json(f"{server.url}/3")
+
+
+def test_retrieve_rate_limit_remaining(args, server, monkeypatch):
+    """A successful response says that no requests are left"""
+    monkeypatch.setattr(pmb.helpers.http, "host_blocked_until", {})
+    server.responses = {"/a": 1}
+    server.response_headers = {"X-RateLimit-Remaining": "0",
+                               "X-RateLimit-Reset": str(int(time.time()) +
+                                                        3600)}
+    assert pmb.helpers.http.retrieve_json(f"{server.url}/a") == 1
+
+    # Don't wait an hour for the reset
+    start = time.time()
+    with pytest.raises(RuntimeError) as e:
+        pmb.helpers.http.retrieve_json(f"{server.url}/a")
+    assert "Rate limit of 127.0.0.1" in str(e.value)
+    assert time.time() - start < 1
+    assert len(server.requests) == 1
+
+    # Short waits are fine
+    monkeypatch.setattr(pmb.helpers.http, "host_blocked_until", {})
+    server.response_headers = {"Retry-After": "1"}
+    assert pmb.helpers.http.retrieve_json(f"{server.url}/a") == 1
+    server.response_headers = {}
+    assert pmb.helpers.http.retrieve_json(f"{server.url}/a") == 1
+    assert time.time() - start >= 1
+
+
+def test_get_rate_limit_wait():
+    func = pmb.helpers.http.get_rate_limit_wait
+    assert func({}) is None
+    assert func({"Retry-After": "30"}) == 30
+    assert func({"X-RateLimit-Remaining": "10",
+                 "X-RateLimit-Reset": str(int(time.time() + 60))}) is None
+    assert 55 < func({"X-RateLimit-Remaining": "0",
+                      "X-RateLimit-Reset": str(int(time.time() + 60))}) <= 60
+    assert func({"RateLimit-Remaining": "0", "RateLimit-Reset": "0"}) == 0
+
+
+def test_retrieve_json_cached(args, server):
+    func = pmb.helpers.http.retrieve_json_cached
+    server.responses = {"/a": {"value": 1}}
+    assert func(args, f"{server.url}/a") == {"value": 1}
+    server.responses = {"/a": {"value": 2}}
+    assert func(args, f"{server.url}/a") == {"value": 1}
+    assert func(args, f"{server.url}/a", ttl=0) == {"value": 2}
+    assert server.requests == ["/a", "/a"]
+    assert func(args, f"{server.url}/b", allow_404=True) is None
+
+
+def test_upgrade_all(args, server, monkeypatch):
+    aportupgrade = pmb.helpers.aportupgrade
+    monkeypatch.setattr(aportupgrade, "GITHUB_API_BASE", server.url)
+    packages = {}
+    for i in range(20):
+        pkgname = f"hello-{i}"
+        packages[pkgname] = {
+            "pkgver": "1.0_git20230101",
+            "pkgrel": "3",
+            "_commit": "0" * 40,
+            "source": [f"https://github.com/pmos/{pkgname}/archive/x.tar.gz"],
+        }
+        sha = "0" * 40 if i % 2 else f"{i}" * 40
+        server.responses[f"/repos/pmos/{pkgname}/commits"] = [{
+            "sha": sha,
+            "commit": {"committer": {"date": "2023-12-24T10:00:00Z"}},
+        }]
+    packages["device-ignored"] = packages["hello-0"]
+    monkeypatch.setattr(pmb.helpers.pmaports, "get_list",
+                        lambda args: sorted(packages))
+    monkeypatch.setattr(pmb.helpers.pmaports, "get",
+                        lambda args, pkgname: packages[pkgname])
+
+    applied = []
+    monkeypatch.setattr(aportupgrade, "apply_changes",
+                        lambda args, pkgname, package, changes, batch:
+                        applied.append((pkgname, changes)))
+
+    args.all = True
+    args.ref = None
+    aportupgrade.upgrade_all(args)
+
+    # Lookups ran in parallel, but changes get applied in order
+    assert server.active_max > 1
+    assert len(server.requests) == 20
+    assert [pkgname for pkgname, _ in applied] == \
+        sorted(set(packages) - {"device-ignored"})
+    assert dict(applied)["hello-2"] == {"_commit": "2" * 40,
+                                        "pkgver": "1.0_git20231224",
+                                        "pkgrel": 0}
+    assert dict(applied)["hello-1"] is None
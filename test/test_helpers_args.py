@@ -0,0 +1,59 @@
+# Copyright 2023 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+""" Test pmb/helpers/args.py """
+import copy
+import sys
+import pytest
+
+import pmb_test  # noqa
+import pmb.config
+import pmb.config.pmaports
+import pmb.helpers.args
+import pmb.helpers.logging
+import pmb.parse
+
+
+def test_args_deviceinfo_lazy(monkeypatch):
+    calls = []
+
+    def deviceinfo(args, device=None, kernel=None):
+        calls.append(args.device)
+        return {"arch": pmb.config.arch_native}
+    monkeypatch.setattr(pmb.parse, "deviceinfo", deviceinfo)
+
+    args = pmb.helpers.args.Args(device="qemu-amd64")
+    assert "deviceinfo" not in args
+    assert calls == []
+
+    # Parsed once on first access
+    assert args.deviceinfo["arch"] == pmb.config.arch_native
+    assert args.deviceinfo["arch"] == pmb.config.arch_native
+    assert calls == ["qemu-amd64"]
+    assert copy.deepcopy(args).deviceinfo == args.deviceinfo
+    assert calls == ["qemu-amd64"]
+
+    # Overwriting still works (e.g. pmbootstrap init)
+    args.deviceinfo = {"arch": "armv7"}
+    assert args.deviceinfo == {"arch": "armv7"}
+
+
+def test_args_deviceinfo_invalid_arch(monkeypatch):
+    monkeypatch.setattr(pmb.parse, "deviceinfo",
+                        lambda args: {"arch": "invalid-arch"})
+    args = pmb.helpers.args.Args(device="invalid-device")
+    with pytest.raises(ValueError) as e:
+        args.deviceinfo
+    assert "Arch 'invalid-arch' is not available" in str(e.value)
+    assert "deviceinfo" not in args
+
+
+@pytest.mark.parametrize("argv", [["kconfig", "check"], ["lint"], ["log"]])
+def test_args_pmaports_cfg_lazy(monkeypatch, argv):
+    """ pmaports.cfg is only read by the actions that use it """
+    def read_config(args):
+        raise RuntimeError("pmaports.cfg was read")
+    monkeypatch.setattr(pmb.config.pmaports, "read_config", read_config)
+    monkeypatch.setattr(sys, "argv", ["pmbootstrap.py"] + argv)
+    args = pmb.parse.arguments()
+    pmb.helpers.logging.logfd.close()
+    assert args.action == argv[0]
@@ -0,0 +1,119 @@
+# Copyright 2023 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+import os
+import subprocess
+import sys
+import time
+import pytest
+
+import pmb_test  # noqa
+import pmb.helpers.du
+import pmb.helpers.logging
+
+
+@pytest.fixture
+def args(request):
+    import pmb.parse
+    sys.argv = ["pmbootstrap.py", "init"]
+    args = pmb.parse.arguments()
+    args.log = args.work + "/log_testsuite.txt"
+    pmb.helpers.logging.init(args)
+    request.addfinalizer(pmb.helpers.logging.logfd.close)
+    return args
+
+
+def du(path):
+    """:returns: output of "du -ks" in bytes"""
+    output = subprocess.check_output(["du", "-ks", path]).decode()
+    return int(output.split("\t")[0]) * 1024
+
+
+def create_tree(path):
+    os.makedirs(f"{path}/a/b/c")
+    os.makedirs(f"{path}/d")
+    for i in range(20):
+        with open(f"{path}/a/b/file{i}", "wb") as handle:
+            handle.write(os.urandom(i * 1000))
+
+    # Hardlinks, symlink, sparse file
+    with open(f"{path}/a/b/c/big", "wb") as handle:
+        handle.write(os.urandom(300 * 1024))
+    os.link(f"{path}/a/b/c/big", f"{path}/d/big")
+    os.link(f"{path}/a/b/c/big", f"{path}/big")
+    os.symlink("a/b/c/big", f"{path}/symlink")
+    with open(f"{path}/d/sparse", "wb") as handle:
+        handle.truncate(100 * 1024 * 1024)
+        handle.write(b"data")
+
+
+def test_size(args, tmpdir):
+    path = str(tmpdir)
+    create_tree(path)
+    size = pmb.helpers.du.size(args, path)
+    assert size == du(path)
+    assert size < 1024 * 1024
+
+
+def test_size_cache(args, tmpdir):
+    path = str(tmpdir)
+    create_tree(path)
+    cache = {}
+    size = pmb.helpers.du.size(args, path, cache)
+    assert f"{path}/a/b" in cache
+
+    # Adding and removing files changes the mtime of the folder
+    os.unlink(f"{path}/d/big")
+    with open(f"{path}/a/b/c/new", "wb") as handle:
+        handle.write(os.urandom(100 * 1024))
+    assert pmb.helpers.du.size(args, path, cache) == du(path)
+    assert du(path) != size
+
+
+def test_size_permission_denied(args, tmpdir, monkeypatch):
+    path = str(tmpdir)
+    create_tree(path)
+    scan = pmb.helpers.du.scan
+
+    def scan_denied(folder):
+        if folder.endswith("/a/b"):
+            return None
+        return scan(folder)
+
+    size_du_calls = []
+
+    def size_du(args, folder):
+        size_du_calls.append(folder)
+        return du(folder)
+
+    monkeypatch.setattr(pmb.helpers.du, "scan", scan_denied)
+    monkeypatch.setattr(pmb.helpers.du, "size_du", size_du)
+    size = pmb.helpers.du.size(args, path)
+    assert size_du_calls == [f"{path}/a/b"]
+
+    # The hardlinks are counted in both scans
+    assert size == du(path) + os.lstat(f"{path}/big").st_blocks * 512
+
+
+@pytest.mark.skip_ci
+def test_size_benchmark(args):
+    """Compare with "du -ks" on the work dir (pytest -s to see the times)"""
+    if not os.path.exists(args.work):
+        pytest.skip(f"work dir not found: {args.work}")
+
+    begin = time.monotonic()
+    size_du = pmb.helpers.du.size_du(args, args.work)
+    time_du = time.monotonic() - begin
+
+    begin = time.monotonic()
+    cache = {}
+    size = pmb.helpers.du.size(args, args.work, cache)
+    time_size = time.monotonic() - begin
+
+    begin = time.monotonic()
+    pmb.helpers.du.size(args, args.work, cache)
+    time_cached = time.monotonic() - begin
+
+    print(f"du -ks: {size_du} bytes, {time_du:.3f}s")
+    print(f"pmb.helpers.du.size: {size} bytes, {time_size:.3f}s")
+    print(f"pmb.helpers.du.size (cached): {time_cached:.3f}s")
+    assert abs(size - size_du) < size_du / 100
@@ -126,6 +126,52 @@ def test_parse_channels_cfg(args):
     assert pmb.helpers.git.parse_channels_cfg(args) == exp
 
 
+def test_parse_channels_cfg_cache(args, monkeypatch, tmpdir):
+    """ Test the cache of parse_channels_cfg() in the work dir """
+    path, run_git = pmb_test.git.prepare_tmpdir(args, monkeypatch, tmpdir)
+    func = pmb.helpers.git.parse_channels_cfg
+    cfg = f"{pmb_test.const.testdata}/channels.cfg"
+    args.config_channels = None
+    args.aports = path
+    args.work = str(tmpdir)
+
+    # channels.cfg in origin/master, in packed-refs
+    shutil.copy(cfg, f"{tmpdir}/remote/channels.cfg")
+    run_git(["add", "channels.cfg"], "remote")
+    run_git(["commit", "-m", "add channels.cfg"], "remote")
+    run_git(["fetch", "origin"])
+    run_git(["pack-refs", "--all"])
+    commit = pmb.helpers.git.rev_parse(args, path, "origin/master")
+    assert pmb.helpers.git.read_ref(path, "refs/remotes/origin/master") == \
+        commit
+
+    def clear_cache():
+        pmb.helpers.other.cache["pmb.helpers.git.parse_channels_cfg"] = {}
+
+    # Parse with git show, cache is written
+    clear_cache()
+    ret = func(args)
+    assert ret["meta"] == {"recommended": "edge"}
+    assert os.path.exists(f"{tmpdir}/cache_git/channels_cfg.json")
+
+    # Cache is used, without running git
+    def run_user(*args, **kwargs):
+        raise AssertionError("git should not run")
+    clear_cache()
+    with monkeypatch.context() as m:
+        m.setattr(pmb.helpers.run, "user", run_user)
+        assert func(args) == ret
+
+    # Remote master changes (loose ref): parse again
+    with open(f"{tmpdir}/remote/channels.cfg", "a") as handle:
+        handle.write("\n[v99.99]\ndescription=Future\nbranch_pmaports=v99.99"
+                     "\nbranch_aports=9.99-stable\nmirrordir_alpine=v9.99\n")
+    run_git(["commit", "-am", "new channel"], "remote")
+    run_git(["fetch", "origin"])
+    clear_cache()
+    assert "v99.99" in func(args)["channels"]
+
+
 def test_pull_non_existing(args):
     assert pmb.helpers.git.pull(args, "non-existing-repo-name") == 1
 
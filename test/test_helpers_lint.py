@@ -41,3 +41,32 @@ def test_pmbootstrap_lint(args, tmpdir):
     # Lint error
     err_str = "invalid option 'pmb:invalid-opt'"
     assert err_str in pmb.helpers.lint.check(args, ["hello-world"])
+
+
+def test_split_output():
+    func = pmb.helpers.lint.split_output
+    apkbuilds = ["main/a/APKBUILD", "main/b/APKBUILD"]
+    output = ("SC:[AL1]:main/b/APKBUILD:3:first\n"
+              "IC:[AL2]:./main/a/APKBUILD:4:second\n"
+              "SC:[AL3]:main/b/APKBUILD:5:third\n")
+    assert func(output, apkbuilds) == {
+        "main/a/APKBUILD": "IC:[AL2]:./main/a/APKBUILD:4:second\n",
+        "main/b/APKBUILD": "SC:[AL1]:main/b/APKBUILD:3:first\n"
+                           "SC:[AL3]:main/b/APKBUILD:5:third\n"}
+    assert func("", apkbuilds) == {"main/a/APKBUILD": "",
+                                   "main/b/APKBUILD": ""}
+    assert func("unexpected error\n", apkbuilds) is None
+
+
+def test_get_cache_key():
+    func = pmb.helpers.lint.get_cache_key
+    key = func("main/a/APKBUILD", b"pkgname=a", "1.0-r0", "pmb:gpu-accel")
+    assert key == func("main/a/APKBUILD", b"pkgname=a", "1.0-r0",
+                       "pmb:gpu-accel")
+    assert key != func("main/b/APKBUILD", b"pkgname=a", "1.0-r0",
+                       "pmb:gpu-accel")
+    assert key != func("main/a/APKBUILD", b"pkgname=b", "1.0-r0",
+                       "pmb:gpu-accel")
+    assert key != func("main/a/APKBUILD", b"pkgname=a", "1.1-r0",
+                       "pmb:gpu-accel")
+    assert key != func("main/a/APKBUILD", b"pkgname=a", "1.0-r0", "")
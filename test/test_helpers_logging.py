@@ -0,0 +1,48 @@
+# Copyright 2023 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+import logging
+import os
+import sys
+import pytest
+
+import pmb_test  # noqa
+import pmb.helpers.logging
+
+
+@pytest.fixture
+def args(tmpdir, request):
+    import pmb.parse
+    sys.argv = ["pmbootstrap.py", "init"]
+    args = pmb.parse.arguments()
+    args.log = f"{tmpdir}/log_testsuite.txt"
+    pmb.helpers.logging.init(args)
+    request.addfinalizer(pmb.helpers.logging.logfd.close)
+    return args
+
+
+def read_log(args):
+    pmb.helpers.logging.flush()
+    with open(args.log) as handle:
+        return [line.split("] ", 1)[-1] for line in handle.read().splitlines()]
+
+
+def test_write_order(args):
+    assert pmb.helpers.logging.logthread
+    logging.debug("% echo hello")
+    pmb.helpers.logging.write(b"hello\nw\xc3")
+    pmb.helpers.logging.write(b"\xb6rld\n")
+    logging.debug("done")
+    assert read_log(args) == ["% echo hello", "hello", "wörld", "done"]
+
+
+def test_fork(args):
+    logging.debug("before fork")
+    pid = os.fork()
+    if pid == 0:
+        # Child process: logthread doesn't exist here
+        code = 0 if pmb.helpers.logging.logqueue is None else 1
+        logging.debug("child")
+        os._exit(code)
+    assert os.waitpid(pid, 0)[1] == 0
+    logging.debug("after fork")
+    assert read_log(args) == ["before fork", "child", "after fork"]
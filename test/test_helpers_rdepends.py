@@ -0,0 +1,83 @@
+# Copyright 2023 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+import os
+import sys
+import pytest
+
+import pmb_test  # noqa
+import pmb.helpers.logging
+import pmb.helpers.other
+import pmb.helpers.rdepends
+import pmb.helpers.repo
+
+
+@pytest.fixture
+def args(tmpdir, request):
+    import pmb.parse
+    sys.argv = ["pmbootstrap.py", "init"]
+    args = pmb.parse.arguments()
+    args.log = args.work + "/log_testsuite.txt"
+    pmb.helpers.logging.init(args)
+    request.addfinalizer(pmb.helpers.logging.logfd.close)
+    args.aports = f"{tmpdir}/pmaports"
+    args.work = f"{tmpdir}/work"
+    return args
+
+
+def write_apkbuild(args, pkgname, content):
+    os.makedirs(f"{args.aports}/main/{pkgname}", exist_ok=True)
+    with open(f"{args.aports}/main/{pkgname}/APKBUILD", "w") as handle:
+        handle.write(f"pkgname={pkgname}\npkgver=1\npkgrel=0\n{content}")
+
+
+def reset_cache():
+    pmb.helpers.other.cache["apkbuild"] = {}
+    pmb.helpers.other.cache["pmb.helpers.pmaports.apkbuilds"] = None
+    pmb.helpers.other.cache["pmb.helpers.rdepends.index"] = {}
+
+
+def test_rdepends(args, tmpdir, monkeypatch):
+    write_apkbuild(args, "libfoo", 'subpackages="libfoo-dev"\n'
+                   'provides="foo-compat=1"\n')
+    write_apkbuild(args, "app", 'makedepends="libfoo-dev>=1"\n'
+                   'subpackages="app-plugins:plugins"\n'
+                   'plugins() {\n\tdepends="foo-compat"\n}\n')
+    write_apkbuild(args, "app-extras", 'depends="app !foo-conflict"\n')
+    write_apkbuild(args, "unrelated", 'depends="musl"\n')
+
+    # Binary packages: "bin-tool" is not in pmaports
+    path_apkindex = f"{tmpdir}/APKINDEX"
+    with open(path_apkindex, "w") as handle:
+        handle.write("P:libfoo\nV:1-r0\nA:x86_64\nt:1\no:libfoo\n"
+                     "p:so:libfoo.so.1=1\n\n"
+                     "P:bin-tool\nV:2-r0\nA:x86_64\nt:1\no:bin-tool\n"
+                     "D:so:libfoo.so.1 app-extras\n\n")
+    monkeypatch.setattr(pmb.helpers.repo, "apkindex_files",
+                        lambda args, arch: [path_apkindex])
+
+    func = pmb.helpers.rdepends.get
+    assert func(args, "libfoo", "x86_64") == ["app", "bin-tool"]
+    assert func(args, "libfoo", "x86_64", True) == ["app", "app-extras",
+                                                    "bin-tool"]
+    assert func(args, "so:libfoo.so.1", "x86_64") == ["bin-tool"]
+    assert func(args, "app-extras", "x86_64") == ["bin-tool"]
+    assert func(args, "foo-conflict", "x86_64") == []
+    assert func(args, "invalid", "x86_64") == []
+
+    # Only the modified APKBUILD gets parsed again in the next session
+    path_index = pmb.helpers.rdepends.get_index_path(args, "x86_64")
+    assert os.path.exists(path_index)
+    write_apkbuild(args, "unrelated", 'depends="libfoo-dev"\n')
+    parsed = []
+    parse_apkbuild = pmb.helpers.rdepends.parse_apkbuild
+    monkeypatch.setattr(pmb.helpers.rdepends, "parse_apkbuild",
+                        lambda path: parsed.append(path) or
+                        parse_apkbuild(path))
+    reset_cache()
+    assert func(args, "libfoo", "x86_64") == ["app", "bin-tool", "unrelated"]
+    assert parsed == [f"{args.aports}/main/unrelated/APKBUILD"]
+
+    # Deleted aport
+    os.unlink(f"{args.aports}/main/app/APKBUILD")
+    reset_cache()
+    assert func(args, "libfoo", "x86_64") == ["bin-tool", "unrelated"]
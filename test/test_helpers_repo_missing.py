@@ -1,10 +1,13 @@
 # Copyright 2023 Oliver Smith
 # SPDX-License-Identifier: GPL-3.0-or-later
+import os
 import pytest
+import subprocess
 import sys
 
 import pmb_test  # noqa
 import pmb.build.other
+import pmb.helpers.repo_missing
 
 
 @pytest.fixture
@@ -136,3 +139,91 @@ def test_generate_output_format(args, monkeypatch):
             "version": "1.0-r0",
             "depends": ["depend1", "depend2"]}]
     assert func(args, "armhf", ["hello-world"]) == ret
+
+
+def test_generate_incremental(args, tmpdir, monkeypatch):
+    """ Test ...repo_missing.generate() with incremental=True """
+    tmpdir = str(tmpdir)
+    args.aports = f"{tmpdir}/pmaports"
+    args.work = f"{tmpdir}/work"
+
+    def write_apkbuild(pkgname, pkgrel=0, subpackages=""):
+        os.makedirs(f"{args.aports}/main/{pkgname}", exist_ok=True)
+        with open(f"{args.aports}/main/{pkgname}/APKBUILD", "w") as handle:
+            handle.write(f"pkgname={pkgname}\npkgver=1\npkgrel={pkgrel}\n"
+                         f'arch="all"\nsubpackages="{subpackages}"\n')
+
+    def git(*arguments):
+        subprocess.run(["git", "-c", "user.name=t", "-c", "user.email=t@t"] +
+                       list(arguments), cwd=args.aports, check=True,
+                       capture_output=True)
+
+    write_apkbuild("a", subpackages="a-dev")
+    write_apkbuild("b")
+    write_apkbuild("c")
+    with open(f"{args.aports}/pmaports.cfg", "w") as handle:
+        handle.write("[pmaports]\nchannel=edge\n")
+    git("init", "-q", ".")
+    git("add", ".")
+    git("commit", "-q", "-m", "init")
+
+    # Stubs: all packages need to be built, b depends on a-dev
+    binary = {"a": [], "b": [], "c": []}
+    monkeypatch.setattr(pmb.config.pmaports, "read_config",
+                        lambda args: {"channel": "edge"})
+    monkeypatch.setattr(pmb.helpers.repo_missing, "get_binary_versions",
+                        lambda args, arch, pkgnames: dict(binary))
+    monkeypatch.setattr(pmb.helpers.repo_missing, "filter_missing_packages",
+                        lambda args, arch, pkgnames: pkgnames)
+    checked = []
+
+    def generate_output_format(args, arch, pkgnames):
+        checked.extend(pkgnames)
+        return [{"pkgname": pkgname, "repo": "main", "version": "1-r0",
+                 "depends": ["a"] if pkgname == "b" else []}
+                for pkgname in pkgnames]
+    monkeypatch.setattr(pmb.helpers.repo_missing, "generate_output_format",
+                        generate_output_format)
+
+    def run():
+        pmb.helpers.other.cache["apkbuild"] = {}
+        pmb.helpers.other.cache["pmb.helpers.pmaports.apkbuilds"] = None
+        checked.clear()
+        ret = pmb.helpers.repo_missing.generate(args, "armhf", True,
+                                                incremental=True)
+        return (ret, sorted(checked))
+
+    # First run checks everything, second run nothing
+    assert run() == (["a", "b", "c"], ["a", "b", "c"])
+    assert run() == (["a", "b", "c"], [])
+
+    # Changed aport (not committed yet) and the packages depending on it
+    write_apkbuild("a", 1, "a-dev")
+    assert run() == (["a", "b", "c"], ["a", "b"])
+    git("commit", "-q", "-a", "-m", "a: bump")
+    assert run() == (["a", "b", "c"], ["a", "b"])
+    assert run() == (["a", "b", "c"], [])
+
+    # Changed binary package
+    binary["c"] = [["c", "1-r0"]]
+    assert run() == (["a", "b", "c"], ["c"])
+
+    # New and deleted aport
+    write_apkbuild("d")
+    git("rm", "-q", "-r", "main/c")
+    binary = {"a": [], "b": [], "d": []}
+    assert run() == (["a", "b", "d"], ["d"])
+
+    # Changed pmaports.cfg: check everything again
+    with open(f"{args.aports}/pmaports.cfg", "a") as handle:
+        handle.write("\n")
+    assert run() == (["a", "b", "d"], ["a", "b", "d"])
+
+    # Output format
+    ret = pmb.helpers.repo_missing.generate(args, "armhf", False,
+                                            incremental=True)
+    assert ret[1] == {"pkgname": "b", "repo": "main", "version": "1-r0",
+                      "depends": ["a"]}
+    with pytest.raises(RuntimeError):
+        pmb.helpers.repo_missing.generate(args, "armhf", True, "a",
+                                          incremental=True)
@@ -0,0 +1,66 @@
+# Copyright 2023 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+import os
+import pytest
+import sys
+
+import pmb_test  # noqa
+import pmb.config
+import pmb.helpers.logging
+import pmb.install
+import pmb.install._install
+import pmb.install.blockdevice
+
+
+@pytest.fixture
+def args(tmpdir, request, monkeypatch):
+    import pmb.parse
+    sys.argv = ["pmbootstrap.py", "init"]
+    args = pmb.parse.arguments()
+    args.log = args.work + "/log_testsuite.txt"
+    pmb.helpers.logging.init(args)
+    request.addfinalizer(pmb.helpers.logging.logfd.close)
+    args.work = str(tmpdir)
+    args.device = "qemu-amd64"
+    args.deviceinfo = {key: "" for key in pmb.config.deviceinfo_attributes}
+    monkeypatch.setattr(pmb.install, "get_root_filesystem",
+                        lambda args: "ext4")
+    return args
+
+
+def test_previous_image_state(args):
+    blockdevice = pmb.install.blockdevice
+    layout = pmb.install._install.get_partition_layout(False, False)
+
+    def state(size_root=1000, **kwargs):
+        ret = blockdevice.get_image_state(args, layout, 256, size_root, 0,
+                                          "pmOS_boot", "pmOS_root")
+        ret.update(kwargs)
+        return ret
+
+    # No previous installation
+    assert blockdevice.get_previous_image_state(args, state()) is None
+
+    img = f"{args.work}/chroot_native/home/pmos/rootfs/qemu-amd64.img"
+    os.makedirs(os.path.dirname(img))
+    with open(img, "w") as handle:
+        handle.truncate(1256 * 1024 * 1024)
+    blockdevice.save_image_state(args, state())
+
+    # Same or smaller rootfs: reuse
+    previous = blockdevice.get_previous_image_state(args, state(900))
+    assert previous["size_root"] == 1000
+    assert previous["images"] == blockdevice.get_image_stats(args)
+    assert blockdevice.get_previous_image_state(args, state()) == previous
+
+    # Rootfs doesn't fit anymore, different layout or labels
+    func = blockdevice.get_previous_image_state
+    assert func(args, state(1001)) is None
+    assert func(args, state(size_boot=128)) is None
+    assert func(args, state(root_label="pmOS_install")) is None
+    assert func(args, state(split=True)) is None
+
+    # Image was modified (e.g. converted to a sparse image)
+    with open(img, "a") as handle:
+        handle.write("sparse")
+    assert func(args, state()) is None
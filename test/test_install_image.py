@@ -0,0 +1,110 @@
+# Copyright 2023 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+import pytest
+import sys
+
+import pmb_test  # noqa
+import pmb.config
+import pmb.helpers.logging
+import pmb.install
+import pmb.install._install
+import pmb.install.image
+
+
+@pytest.fixture
+def args(request):
+    import pmb.parse
+    sys.argv = ["pmbootstrap.py", "init"]
+    args = pmb.parse.arguments()
+    args.log = args.work + "/log_testsuite.txt"
+    pmb.helpers.logging.init(args)
+    request.addfinalizer(pmb.helpers.logging.logfd.close)
+    args.device = "qemu-amd64"
+    args.direct_image = True
+    args.disk = None
+    args.rsync = False
+    args.full_disk_encryption = False
+    args.install_cgpt = True
+    args.deviceinfo = {key: "" for key in pmb.config.deviceinfo_attributes}
+    args.deviceinfo["arch"] = "x86_64"
+    return args
+
+
+def test_check_supported(args, monkeypatch):
+    func = pmb.install.image.check_supported
+    root_filesystem = "ext4"
+    monkeypatch.setattr(pmb.install, "get_root_filesystem",
+                        lambda args: root_filesystem)
+    func(args)
+
+    args.deviceinfo["boot_filesystem"] = "fat32"
+    func(args)
+
+    # Everything that needs loop devices or mounting
+    args.full_disk_encryption = True
+    args.deviceinfo["cgpt_kpart"] = "/boot/vmlinuz.kpart"
+    root_filesystem = "btrfs"
+    with pytest.raises(ValueError) as e:
+        func(args)
+    assert str(e.value) == ("--direct-image cannot be used with: --fde,"
+                            " ChromeOS kernel partition (use --no-cgpt),"
+                            " root filesystem btrfs")
+
+    args.full_disk_encryption = False
+    args.install_cgpt = False
+    root_filesystem = "ext4"
+    args.deviceinfo["boot_filesystem"] = "btrfs"
+    with pytest.raises(ValueError) as e:
+        func(args)
+    assert "boot filesystem btrfs" in str(e.value)
+
+
+def test_get_uuids(args):
+    func = pmb.install.image.get_uuids
+    uuids = func(args)
+    assert len(uuids["boot"]) == 36
+    assert len(uuids["root"]) == 36
+    assert uuids["boot"] != uuids["root"]
+
+    # FAT volume ID
+    args.deviceinfo["boot_filesystem"] = "fat16"
+    assert len(func(args)["boot"]) == len("ABCD-EF01")
+    assert func(args)["boot"][4] == "-"
+
+
+def test_get_partitions(args):
+    func = pmb.install.image.get_partitions
+    get_partition_layout = pmb.install._install.get_partition_layout
+    img = "/home/pmos/rootfs/qemu-amd64.img"
+
+    # Default: msdos, boot partition at 1 MiB
+    layout = get_partition_layout(False, False)
+    assert func(args, layout, 128, 1024, 0) == {
+        "boot": {"img": img, "start": 2048, "end": 262143,
+                 "img_size": 1152 * 1024 * 1024},
+        "root": {"img": img, "start": 262144, "end": 2359295,
+                 "img_size": 1152 * 1024 * 1024},
+    }
+
+    # GPT with reserved space, leave room for the backup GPT
+    args.deviceinfo["partition_type"] = "gpt"
+    args.deviceinfo["boot_part_start"] = "4096"
+    layout = get_partition_layout(True, False)
+    ret = func(args, layout, 128, 1024, 64)
+    assert [(p["start"], p["end"]) for p in ret.values()] == [
+        (4096, 262143), (262144, 393215), (393216, 2490334)]
+    assert list(ret) == ["boot", "reserve", "root"]
+
+    # Split images start at offset 0
+    ret = func(args, layout, 128, 1024, 64, True)
+    assert ret["boot"] == {"img": "/home/pmos/rootfs/qemu-amd64-boot.img",
+                           "start": 0, "end": 262143,
+                           "img_size": 128 * 1024 * 1024}
+    assert ret["root"]["img"] == "/home/pmos/rootfs/qemu-amd64-root.img"
+    assert ret["root"]["end"] == 1024 * 2048 - 1
+
+    # Boot partition doesn't fit
+    args.deviceinfo["boot_part_start"] = "300000"
+    with pytest.raises(RuntimeError) as e:
+        func(args, layout, 128, 1024, 64)
+    assert "Not enough space for the boot partition" in str(e.value)
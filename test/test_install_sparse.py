@@ -0,0 +1,94 @@
+# Copyright 2023 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+import os
+import struct
+
+import pmb_test  # noqa
+import pmb.install.sparse
+
+
+def unsparse(path):
+    """Decode a sparse image like simg2img.
+
+    :returns: (content, list of chunk types), DONT_CARE blocks are zeros
+    """
+    sparse = pmb.install.sparse
+    with open(path, "rb") as handle:
+        header = struct.unpack(sparse.header_format,
+                               handle.read(sparse.header_size))
+        (magic, major, minor, file_hdr_sz, chunk_hdr_sz, blk_sz, total_blks,
+         total_chunks, checksum) = header
+        assert magic == sparse.header_magic
+        assert (major, minor, file_hdr_sz, chunk_hdr_sz) == (1, 0, 28, 12)
+
+        ret = b""
+        types = []
+        for i in range(total_chunks):
+            chunk_type, _, blocks, total_sz = struct.unpack(
+                sparse.chunk_format, handle.read(sparse.chunk_size))
+            data = handle.read(total_sz - sparse.chunk_size)
+            types += [chunk_type]
+            if chunk_type == sparse.chunk_raw:
+                assert len(data) == blocks * blk_sz
+                ret += data
+            elif chunk_type == sparse.chunk_fill:
+                assert len(data) == 4
+                ret += data * (blocks * blk_sz // 4)
+            else:
+                assert chunk_type == sparse.chunk_dont_care
+                assert data == b""
+                ret += b"\0" * blocks * blk_sz
+        assert handle.read() == b""
+        assert len(ret) == total_blks * blk_sz
+    return (ret, types)
+
+
+def test_convert(tmpdir):
+    func = pmb.install.sparse.convert
+    sparse = pmb.install.sparse
+    block = sparse.block_size
+    path_raw = f"{tmpdir}/raw.img"
+    path_sparse = f"{tmpdir}/sparse.img"
+
+    # Hole, random data, zeros, 0xdeadbeef fill, data, hole (unaligned end)
+    data = os.urandom(3 * block)
+    with open(path_raw, "wb") as handle:
+        handle.seek(1024 * block)
+        handle.write(data)
+        handle.write(b"\0" * 2 * block)
+        handle.write(b"\xef\xbe\xad\xde" * block)
+        handle.write(data[:block])
+        handle.truncate(4096 * block + 100)
+    with open(path_raw, "rb") as handle:
+        raw = handle.read()
+
+    size = func(path_raw, path_sparse)
+    assert size == os.path.getsize(path_sparse)
+    assert size < 6 * block
+    content, types = unsparse(path_sparse)
+    assert content == raw + b"\0" * (block - 100)
+    assert types[1:5] == [sparse.chunk_raw, sparse.chunk_fill,
+                          sparse.chunk_fill, sparse.chunk_raw]
+    assert types[0] == types[-1] == sparse.chunk_dont_care
+
+    # File without holes: zeros get stored as FILL chunk
+    with open(path_raw, "wb") as handle:
+        handle.write(b"\0" * 300 * block)
+        handle.write(data)
+    func(path_raw, path_sparse)
+    content, types = unsparse(path_sparse)
+    assert content == b"\0" * 300 * block + data
+    assert types == [sparse.chunk_fill, sparse.chunk_raw]
+
+
+def test_convert_raw_chunk_max(tmpdir, monkeypatch):
+    sparse = pmb.install.sparse
+    monkeypatch.setattr(sparse, "raw_chunk_max", 2 * sparse.block_size)
+    data = os.urandom(5 * sparse.block_size)
+    path_raw = f"{tmpdir}/raw.img"
+    with open(path_raw, "wb") as handle:
+        handle.write(data)
+    sparse.convert(path_raw, f"{tmpdir}/sparse.img")
+    content, types = unsparse(f"{tmpdir}/sparse.img")
+    assert content == data
+    assert types == [sparse.chunk_raw] * 3
@@ -0,0 +1,98 @@
+# Copyright 2023 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+""" Test that the subsystems get imported on demand, and the startup time of
+    pmbootstrap """
+import subprocess
+import sys
+
+import pytest
+
+import pmb_test  # noqa
+import pmb.config
+import pmb.helpers.frontend
+
+
+def import_times(code):
+    """ Run python with -X importtime.
+
+    :returns: dict of module name to cumulative import time in µs """
+    cmd = [sys.executable, "-X", "importtime", "-c", code]
+    stderr = subprocess.run(cmd, cwd=pmb.config.pmb_src, check=True,
+                            stderr=subprocess.PIPE,
+                            universal_newlines=True).stderr
+    ret = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit():
+            ret[name.strip()] = int(cumulative)
+    return ret
+
+
+def test_startup_imports():
+    """ Heavy subsystems must not get imported on startup, only when the
+        action needs them. Prints the time for "import pmb" (pytest -s). """
+    times = import_times("import pmb")
+    print(f"import pmb: {times['pmb'] / 1000:.1f} ms")
+    for module in ["pmb.build", "pmb.install", "pmb.qemu", "pmb.flasher",
+                   "pmb.export", "pmb.netboot", "pmb.chroot",
+                   "pmb.helpers.http"]:
+        assert module not in times
+
+    # A regular run of argparse loads the modules of the action only
+    times = import_times("from pmb.parse.arguments import get_parser;"
+                         "get_parser('status').parse_args(['status'])")
+    assert "pmb.chroot" not in times
+
+
+# Imports only the modules of one action, then checks that all pmb.* names
+# used by the action's function (and the frontend helpers that it calls)
+# exist
+check_action = """
+import ast
+import importlib
+import inspect
+import sys
+
+import pmb.helpers.frontend as frontend
+
+
+def used_names(function, seen):
+    ret = []
+    if function.__name__ in seen:
+        return ret
+    seen.add(function.__name__)
+    for node in ast.walk(ast.parse(inspect.getsource(function))):
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+            helper = getattr(frontend, node.func.id, None)
+            if inspect.isfunction(helper) and \\
+                    helper.__module__ == frontend.__name__:
+                ret += used_names(helper, seen)
+        parts = []
+        while isinstance(node, ast.Attribute):
+            parts.insert(0, node.attr)
+            node = node.value
+        if parts and isinstance(node, ast.Name) and node.id == "pmb":
+            ret.append(parts)
+    return ret
+
+
+action = sys.argv[1]
+for module in frontend.action_modules.get(action, []):
+    importlib.import_module(module)
+for parts in used_names(getattr(frontend, action), set()):
+    obj = sys.modules["pmb"]
+    for part in parts:
+        assert hasattr(obj, part), f"{action}: pmb.{'.'.join(parts)}"
+        obj = getattr(obj, part)
+"""
+
+
+@pytest.mark.parametrize("action", sorted(
+    pmb.helpers.frontend.action_modules))
+def test_action_modules(action):
+    """ pmb.helpers.frontend.action_modules lists all subsystems that the
+        action uses """
+    subprocess.run([sys.executable, "-c", check_action, action],
+                   cwd=pmb.config.pmb_src, check=True)
@@ -0,0 +1,166 @@
+# Copyright 2023 Oliver Smith
+# SPDX-License-Identifier: GPL-3.0-or-later
+import gzip
+import lzma
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import pytest
+
+import pmb_test  # noqa
+import pmb.helpers.logging
+import pmb.parse.cpio
+
+
+@pytest.fixture
+def args(request):
+    import pmb.parse
+    sys.argv = ["pmbootstrap.py", "init"]
+    args = pmb.parse.arguments()
+    args.log = args.work + "/log_testsuite.txt"
+    pmb.helpers.logging.init(args)
+    request.addfinalizer(pmb.helpers.logging.logfd.close)
+    return args
+
+
+def pad(data):
+    return data + b"\0" * (-len(data) % 4)
+
+
+def newc(entries):
+    """Create a cpio archive in the newc format.
+
+    :param entries: list of (name, mode, data)
+    """
+    ret = b""
+    for ino, (name, mode, data) in enumerate(entries + [("TRAILER!!!", 0,
+                                                           b"")]):
+        name = name.encode() + b"\0"
+        fields = [ino, mode, 0, 0, 1, 1700000000, len(data), 0, 0, 0, 0,
+                  len(name), 0]
+        header = b"070701" + b"".join(b"%08X" % field for field in fields)
+        ret += pad(header + name) + pad(data)
+    return ret + b"\0" * (-len(ret) % 512)
+
+
+entries_old = [
+    (".", stat.S_IFDIR | 0o755, b""),
+    ("init", stat.S_IFREG | 0o755, b"#!/bin/sh\necho init\n"),
+    ("bin", stat.S_IFDIR | 0o755, b""),
+    ("bin/sh", stat.S_IFLNK | 0o777, b"busybox"),
+    ("bin/busybox", stat.S_IFREG | 0o755, b"\x7fELF" * 1000),
+    ("dev/console", stat.S_IFCHR | 0o600, b""),
+    ("lib/modules/a.ko", stat.S_IFREG | 0o644, b"a" * 100),
+    ("../evil", stat.S_IFREG | 0o644, b"evil"),
+]
+
+
+def write_initramfs(path, compression, entries=entries_old):
+    data = newc(entries)
+    if compression == "gzip":
+        with gzip.open(path, "wb") as handle:
+            handle.write(data)
+    elif compression == "xz":
+        with lzma.open(path, "wb", format=lzma.FORMAT_XZ,
+                       check=lzma.CHECK_CRC32) as handle:
+            handle.write(data)
+    elif compression == "none":
+        with open(path, "wb") as handle:
+            handle.write(data)
+    else:
+        if not shutil.which(compression):
+            pytest.skip(f"{compression} not installed")
+        with open(path, "wb") as handle:
+            subprocess.run([compression, "-q", "-c"], input=data,
+                           stdout=handle, check=True)
+    assert pmb.parse.cpio.get_compression(path) == compression
+
+
+@pytest.mark.parametrize("compression", ["gzip", "xz", "zstd", "lz4",
+                                         "none"])
+def test_ls(args, tmpdir, compression):
+    path = f"{tmpdir}/initramfs"
+    write_initramfs(path, compression)
+    lines = pmb.parse.cpio.ls(path)
+    assert len(lines) == len(entries_old)
+    assert lines[1].startswith("-rwxr-xr-x    0    0        20 2023-11-14")
+    assert lines[1].endswith(" init")
+    assert lines[3].startswith("lrwxrwxrwx")
+    assert lines[3].endswith("bin/sh -> busybox")
+    assert lines[5].startswith("crw-------")
+
+
+def test_multiple_archives(args, tmpdir):
+    """Archives can be concatenated, e.g. for early microcode updates"""
+    path = f"{tmpdir}/initramfs"
+    with gzip.open(path, "wb") as handle:
+        handle.write(newc(entries_old[:2]))
+        handle.write(newc(entries_old[2:4]))
+    names = [entry["name"] for entry, _ in pmb.parse.cpio.entries(path)]
+    assert names == [".", "init", "bin", "bin/sh"]
+
+
+def test_extract(args, tmpdir):
+    path = f"{tmpdir}/initramfs"
+    target = f"{tmpdir}/extracted"
+    write_initramfs(path, "gzip")
+    assert pmb.parse.cpio.extract(path, target) == 5
+    with open(f"{target}/init") as handle:
+        assert handle.read() == "#!/bin/sh\necho init\n"
+    assert os.stat(f"{target}/init").st_mode & 0o777 == 0o755
+    assert os.stat(f"{target}/init").st_mtime == 1700000000
+    assert os.readlink(f"{target}/bin/sh") == "busybox"
+    assert os.path.getsize(f"{target}/lib/modules/a.ko") == 100
+    assert not os.path.exists(f"{target}/dev/console")
+    assert not os.path.exists(f"{tmpdir}/evil")
+
+    # Selected files only
+    target = f"{tmpdir}/selected"
+    assert pmb.parse.cpio.extract(path, target, ["lib", "/ini*"]) == 2
+    assert sorted(os.listdir(target)) == ["init", "lib"]
+
+
+def test_extract_symlink_outside(args, tmpdir):
+    """Don't write through symlinks that point outside of the target"""
+    path = f"{tmpdir}/initramfs"
+    target = f"{tmpdir}/extracted"
+    outside = f"{tmpdir}/outside"
+    os.makedirs(outside)
+    write_initramfs(path, "gzip", [
+        ("evil", stat.S_IFLNK | 0o777, outside.encode()),
+        ("evil/x", stat.S_IFREG | 0o644, b"x"),
+        ("evil/dir", stat.S_IFDIR | 0o755, b""),
+        ("evil/dir/y", stat.S_IFREG | 0o644, b"y"),
+        ("rel", stat.S_IFLNK | 0o777, b"../outside"),
+        ("rel/z", stat.S_IFREG | 0o644, b"z"),
+        ("dir", stat.S_IFLNK | 0o777, outside.encode()),
+        ("dir", stat.S_IFDIR | 0o700, b""),
+    ])
+    assert pmb.parse.cpio.extract(path, target) == 4
+    assert os.listdir(outside) == []
+    assert os.stat(outside).st_mode & 0o777 != 0o700
+    assert os.readlink(f"{target}/evil") == outside
+    assert os.path.isdir(f"{target}/dir")
+    assert not os.path.islink(f"{target}/dir")
+
+
+def test_diff(args, tmpdir):
+    entries_new = [entry for entry in entries_old
+                   if entry[0] != "lib/modules/a.ko"]
+    entries_new[1] = ("init", stat.S_IFREG | 0o755, b"#!/bin/sh\n")
+    entries_new.append(("lib/modules/b.ko", stat.S_IFREG | 0o644, b"b" * 50))
+    write_initramfs(f"{tmpdir}/old", "gzip")
+    write_initramfs(f"{tmpdir}/new", "gzip", entries_new)
+
+    changes = pmb.parse.cpio.diff(f"{tmpdir}/old", f"{tmpdir}/new")
+    assert changes == [("init", 20, 10),
+                       ("lib/modules/a.ko", 100, None),
+                       ("lib/modules/b.ko", None, 50)]
+    lines = pmb.parse.cpio.format_diff(f"{tmpdir}/old", f"{tmpdir}/new",
+                                       changes)
+    assert lines[0] == "       -10 changed init"
+    assert lines[1] == "      -100 removed lib/modules/a.ko"
+    assert lines[2] == "       +50 added   lib/modules/b.ko"
+    assert lines[3].startswith("       -60 total")
@@ -84,6 +84,18 @@ def test_get_all_component_names(monkeypatch):
     assert func() == ["waydroid", "nftables"]
 
 
+def test_parse_config():
+    config = ("#\n"
+              "# CONFIG_EXT2_FS is not set\n"
+              "CONFIG_EXT4_FS=y\n"
+              'CONFIG_DEFAULT_HOSTNAME="(none)"\n'
+              "CONFIG_EXT4_FS=n\n")
+    assert pmb.parse.kconfig.parse_config(config) == {
+        "EXT4_FS": "y",
+        "DEFAULT_HOSTNAME": '"(none)"',
+    }
+
+
 def test_is_set():
     config = ("CONFIG_WIREGUARD=m\n"
               "# CONFIG_EXT2_FS is not set\n"
@@ -309,6 +321,50 @@ def test_check_config(monkeypatch, tmpdir):
     assert func(path, arch, pkgver, components_list, details, enforce) is True
 
 
+def test_check_configs(monkeypatch, tmpdir, caplog):
+    patch_config(monkeypatch)
+    func = pmb.parse.kconfig.check_configs
+    configs = []
+    for name, config in [("pass", 'CONFIG_BLK_DEV_INITRD=y\n'
+                                  'CONFIG_DEFAULT_HOSTNAME="(none)"\n'
+                                  'CONFIG_BINFMT_ELF=y\n'),
+                         ("fail", 'CONFIG_BLK_DEV_INITRD=y\n')]:
+        path = f"{tmpdir}/config-{name}.aarch64"
+        with open(path, "w") as handle:
+            handle.write(config)
+        configs += [{"config_path": path,
+                     "config_arch": "aarch64",
+                     "pkgver": "6.0",
+                     "components_list": [],
+                     "enforce_check": True}]
+
+    results = func(configs, details=True)
+    assert [result["passed"] for result in results] == [True, False]
+    warnings = [r.getMessage() for r in caplog.records
+                if r.levelname == "WARNING"]
+    assert len(warnings) == 2
+    assert all("config-fail.aarch64: CONFIG_" in w for w in warnings)
+    assert results[0]["warnings"] == []
+    assert results[1]["warnings"] == warnings
+
+    # Cache: first run fills it, second run uses it and logs the same
+    cache_dir = f"{tmpdir}/cache_kconfig"
+    assert func(configs, True, cache_dir=cache_dir) == results
+    caplog.clear()
+    results_cached = func(configs, True, cache_dir=cache_dir)
+    assert [result["cached"] for result in results_cached] == [True, True]
+    assert results_cached[1]["warnings"] == warnings
+    assert [r.getMessage() for r in caplog.records
+            if r.levelname == "WARNING"] == warnings
+
+    # Cache is not used when the rules change
+    monkeypatch.setitem(pmb.config.kconfig_options[">=0.0.0"]["all"],
+                        "BLK_DEV_INITRD", False)
+    results = func(configs, True, cache_dir=cache_dir)
+    assert [result["cached"] for result in results] == [False, False]
+    assert [result["passed"] for result in results] == [False, False]
+
+
 def test_check(args, monkeypatch, tmpdir):
     func = pmb.parse.kconfig.check
     details = True
@@ -169,3 +169,72 @@ def test_pkgrel_bump_high_level(args, tmpdir):
     # Clean up
     pmbootstrap(args, tmpdir, ["shutdown"])
     pmb.helpers.run.root(args, ["rm", "-rf", tmpdir])
+
+
+def write_apkindex(path, packages):
+    """:param packages: list of (pkgname, version, origin, depends,
+                        provides)"""
+    with open(path, "w") as handle:
+        for pkgname, version, origin, depends, provides in packages:
+            handle.write(f"P:{pkgname}\nV:{version}\nA:x86_64\nt:1\n"
+                         f"o:{origin}\nD:{' '.join(depends)}\n"
+                         f"p:{' '.join(provides)}\n\n")
+
+
+def test_pkgrel_bump_missing_depends(args, tmpdir):
+    tmpdir = str(tmpdir)
+    write_apkindex(f"{tmpdir}/alpine", [
+        ("musl", "1.2-r0", "musl", [], ["so:libc.musl-x86_64.so.1=1"]),
+    ])
+    write_apkindex(f"{tmpdir}/pmos", [
+        ("testlib", "1.0-r1", "testlib", ["so:libc.musl-x86_64.so.1"],
+         ["so:libtestlib.so.2=2"]),
+        ("testapp", "1.0-r0", "testapp",
+         ["so:libtestlib.so.1", "so:libc.musl-x86_64.so.1",
+          "!testapp-old"], []),
+        ("testsubpkg", "1.0-r0", "testsubpkg", ["testlib>=1.0"], []),
+        ("testsubpkg-sub", "1.0-r0", "testsubpkg", ["removed-pkg"], []),
+    ])
+    indexes = [f"{tmpdir}/alpine", f"{tmpdir}/pmos"]
+
+    func = pmb.helpers.pkgrel_bump.missing_depends
+    assert func(indexes, [f"{tmpdir}/pmos"]) == {
+        ("testapp", "1.0-r0"): ["so:libtestlib.so.1"],
+        ("testsubpkg", "1.0-r0"): ["removed-pkg"],
+    }
+
+
+def test_pkgrel_bump_auto(args, tmpdir, monkeypatch):
+    tmpdir = str(tmpdir)
+    for arch in ["aarch64", "x86_64"]:
+        write_apkindex(f"{tmpdir}/{arch}", [
+            ("testapp", "1.0-r0", "testapp", ["so:libtestlib.so.1"], []),
+            ("testsubpkg", "1.0-r0", "testsubpkg", ["testapp-doc"], []),
+            ("testold", "0.9-r0", "testold", ["so:libtestlib.so.1"], []),
+        ])
+    monkeypatch.setattr(pmb.config, "build_device_architectures",
+                        ["aarch64", "x86_64"])
+    monkeypatch.setattr(pmb.helpers.repo, "apkindex_files",
+                        lambda args, arch, alpine=True: [f"{tmpdir}/{arch}"])
+
+    aports = {"testapp": {"pkgname": "testapp", "pkgver": "1.0",
+                          "pkgrel": "0"},
+              "testold": {"pkgname": "testold", "pkgver": "1.0",
+                          "pkgrel": "0"},
+              "testsubpkg": {"pkgname": "testsubpkg", "pkgver": "1.0",
+                             "pkgrel": "0"},
+              "testapp-doc": {}}
+    monkeypatch.setattr(pmb.helpers.pmaports, "find",
+                        lambda args, pkgname, must_exist=True:
+                        pkgname if pkgname in aports else None)
+    monkeypatch.setattr(pmb.parse, "apkbuild",
+                        lambda path: aports[os.path.dirname(path)])
+    bumped = []
+    monkeypatch.setattr(pmb.helpers.pkgrel_bump, "package",
+                        lambda args, pkgname, reason="", dry=False:
+                        bumped.append((pkgname, reason, dry)))
+
+    # testold: binary package is outdated, testsubpkg: depends on an aport
+    assert pmb.helpers.pkgrel_bump.auto(args, True) == ["testapp"]
+    assert bumped == [("testapp", ", missing depend(s):"
+                       " so:libtestlib.so.1", True)]
@@ -122,6 +122,25 @@ def test_foreground_pipe(args):
     assert len(child_procs) == 0
 
 
+@pytest.mark.skip_ci
+def test_foreground_pipe_throughput(args):
+    """Benchmark reading lots of output, like from a verbose kernel build
+    (pytest -s to see the times)."""
+    func = pmb.helpers.run_core.foreground_pipe
+    lines = 500000
+    cmd = ["seq", str(lines)]
+    expected = "".join(f"{i}\n" for i in range(1, lines + 1))
+
+    for output_return in [False, True]:
+        start = time.perf_counter()
+        ret = func(args, cmd, output_return=output_return)
+        duration = time.perf_counter() - start
+        mb_per_second = len(expected) / 1024 / 1024 / duration
+        print(f"output_return={output_return}: {lines} lines in"
+              f" {duration:.3f}s ({mb_per_second:.1f} MB/s)")
+        assert ret == (0, expected if output_return else "")
+
+
 def test_foreground_tui():
     func = pmb.helpers.run_core.foreground_tui
     assert func(["echo", "test"]) == 0